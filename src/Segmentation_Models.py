@@ -1,30 +1,15 @@
 import numpy as np
 import random
 import json
-import h5py
 from patch_library import PatchLibrary
+from segment_volume import sort_slices
+from model_base import SegmentationModelBase
 from glob import glob
-import matplotlib.pyplot as plt
-from skimage import io, color, img_as_float
-from skimage.exposure import adjust_gamma
-from skimage.segmentation import mark_boundaries
-from sklearn.feature_extraction.image import extract_patches_2d
-from sklearn.metrics import classification_report
-from keras.models import Sequential, model_from_json, load_model
-from keras.layers.convolutional import Convolution2D, MaxPooling2D
-from keras.layers.core import Dense, Dropout, Activation, Flatten, Reshape
-from keras.layers import Merge, MaxoutDense
-from keras.layers.normalization import BatchNormalization
-from keras.regularizers import L1L2 as l1l2
-from keras.optimizers import SGD
-from keras.constraints import maxnorm
-from keras.callbacks import EarlyStopping, ModelCheckpoint
-from keras.utils import np_utils
 
-import os
+class SegmentationModel(SegmentationModelBase):
+    checkpoint_path = './models/example.hdf5'
 
-class SegmentationModel(object):
-    def __init__(self, n_epoch=10, n_chan=3, batch_size=128, loaded_model=False, architecture='single', w_reg=0.01, n_filters=[64,128,128,128], k_dims = [7,5,5,3], activation = 'relu'):
+    def __init__(self, n_epoch=10, n_chan=3, batch_size=128, loaded_model=False, architecture='single', w_reg=0.01, n_filters=[64,128,128,128], k_dims = [7,5,5,3], activation = 'relu', cache=None, store=None, prediction_cache=None, dtype=np.float32, norm_stats=None, normalization='slice_max', roi=None, model_name='./models/example'):
         '''
         A class for compiling/loading, fitting and saving various models, viewing segmented images and analyzing results
         INPUT   (1) int 'n_epoch': number of eopchs to train on. defaults to 10
@@ -36,6 +21,19 @@ class SegmentationModel(object):
                 (7) list 'n_filters': number of filters for each convolutional layer (4 total)
                 (8) list 'k_dims': dimension of kernel at each layer (will be a k_dim[n] x k_dim[n] square). Four total.
                 (9) string 'activation': activation to use at each convolutional layer. defaults to relu.
+                (10) SliceCache 'cache': cache of decoded slices used by predict_image. defaults to the shared cache
+                (11) SliceStore 'store': packed slice store. slices found in it are read as memory-mapped views instead of decoding pngs
+                (12) PredictionCache 'prediction_cache': on-disk cache of predictions, keyed by model weights and slice
+                     contents. predict_image and the volume entry points return cached predictions when given one
+                (13) dtype 'dtype': dtype slices are normalized into for prediction. float32 by default, float16 halves the
+                     inference tiles; training patches keep the dtype of the arrays passed to fit_model
+                (14) NormStats 'norm_stats': precomputed intensity statistics of the slices to predict on, see norm_stats
+                (15) str 'normalization': one of norm_stats.METHODS. defaults to slice_max, each modality divided by its
+                     max in the slice. train with the same normalization on the PatchLibrary
+                (16) int 'roi': if given, only pixels within roi pixels of the brain (nonzero modalities) are classified
+                     and slices without brain are not run through the model at all, see roi.brain_mask. every other
+                     pixel is background. defaults to None, classifying all 208 x 208 pixels
+                (17) str 'model_name': model and weights to load if loaded_model is True, not including extension
         '''
         self.n_epoch = n_epoch
         self.n_chan = n_chan
@@ -46,6 +44,21 @@ class SegmentationModel(object):
         self.n_filters = n_filters
         self.k_dims = k_dims
         self.activation = activation
+        self.cache = cache
+        self.store = store
+        # modalities fed to the model: flair, t1c and t2
+        self.channels = (0,2,3)
+        self.dense = None
+        # inputs of model_comp as views of each patch batch, set on first use
+        self.scales = None
+        self.prediction_cache = prediction_cache
+        self.dtype = np.dtype(dtype)
+        self.norm_stats = norm_stats
+        self.normalization = normalization
+        self.roi = roi
+        # hash of the architecture and weights, set when loading and recomputed lazily after training
+        self.weights_key = None
+        self.model_name = model_name
         if not self.loaded_model:
             if self.architecture == 'two_path':
                 self.model_comp = self.comp_two_path()
@@ -55,12 +68,18 @@ class SegmentationModel(object):
                 self.model_comp = self.compile_model()
         else:
             #model = str(input('Which model should I load? '))
-            self.model_comp = self.load_model_weights('./models/example')
+            self.model_comp = self.load_model_weights(model_name)
 
     def compile_model(self):
         '''
         compiles standard single model with 4 convolitional/max-pooling layers.
         '''
+        from keras.models import Sequential
+        from keras.layers.convolutional import Convolution2D, MaxPooling2D
+        from keras.layers.core import Dense, Dropout, Activation, Flatten
+        from keras.layers.normalization import BatchNormalization
+        from keras.regularizers import L1L2 as l1l2
+        from keras.optimizers import SGD
         print('Compiling single model...')
         single = Sequential()
 
@@ -94,6 +113,10 @@ class SegmentationModel(object):
         '''
         compiles two-path model, takes in a 4x33x33 patch and assesses global and local paths, then merges the results.
         '''
+        from keras.layers.convolutional import Convolution2D, MaxPooling2D
+        from keras.layers.core import Dense, Dropout, Flatten
+        from keras.regularizers import L1L2 as l1l2
+        from keras.optimizers import SGD
         print('Compiling two-path model...')
         #model = Graph()
         model.add_input(name='input', input_shape=(self.n_chan, 33, 33))
@@ -129,6 +152,13 @@ class SegmentationModel(object):
         '''
         double model. Simialar to two-pathway, except takes in a 4x33x33 patch and it's center 4x5x5 patch. merges paths at flatten layer.
         '''
+        from keras.models import Sequential
+        from keras.layers.convolutional import Convolution2D, MaxPooling2D
+        from keras.layers.core import Dense, Dropout, Activation, Flatten, Reshape
+        from keras.layers import Merge, MaxoutDense
+        from keras.layers.normalization import BatchNormalization
+        from keras.regularizers import L1L2 as l1l2
+        from keras.optimizers import SGD
         print('Compiling double model...')
         single = Sequential()
         single.add(Convolution2D(64, 7, 7, border_mode='valid', W_regularizer=l1l2(l1=0.01, l2=0.01), input_shape=(4,33,33)))
@@ -166,52 +196,6 @@ class SegmentationModel(object):
         print('Done.')
         return model
 
-    def load_model_weights(self, model_name):
-        '''
-        INPUT  (1) string 'model_name': filepath to model and weights, not including extension
-        OUTPUT: Model with loaded weights. can fit on model using loaded_model=True in fit_model method
-        '''
-        print('Loading model {}'.format(model_name))
-        model = '{}.json'.format(model_name)
-        weights = '{}.hdf5'.format(model_name)
-        '''
-        with open(model) as f:
-            m = f.next()
-        model_comp = model_from_json(json.loads(m))
-        '''
-        model_comp = model_from_json(open(model).read())
-        model_comp.load_weights(weights)
-        print('Done.')
-        return model_comp
-
-    def fit_model(self, X_train, y_train, X5_train = None, save=True):
-        '''
-        INPUT   (1) numpy array 'X_train': list of patches to train on in form (n_sample, n_channel, h, w)
-                (2) numpy vector 'y_train': list of labels corresponding to X_train patches in form (n_sample,)
-                (3) numpy array 'X5_train': center 5x5 patch in corresponding X_train patch. if None, uses single-path architecture
-        OUTPUT  (1) Fits specified model
-        '''
-        Y_train = np_utils.to_categorical(y_train, 5)
-
-        shuffle = list(zip(X_train, Y_train))
-        np.random.shuffle(shuffle)
-
-        X_train = np.array([shuffle[i][0] for i in range(len(shuffle))])
-        Y_train = np.array([shuffle[i][1] for i in range(len(shuffle))])
-        es = EarlyStopping(monitor='val_loss', patience=2, verbose=1, mode='auto')
-
-        # Save model after each epoch to check/bm_epoch#-val_loss
-        checkpointer = ModelCheckpoint(filepath="./models/example.hdf5", monitor='val_acc', save_best_only=True, mode='max',verbose=1)
-
-        if self.architecture == 'dual':
-            self.model_comp.fit([X5_train, X_train], Y_train, batch_size=self.batch_size, nb_epoch=self.n_epoch, validation_split=0.1, show_accuracy=True, verbose=1, callbacks=[checkpointer])
-        elif self.architecture == 'two_path':
-            data = {'input': X_train, 'output': Y_train}
-            self.model_comp.fit(data, batch_size=self.batch_size, nb_epoch=self.n_epoch, validation_split=0.1, show_accuracy=True, verbose=1, callbacks=[checkpointer])
-        else:
-            self.model_comp.fit(X_train, Y_train, batch_size=self.batch_size, nb_epoch=self.n_epoch, validation_split=0.1, verbose=1, callbacks=[checkpointer])
-            #self.model_comp.fit(X_train, Y_train, batch_size=self.batch_size, n_epoch=self.n_epoch,
-                                #validation_split=0.1,  verbose=1, callbacks=[checkpointer])
     def save_model(self, model_name):
         '''
         INPUT string 'model_name': name to save model and weigths under, including filepath but not extension
@@ -228,171 +212,10 @@ class SegmentationModel(object):
         '''
         open(model, 'w').write(json_string)
 
-    def class_report(self, X_test, y_test):
-        '''
-        returns skilearns test report (precision, recall, f1-score)
-        INPUT   (1) list 'X_test': test data of 4x33x33 patches
-                (2) list 'y_test': labels for X_test
-        OUTPUT  (1) confusion matrix of precision, recall and f1 score
-        '''
-        y_pred = self.model_load.predict_class(X_test)
-        print(classification_report(y_pred, y_test))
-
-    def predict_image(self, test_img, show=False):
-        '''
-        predicts classes of input image
-        INPUT   (1) str 'test_image': filepath to image to predict on
-                (2) bool 'show': True to show the results of prediction, False to return prediction
-        OUTPUT  (1) if show == False: array of predicted pixel classes for the center 208 x 208 pixels
-                (2) if show == True: displays segmentation results
-        '''
-        imgs = io.imread(test_img).astype('float').reshape(5,240,240)
-        plist = []
-        imgs_three=[]
-        imgs_three.append(imgs[0])
-        imgs_three.append(imgs[2])
-        imgs_three.append(imgs[3])
-        # create patches from an entire slice
-        for img in imgs_three:
-            if np.max(img) != 0:
-                img /= np.max(img)
-            p = extract_patches_2d(img, (33,33))
-            plist.append(p)
-        aa = list(zip(np.array(plist[0]), np.array(plist[1]), np.array(plist[2])))
-        patches = np.array(aa)
-
-        # predict classes of each pixel based on models
-        full_pred = self.model_comp.predict_classes(patches)
-
-        print(full_pred)
-        print(max(full_pred))
-        fp1 = full_pred.reshape(208,208)
-        if show:
-            io.imshow(fp1)
-            plt.show
-        else:
-            return fp1
-
-    def show_segmented_image(self, test_img, modality='t1c', show = False):
-        '''
-        Creates an image of original brain with segmentation overlay
-        INPUT   (1) str 'test_img': filepath to test image for segmentation, including file extension
-                (2) str 'modality': imaging modelity to use as background. defaults to t1c. options: (flair, t1, t1c, t2)
-                (3) bool 'show': If true, shows output image. defaults to False.
-        OUTPUT  (1) if show is True, shows image of segmentation results
-                (2) if show is false, returns segmented image.
-        '''
-        modes = {'flair':0, 't1':1, 't1c':2, 't2':3}
-
-        segmentation = self.predict_image(test_img)
-        img_mask = np.pad(segmentation, (16,16), mode='edge')
-        ones = np.argwhere(img_mask == 1)
-        twos = np.argwhere(img_mask == 2)
-        threes = np.argwhere(img_mask == 3)
-        fours = np.argwhere(img_mask == 4)
-
-        test_im = io.imread(test_img)
-        test_back = test_im.reshape(5,240,240)[-2]
-        # overlay = mark_boundaries(test_back, img_mask)
-        gray_img = img_as_float(test_back)
-
-        # adjust gamma of image
-        image = adjust_gamma(color.gray2rgb(gray_img), 0.65)
-        sliced_image = image.copy()
-        red_multiplier = [1, 0.2, 0.2]
-        yellow_multiplier = [1,1,0.25]
-        green_multiplier = [0.35,0.75,0.25]
-        blue_multiplier = [0,0.25,0.9]
-
-        # change colors of segmented classes
-        for i in range(len(ones)):
-            sliced_image[ones[i][0]][ones[i][1]] = red_multiplier
-        for i in range(len(twos)):
-            sliced_image[twos[i][0]][twos[i][1]] = green_multiplier
-        for i in range(len(threes)):
-            sliced_image[threes[i][0]][threes[i][1]] = blue_multiplier
-        for i in range(len(fours)):
-            sliced_image[fours[i][0]][fours[i][1]] = yellow_multiplier
-
-        if show:
-            io.imshow(sliced_image)
-            plt.show()
-
-        else:
-            return sliced_image
-
-    def get_dice_coef(self, test_img, label):
-        '''
-        Calculate dice coefficient for total slice, tumor-associated slice, advancing tumor and core tumor
-        INPUT   (1) str 'test_img': filepath to slice to predict on
-                (2) str 'label': filepath to ground truth label for test_img
-        OUTPUT: Summary of dice scores for the following classes:
-                    - all classes
-                    - all classes excluding background (ground truth and segmentation)
-                    - all classes excluding background (only ground truth-based)
-                    - advancing tumor
-                    - core tumor (1,3 and 4)
-        '''
-        segmentation = self.predict_image(test_img)
-        seg_full = np.pad(segmentation, (16,16), mode='edge')
-        gt = io.imread(label).astype(int)
-        # dice coef of total image
-        total = (len(np.argwhere(seg_full == gt)) * 2.) / (2 * 240 * 240)
-
-        def unique_rows(a):
-            '''
-            helper function to get unique rows from 2D numpy array
-            '''
-            a = np.ascontiguousarray(a)
-            unique_a = np.unique(a.view([('', a.dtype)]*a.shape[1]))
-            return unique_a.view(a.dtype).reshape((unique_a.shape[0], a.shape[1]))
-
-        # dice coef of entire non-background image
-        gt_tumor = np.argwhere(gt != 0)
-        seg_tumor = np.argwhere(seg_full != 0)
-        combo = np.append(pred_core, core, axis = 0)
-        core_edema = unique_rows(combo) # intersection of locations defined as tumor_assoc in gt and segmentation
-        gt_c, seg_c = [], [] # predicted class of each
-        for i in core_edema:
-            gt_c.append(gt[i[0]][i[1]])
-            seg_c.append(seg_full[i[0]][i[1]])
-        tumor_assoc = len(np.argwhere(np.array(gt_c) == np.array(seg_c))) / float(len(core))
-        tumor_assoc_gt = len(np.argwhere(np.array(gt_c) == np.array(seg_c))) / float(len(gt_tumor))
-
-        # dice coef advancing tumor
-        adv_gt = np.argwhere(gt == 4)
-        gt_a, seg_a = [], [] # classification of
-        for i in adv_gt:
-            gt_a.append(gt[i[0]][i[1]])
-            seg_a.append(fp[i[0]][i[1]])
-        gta = np.array(gt_a)
-        sega = np.array(seg_a)
-        adv = float(len(np.argwhere(gta == sega))) / len(adv_gt)
-
-        # dice coef core tumor
-        noadv_gt = np.argwhere(gt == 3)
-        necrosis_gt = np.argwhere(gt == 1)
-        live_tumor_gt = np.append(adv_gt, noadv_gt, axis = 0)
-        core_gt = np.append(live_tumor_gt, necrosis_gt, axis = 0)
-        gt_core, seg_core = [],[]
-        for i in core_gt:
-            gt_core.append(gt[i[0]][i[1]])
-            seg_core.append(seg_full[i[0]][i[1]])
-        gtcore, segcore = np.array(gt_core), np.array(seg_core)
-        core = len(np.argwhere(gtcore == segcore)) / float(len(core_gt))
-
-        print( ' ')
-        print( 'Region_______________________| Dice Coefficient')
-        print( 'Total Slice__________________| {0:.2f}'.format(total))
-        print( 'No Background gt_____________| {0:.2f}'.format(tumor_assoc_gt))
-        print( 'No Background both___________| {0:.2f}'.format(tumor_assoc))
-        print( 'Advancing Tumor______________| {0:.2f}'.format(adv))
-        print( 'Core Tumor___________________| {0:.2f}'.format(core))
-
 if __name__ == '__main__':
     #'''
     train_data = glob('/vdb1/ImageData/n4_PNG/**')
-    patches = PatchLibrary((33,33), train_data, 50000)
+    patches = PatchLibrary((33,33), train_data, 50000, index_path='/vdb1/ImageData/label_index.npz')
 
     X,y = patches.make_training_patches()
     #
@@ -405,13 +228,7 @@ if __name__ == '__main__':
     model = SegmentationModel(loaded_model=True)
     tests = glob('/vdb1/ImageData/BRATS/n4_PNG/3_*')
     print(len(tests))
-    test_sort = sorted(tests, key= lambda x: int(x[31:-4]))
-    segmented_images = []
-    i = 0
-    for slice in test_sort[12:126]:
-        print(slice)
-        filename = os.path.basename(slice)
-        segmented_images.append(model.show_segmented_image(slice,show = False))
-        plt.imsave('/vdb1/ImageData/Result/023/' + filename[:-4] + '_seg.png', segmented_images[i],format('png') )
-        i = i + 1
+    test_sort = sort_slices(tests)
+    volume, stats = model.segment_volume(test_sort[12:126])
+    model.render_volume(test_sort[12:126], volume, out_dir='/vdb1/ImageData/Result/023/')
     #'''
@@ -0,0 +1,254 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import subprocess
+import numpy as np
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# CPU-only and quiet, before anything imports tensorflow
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+
+from synthetic import RARITY, make_dataset, stand_in_model
+
+# most p50 seconds per item (patch or slice) each benchmark may take before the run fails, independent of any baseline.
+# several times what a laptop CPU needs with the stand-in model, so only regressions of an order of magnitude trip them
+BUDGETS = {'find_patches_rare_class': 1e-3,
+           'find_patches_common_class': 1e-3,
+           'make_training_patches': 1e-3,
+           'make_training_patches_entropy': 1e-3,
+           'predict_image_dense': 2.,
+           'predict_image_patch': 60.,
+           'predict_image_dense_roi': 2.,
+           'predict_image_patch_roi': 60.,
+           'cascade_predict_image': 4.,
+           'show_segmented_image': 0.05,
+           'get_dice_coef': 0.01,
+           'segment_volume': 2.}
+
+
+def peak_rss_mb():
+    '''
+    Peak resident set size of this process so far, in MB.
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024. ** 2 if sys.platform == 'darwin' else peak / 1024.
+
+
+def measure(fn, repeats=5, warmup=1, items=1):
+    '''
+    Times repeated calls of fn.
+    INPUT   (1) function 'fn': called with no arguments
+            (2) int 'repeats': timed calls
+            (3) int 'warmup': untimed calls first, e.g. to build graphs or fill caches
+            (4) int 'items': items (patches, slices) processed per call, for the throughput
+    OUTPUT  (1) dict of latency percentiles and mean in seconds, items per second and peak RSS after the calls
+    '''
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    times = np.array(times)
+    return {'repeats': repeats,
+            'items': items,
+            'mean': float(times.mean()),
+            'p50': float(np.percentile(times, 50)),
+            'p90': float(np.percentile(times, 90)),
+            'p99': float(np.percentile(times, 99)),
+            'min': float(times.min()),
+            'max': float(times.max()),
+            'throughput': float(items / times.mean()) if times.mean() else 0.,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def environment():
+    info = {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'numpy': np.__version__, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    for module in ('keras', 'tensorflow', 'skimage'):
+        if module in sys.modules:
+            info[module] = getattr(sys.modules[module], '__version__', None)
+    try:
+        info['commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=SRC, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return info
+
+
+def run(work_dir, n_patients=2, n_slices=16, rarity=RARITY, repeats=5, n_patches=500, only=None, patch_mode=True):
+    '''
+    Generates a synthetic dataset and stand-in model in work_dir and times the hot paths on them.
+    INPUT   (1) str 'work_dir': directory for the dataset, model and indices
+            (2) int 'n_patients', 'n_slices': size of the synthetic dataset
+            (3) tuple 'rarity': fraction of a tumour slice in each class
+            (4) int 'repeats': timed calls per benchmark
+            (5) int 'n_patches': patches per find_patches call, and per class in make_training_patches
+            (6) list 'only': names of the benchmarks to run. all if None
+            (7) bool 'patch_mode': if False, skips predict_image in patch mode, the slowest benchmark
+    OUTPUT  (1) dict of benchmark name -> measurements
+            (2) dict of correctness check name -> {'value', 'limit', 'ok'}, each value must stay at or below its limit
+    '''
+    from patch_library import PatchLibrary
+    from slice_cache import SliceCache, read_label
+
+    start = time.time()
+    paths, label_dir = make_dataset(os.path.join(work_dir, 'slices'), n_patients, n_slices, rarity)
+    model_name = os.path.join(work_dir, 'stand_in')
+    stand_in_model(model_name)
+    print('Synthetic dataset of {} slices in {:.2f}s'.format(len(paths), time.time() - start))
+
+    # output of the last call of each benchmark, for the checks comparing them
+    results, checks, outputs = {}, {}, {}
+
+    def check(name, value, limit):
+        checks[name] = {'value': float(value), 'limit': limit, 'ok': bool(value <= limit)}
+        print('{0:_<32}| {1:.3g} (limit {2:.3g}) {3}'.format(name, value, limit, 'ok' if value <= limit else 'FAILED'))
+
+    def bench(name, fn, **kwargs):
+        if only and name not in only:
+            return
+
+        def call():
+            outputs[name] = fn()
+        results[name] = measure(call, **kwargs)
+        r = results[name]
+        print('{0:_<32}| p50 {1:8.4f}s  p90 {2:8.4f}s  {3:10.1f} items/s  peak RSS {4:7.1f} MB'.format(
+            name, r['p50'], r['p90'], r['throughput'], r['peak_rss_mb']))
+
+    # a fresh cache so the first run decodes, as a new process would
+    library = PatchLibrary((33, 33), paths, n_patches * 5, label_dir=label_dir, cache=SliceCache(),
+                           index_path=os.path.join(work_dir, 'label_index.npz'))
+    rng = np.random.RandomState(0)
+    bench('find_patches_rare_class', lambda: library.find_patches(4., n_patches, normalize=True, rng=rng, verbose=False),
+          repeats=repeats, items=n_patches)
+    bench('find_patches_common_class', lambda: library.find_patches(0., n_patches, normalize=True, rng=rng, verbose=False),
+          repeats=repeats, items=n_patches)
+    bench('make_training_patches', lambda: library.make_training_patches(shard_size=n_patches),
+          repeats=max(1, repeats // 2), items=library.num_samples)
+    bench('make_training_patches_entropy', lambda: library.make_training_patches(entropy=True, shard_size=n_patches),
+          repeats=max(1, repeats // 2), items=library.num_samples)
+    if not only or 'make_training_patches' in only:
+        # each shard has its own seed, so the patches must not depend on the number of workers
+        np.random.seed(0)
+        X1, y1 = library.make_training_patches(entropy=True, shard_size=n_patches)
+        np.random.seed(0)
+        X2, y2 = library.make_training_patches(entropy=True, n_jobs=2, shard_size=n_patches)
+        check('n_jobs_mismatched_patches', ((X1 != X2).any(axis=(1, 2, 3)) | (y1 != y2)).sum(), 0)
+
+    from Segmentation_Models import SegmentationModel
+    model = SegmentationModel(loaded_model=True, model_name=model_name)
+    # a slice with tumour, so rendering and dice see every class
+    test_img = paths[[i for i, p in enumerate(paths) if read_label(library.label_path(p), library.cache).max()][0]]
+    label = library.label_path(test_img)
+    # largest difference between dense and patch class probabilities, float32 rounding when the kernels line up
+    check('verify_dense', model.verify_dense(test_img), 1e-4)
+    bench('predict_image_dense', lambda: model.predict_image(test_img, mode='dense'), repeats=repeats)
+    if patch_mode:
+        bench('predict_image_patch', lambda: model.predict_image(test_img, mode='patch'), repeats=max(1, repeats // 5), warmup=0)
+    # brain-mask inference, only pixels near nonzero modalities are classified
+    roi_model = SegmentationModel(loaded_model=True, model_name=model_name, roi=2)
+    bench('predict_image_dense_roi', lambda: roi_model.predict_image(test_img, mode='dense'), repeats=repeats)
+    if patch_mode:
+        bench('predict_image_patch_roi', lambda: roi_model.predict_image(test_img, mode='patch'), repeats=max(1, repeats // 5), warmup=0)
+    # dense inference is exact, so both modes must predict the same classes
+    for dense, patch in (('predict_image_dense', 'predict_image_patch'), ('predict_image_dense_roi', 'predict_image_patch_roi')):
+        if dense in outputs and patch in outputs:
+            check(dense.replace('predict_image', 'mismatched_pixels'), (outputs[dense] != outputs[patch]).sum(), 0)
+    # the stand-in gating itself stands for the fast model gating the dual one; the escalated fraction is recorded
+    from cascade import CascadeModel
+    cascade = CascadeModel(roi_model, model, threshold=0.9, boundary=1, fast_mode='dense', slow_mode='dense')
+    bench('cascade_predict_image', lambda: cascade.predict_image(test_img), repeats=repeats)
+    if 'cascade_predict_image' in results:
+        results['cascade_predict_image']['escalated_fraction'] = cascade.summary()['escalated_fraction']
+
+    # rendering and metrics are timed on a fixed segmentation, apart from the prediction timed above
+    segmentation = model.predict_image(test_img, mode='dense')
+    bench('show_segmented_image', lambda: model.show_segmented_image(test_img, segmentation=segmentation), repeats=repeats)
+    bench('get_dice_coef', lambda: model.get_dice_coef(test_img, label, segmentation=segmentation), repeats=repeats)
+    bench('segment_volume', lambda: model.segment_volume(paths[:n_slices], batch_slices=4), repeats=max(1, repeats // 2),
+          items=n_slices)
+    return results, checks
+
+
+def compare(results, baseline, tolerance=1.2):
+    '''
+    Prints the p50 latency of each benchmark against a baseline run.
+    OUTPUT  list of benchmarks more than tolerance times slower than in the baseline
+    '''
+    slower = []
+    for name, r in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ratio = r['p50'] / baseline[name]['p50'] if baseline[name]['p50'] else float('inf')
+        print('{0:_<32}| {1:6.2f}x baseline p50{2}'.format(name, ratio, '  SLOWER' if ratio > tolerance else ''))
+        if ratio > tolerance:
+            slower.append(name)
+    return slower
+
+
+def over_budget(results, scale=1.):
+    '''
+    Checks the p50 seconds per item of each benchmark against BUDGETS.
+    INPUT   (1) dict 'results': as returned by run
+            (2) float 'scale': multiplies every budget, for slower machines
+    OUTPUT  list of benchmarks over their budget
+    '''
+    over = []
+    for name, budget in sorted(BUDGETS.items()):
+        if name not in results:
+            continue
+        per_item = results[name]['p50'] / results[name]['items']
+        ok = per_item <= budget * scale
+        print('{0:_<32}| {1:10.6f}s per item, budget {2:.6f}s {3}'.format(name, per_item, budget * scale, 'ok' if ok else 'OVER BUDGET'))
+        if not ok:
+            over.append(name)
+    return over
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time patch sampling, inference and metrics on synthetic BRATS-shaped data.')
+    parser.add_argument('--work', default='./bench_work', help='directory for the synthetic dataset and stand-in model')
+    parser.add_argument('--out', default='bench_results.json', help='file to write the results to')
+    parser.add_argument('--patients', type=int, default=2)
+    parser.add_argument('--slices', type=int, default=16, help='slices per patient')
+    parser.add_argument('--rarity', default=','.join(str(r) for r in RARITY),
+                        help='fraction of a tumour slice in each of the 5 classes, comma separated')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--patches', type=int, default=500, help='patches per find_patches call')
+    parser.add_argument('--only', default=None, help='comma separated benchmarks to run')
+    parser.add_argument('--skip-patch-mode', action='store_true', help='skip predict_image in patch mode')
+    parser.add_argument('--compare', default=None, help='results json of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.2, help='slowdown over the baseline p50 that fails the run')
+    parser.add_argument('--budget-scale', type=float, default=1., help='multiplies the per-item time budgets in BUDGETS')
+    args = parser.parse_args()
+
+    rarity = tuple(float(r) for r in args.rarity.split(','))
+    results, checks = run(args.work, args.patients, args.slices, rarity, args.repeats, args.patches,
+                  args.only.split(',') if args.only else None, not args.skip_patch_mode)
+    with open(args.out, 'w') as f:
+        json.dump({'environment': environment(), 'config': vars(args), 'results': results, 'checks': checks}, f, indent=2, sort_keys=True)
+    print('Results written to {}'.format(args.out))
+
+    failed = [name for name, c in sorted(checks.items()) if not c['ok']]
+    if failed:
+        print('Failed checks: {}'.format(', '.join(failed)))
+    over = over_budget(results, args.budget_scale)
+    failed += over
+    if over:
+        print('Over budget: {}'.format(', '.join(over)))
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(results, json.load(f)['results'], args.tolerance)
+        if slower:
+            print('Slower than the baseline: {}'.format(', '.join(slower)))
+            failed += slower
+    if failed:
+        sys.exit(1)
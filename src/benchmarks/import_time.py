@@ -0,0 +1,85 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# dependencies that must only be imported by the code paths that use them
+HEAVY = ('keras', 'tensorflow', 'theano', 'matplotlib', 'sklearn', 'h5py', 'skimage', 'IPython')
+
+# module -> heavy dependencies it is allowed to import eagerly
+MODULES = {'patch_library': (),
+           'label_index': (),
+           'slice_cache': (),
+           'slice_store': (),
+           'patch_stream': (),
+           'metrics': (),
+           'rendering': (),
+           'inference': (),
+           'segment_volume': (),
+           'evaluation': (),
+           'prediction_cache': (),
+           'model_registry': (),
+           'norm_stats': (),
+           'boundary_index': (),
+           'instrumentation': (),
+           'roi': (),
+           'cascade': (),
+           'Segmentation_Models': (),
+           'Two_Models': (),
+           'model_base': (),
+           'inference_server': ()}
+
+_PROBE = '''
+import sys, time, json
+start = time.time()
+import {module}
+seconds = time.time() - start
+print(json.dumps({{'seconds': seconds, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+
+def time_import(module, repeats=3):
+    '''
+    Imports module in fresh interpreters and reports the fastest import time and the heavy dependencies it loaded.
+    INPUT   (1) str 'module': module in src to import
+            (2) int 'repeats': fresh interpreters to time, the fastest one is kept to reduce noise from disk caches
+    OUTPUT  (1) dict of 'seconds' and 'loaded' heavy dependencies
+    '''
+    best = None
+    for _ in range(repeats):
+        out = subprocess.check_output([sys.executable, '-c', _PROBE.format(module=module, heavy=HEAVY)], cwd=SRC,
+                                      env=dict(os.environ, PYTHONPATH=SRC))
+        result = json.loads(out.decode().strip().splitlines()[-1])
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that the modules import fast and without their heavy dependencies.')
+    parser.add_argument('modules', nargs='*', help='modules to check. defaults to all of src')
+    parser.add_argument('--budget', type=float, default=1., help='seconds each import may take')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--json', default=None, help='file to write the results to')
+    args = parser.parse_args()
+
+    results, failed = {}, []
+    for module in args.modules or sorted(MODULES):
+        result = time_import(module, args.repeats)
+        leaked = [m for m in result['loaded'] if m not in MODULES.get(module, ())]
+        ok = result['seconds'] <= args.budget and not leaked
+        results[module] = dict(result, ok=ok)
+        print('{0:_<24}| {1:6.3f}s {2}{3}'.format(module, result['seconds'], 'ok' if ok else 'FAIL',
+                                                   ' (imports {})'.format(', '.join(leaked)) if leaked else ''))
+        if not ok:
+            failed.append(module)
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if failed:
+        print('Import budget exceeded or heavy dependencies imported eagerly: {}'.format(', '.join(failed)))
+        sys.exit(1)
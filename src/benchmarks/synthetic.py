@@ -0,0 +1,94 @@
+import numpy as np
+import os
+
+# default fraction of the pixels of a tumour slice in each class: background and healthy tissue, necrosis, edema,
+# non-enhancing and enhancing tumour. the tumour classes are rare, as in BRATS
+RARITY = (0.9, 0.02, 0.05, 0.02, 0.01)
+
+
+def synthetic_slice(rng, rarity=RARITY, tumour=True):
+    '''
+    One BRATS-shaped slice: an elliptical brain in 5 uint8 modalities (the fifth is the ground truth, as in the png
+    slices) holding a tumour of concentric classes whose areas follow rarity.
+    INPUT   (1) RandomState 'rng': source of randomness
+            (2) tuple 'rarity': fraction of the slice in each of the 5 classes
+            (3) bool 'tumour': if False, the slice only holds healthy brain
+    OUTPUT  (1) (5, 240, 240) uint8 modalities
+            (2) (240, 240) uint8 label
+    '''
+    rows, cols = np.mgrid[:240, :240]
+    cy, cx = 120 + rng.randint(-8, 9), 120 + rng.randint(-8, 9)
+    brain = ((rows - cy) / 95.) ** 2 + ((cols - cx) / 80.) ** 2 <= 1
+    label = np.zeros((240, 240), np.uint8)
+    if tumour:
+        ty, tx = cy + rng.randint(-30, 31), cx + rng.randint(-25, 26)
+        dist = np.hypot(rows - ty, cols - tx)
+        # nested rings from the inside out: necrotic core, enhancing, non-enhancing, edema
+        area = 0.
+        for c in (1, 4, 3, 2):
+            area += rarity[c] * 240 * 240
+            label[(dist <= np.sqrt(area / np.pi)) & (label == 0)] = c
+        label[~brain] = 0
+
+    image = np.zeros((5, 240, 240), np.float32)
+    for m in range(4):
+        contrast = rng.uniform(20, 60, 5)
+        image[m] = 90 + contrast[label] + rng.normal(0, 8, (240, 240))
+    image[:4, ~brain] = 0
+    image[4] = label * 50
+    return np.clip(image, 0, 255).astype(np.uint8), label
+
+
+def make_dataset(out_dir, n_patients=2, n_slices=16, rarity=RARITY, tumour_fraction=0.75, seed=0):
+    '''
+    Writes synthetic '<patient>_<slice>.png' slices and their '<name>L.png' labels.
+    INPUT   (1) str 'out_dir': directory to write slices to. labels go to out_dir/labels
+            (2) int 'n_patients': number of volumes
+            (3) int 'n_slices': slices per volume
+            (4) tuple 'rarity': fraction of a tumour slice in each class
+            (5) float 'tumour_fraction': fraction of slices holding tumour, the rest are healthy brain only
+            (6) int 'seed': seed of the whole dataset
+    OUTPUT  (1) list of slice filepaths
+            (2) str label directory
+    '''
+    from skimage import io
+
+    label_dir = os.path.join(out_dir, 'labels')
+    if not os.path.isdir(label_dir):
+        os.makedirs(label_dir)
+    rng = np.random.RandomState(seed)
+    paths = []
+    for patient in range(n_patients):
+        for s in range(n_slices):
+            image, label = synthetic_slice(rng, rarity, tumour=rng.random_sample() < tumour_fraction)
+            path = os.path.join(out_dir, '{}_{}.png'.format(patient, s))
+            io.imsave(path, image.reshape(5 * 240, 240), check_contrast=False)
+            io.imsave(os.path.join(label_dir, '{}_{}L.png'.format(patient, s)), label, check_contrast=False)
+            paths.append(path)
+    return paths, label_dir
+
+
+def stand_in_model(model_name, n_chan=3, seed=0):
+    '''
+    Saves a small untrained patch classifier with the layout of compile_model (channels-first 33x33 patches,
+    valid convolutions and stride 1 pooling, Flatten, Dense and softmax), so inference paths can be timed on a CPU.
+    INPUT   (1) str 'model_name': filepath to save the model and weights to, not including extension
+            (2) int 'n_chan': input channels
+            (3) int 'seed': seed of the weights
+    '''
+    from keras.models import Sequential
+    from keras.layers import Conv2D, MaxPooling2D, Flatten, Dense, Activation
+
+    np.random.seed(seed)
+    model = Sequential([Conv2D(8, (7, 7), activation='relu', data_format='channels_first', input_shape=(n_chan, 33, 33)),
+                        MaxPooling2D(pool_size=(2, 2), strides=(1, 1), data_format='channels_first'),
+                        Conv2D(8, (5, 5), activation='relu', data_format='channels_first'),
+                        MaxPooling2D(pool_size=(2, 2), strides=(1, 1), data_format='channels_first'),
+                        Conv2D(8, (3, 3), activation='relu', data_format='channels_first'),
+                        Flatten(),
+                        Dense(5),
+                        Activation('softmax')])
+    model.set_weights([np.random.normal(0, 0.1, w.shape).astype(np.float32) for w in model.get_weights()])
+    with open(model_name + '.json', 'w') as f:
+        f.write(model.to_json())
+    model.save_weights(model_name + '.hdf5')
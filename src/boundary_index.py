@@ -0,0 +1,190 @@
+import numpy as np
+import os
+import multiprocessing
+from label_index import progress_bar
+
+# BoundaryIndex.build parameters saved with an index, in the order they are saved in
+PARAMS = ('radius', 'percentile', 'border')
+
+
+def label_entropy(label, radius, n_classes=5):
+    '''
+    Shannon entropy of the label classes in the (2 * radius + 1) square window around every pixel, from one integral
+    image per class. The same measure as skimage.filters.rank.entropy over the label with a square footprint, at a
+    cost independent of the window size.
+    INPUT   (1) array 'label': (h, w) label classes
+            (2) int 'radius': half width of the window
+            (3) int 'n_classes': number of label classes
+    OUTPUT  (1) (h, w) float32 entropy in bits, 0 where the window holds a single class
+    '''
+    h, w = label.shape
+    onehot = (label[np.newaxis] == np.arange(n_classes)[:, np.newaxis, np.newaxis]).astype(np.int32)
+    integral = np.zeros((n_classes, h + 1, w + 1), dtype=np.int32)
+    integral[:, 1:, 1:] = onehot.cumsum(axis=1).cumsum(axis=2)
+    r0, r1 = np.clip(np.arange(h) - radius, 0, h), np.clip(np.arange(h) + radius + 1, 0, h)
+    c0, c1 = np.clip(np.arange(w) - radius, 0, w), np.clip(np.arange(w) + radius + 1, 0, w)
+    counts = (integral[:, r1][:, :, c1] - integral[:, r0][:, :, c1] - integral[:, r1][:, :, c0] + integral[:, r0][:, :, c0])
+    p = counts.astype(np.float32)
+    p /= p.sum(axis=0, keepdims=True)
+    logp = np.log2(p, out=np.zeros_like(p), where=p > 0)
+    return -(p * logp).sum(axis=0)
+
+
+def slice_boundaries(label, radius, percentile=90, border=16):
+    '''
+    High-entropy (class boundary) pixels of one label, ranked by entropy.
+    INPUT   (1) array 'label': (240, 240) label classes
+            (2) int 'radius': half width of the entropy window
+            (3) float 'percentile': pixels at or above this entropy percentile of the slice, and above zero, are kept
+            (4) int 'border': pixels closer than this to the edge are left out, as no whole patch fits around them
+    OUTPUT  (1) (n, 2) uint8 coordinates, highest entropy first
+            (2) (n,) float16 entropy of each coordinate
+            (3) (n,) uint8 label class of each coordinate
+    '''
+    ent = label_entropy(label, radius)
+    inner = ent[border:ent.shape[0] - border, border:ent.shape[1] - border]
+    top = np.percentile(ent, percentile)
+    if top == 0:
+        top = np.finfo(np.float32).tiny
+    where = np.argwhere(inner >= top)
+    scores = inner[where[:, 0], where[:, 1]]
+    order = np.argsort(-scores, kind='stable')
+    where = where[order] + border
+    return where.astype(np.uint8), scores[order].astype(np.float16), label[where[:, 0], where[:, 1]].astype(np.uint8)
+
+
+class BoundaryIndex(object):
+    def __init__(self, paths, slices, offsets, coords, scores, classes, params=None):
+        '''
+        Ranked class-boundary coordinates of every training slice, computed once so entropy sampling is an index
+        lookup. Build it with BoundaryIndex.build and save it alongside the label index.
+        INPUT   (1) list 'paths': filepaths of the indexed training slices
+                (2) array 'slices': indices into paths of slices holding boundary pixels
+                (3) array 'offsets': offsets into coords for each entry of slices (len(slices) + 1)
+                (4) array 'coords': (n, 2) boundary coordinates, grouped by slice and ranked by entropy within each
+                (5) array 'scores': (n,) entropy of each coordinate
+                (6) array 'classes': (n,) label class at each coordinate
+                (7) dict 'params': radius, percentile and border the index was built with, None if unknown
+        '''
+        self.paths = list(paths)
+        self.slices = slices
+        self.offsets = offsets
+        self.coords = coords
+        self.scores = scores
+        self.classes = classes
+        self.params = params
+
+    @classmethod
+    def build(cls, train_data, load_label, radius=16, percentile=90, border=16, n_jobs=1):
+        '''
+        Computes the label entropy of every training slice once, in n_jobs forked processes.
+        INPUT   (1) list 'train_data': filepaths to training slices
+                (2) function 'load_label': maps a training slice filepath to its decoded label
+                (3) int 'radius': half width of the entropy window
+                (4) float 'percentile': entropy percentile of each slice above which pixels are indexed
+                (5) int 'border': pixels closer than this to the edge are not indexed, half the patch size
+                (6) int 'n_jobs': worker processes
+        OUTPUT  (1) BoundaryIndex over train_data
+        '''
+        print('Indexing label boundaries of {} slices...'.format(len(train_data)))
+        args = (train_data, load_label, radius, percentile, border)
+        bar = progress_bar()
+        if n_jobs == 1:
+            _init_worker(*args)
+            results = [_index_slice(s) for s in bar(range(len(train_data)))]
+        else:
+            pool = multiprocessing.get_context('fork').Pool(n_jobs, _init_worker, args)
+            try:
+                results = list(bar(pool.imap(_index_slice, range(len(train_data)), chunksize=16)))
+            finally:
+                pool.close()
+                pool.join()
+        slices = np.array([s for s, r in enumerate(results) if len(r[0])], dtype=np.int64)
+        kept = [results[s] for s in slices]
+        offsets = np.cumsum([0] + [len(r[0]) for r in kept]).astype(np.int64)
+        coords = np.concatenate([r[0] for r in kept]) if kept else np.zeros((0, 2), np.uint8)
+        scores = np.concatenate([r[1] for r in kept]) if kept else np.zeros(0, np.float16)
+        classes = np.concatenate([r[2] for r in kept]) if kept else np.zeros(0, np.uint8)
+        print('Done.')
+        return cls(train_data, slices, offsets, coords, scores, classes, build_params(radius, percentile, border))
+
+    @classmethod
+    def load(cls, index_path):
+        '''
+        INPUT   (1) str 'index_path': filepath of an index written by save
+        OUTPUT  (1) BoundaryIndex
+        '''
+        data = np.load(index_path)
+        # indexes saved before the parameters were recorded have none, and are rebuilt by load_or_build
+        params = build_params(*data['params']) if 'params' in data else None
+        return cls([str(p) for p in data['paths']], data['slices'], data['offsets'], data['coords'], data['scores'],
+                   data['classes'], params)
+
+    def save(self, index_path):
+        '''
+        INPUT   (1) str 'index_path': filepath to save the index to (.npz)
+        '''
+        arrays = {} if self.params is None else {'params': np.array([self.params[k] for k in PARAMS], dtype=np.float64)}
+        np.savez(index_path, paths=np.array(self.paths), slices=self.slices, offsets=self.offsets, coords=self.coords,
+                 scores=self.scores, classes=self.classes, **arrays)
+
+    def covers(self, train_data):
+        '''
+        True if the index was built over exactly the slices in train_data (in any order).
+        '''
+        return set(self.paths) == set(train_data)
+
+    def sample(self, n=1, top=None, rng=np.random):
+        '''
+        Draws slices uniformly from those with boundaries, then a boundary pixel uniformly within each slice.
+        INPUT   (1) int 'n': number of draws
+                (2) int 'top': if given, only the top highest-entropy pixels of each slice are drawn from
+                (3) RandomState 'rng': source of randomness. defaults to the global numpy state
+        OUTPUT  (1) array of indices into paths (n,)
+                (2) array of pixel coordinates (n, 2)
+                (3) array of the label class at each coordinate (n,)
+        '''
+        if len(self.slices) == 0:
+            raise ValueError('No slice in the index has label boundaries')
+        s = rng.randint(0, len(self.slices), n)
+        start, count = self.offsets[s], self.offsets[s + 1] - self.offsets[s]
+        if top is not None:
+            count = np.minimum(count, top)
+        p = start + (rng.random_sample(n) * count).astype(np.int64)
+        return self.slices[s], self.coords[p].astype(np.int64), self.classes[p]
+
+
+def build_params(radius, percentile, border):
+    '''
+    OUTPUT  dict of the BoundaryIndex.build parameters that decide which pixels are indexed, see PARAMS
+    '''
+    return {'radius': int(radius), 'percentile': float(percentile), 'border': int(border)}
+
+
+# arguments of a BoundaryIndex.build worker process, set when the worker is forked
+_worker = {}
+
+
+def _init_worker(train_data, load_label, radius, percentile, border):
+    _worker.update(train_data=train_data, load_label=load_label, radius=radius, percentile=percentile, border=border)
+
+
+def _index_slice(s):
+    label = np.asarray(_worker['load_label'](_worker['train_data'][s]))
+    return slice_boundaries(label, _worker['radius'], _worker['percentile'], _worker['border'])
+
+
+def load_or_build(index_path, train_data, load_label, radius=16, percentile=90, border=16, n_jobs=1):
+    '''
+    Loads the index at index_path, rebuilding and saving it if missing, if it no longer matches train_data, or if it
+    was built with another radius, percentile or border.
+    '''
+    if index_path is not None and os.path.exists(index_path):
+        index = BoundaryIndex.load(index_path)
+        if index.covers(train_data) and index.params == build_params(radius, percentile, border):
+            return index
+        print('Boundary index {} is out of date, rebuilding.'.format(index_path))
+    index = BoundaryIndex.build(train_data, load_label, radius, percentile, border, n_jobs)
+    if index_path is not None:
+        index.save(index_path)
+    return index
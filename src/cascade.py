@@ -0,0 +1,158 @@
+import numpy as np
+import time
+import argparse
+from glob import glob
+from boundary_index import label_entropy
+from segment_volume import sort_slices
+from instrumentation import span, count
+
+
+def escalation_mask(probabilities, threshold=0.9, boundary=1, mask=None):
+    '''
+    Pixels the first pass is not sure of: those whose top class probability is below threshold, and those within
+    boundary pixels of a change of predicted class (a tumour boundary).
+    INPUT   (1) array 'probabilities': (5, 208, 208) class probabilities of the first pass
+            (2) float 'threshold': pixels with a lower top probability are escalated
+            (3) int 'boundary': pixels whose (2 * boundary + 1) square window holds more than one predicted class are
+                escalated. 0 escalates on confidence alone
+            (4) array 'mask': (208, 208) pixels that may be escalated, e.g. the brain mask. all if None
+    OUTPUT  (1) (208, 208) bool mask of the pixels to re-score
+            (2) int number of pixels escalated on confidence
+            (3) int number of pixels escalated only for being near a boundary
+    '''
+    unsure = probabilities.max(axis=0) < threshold
+    near = np.zeros_like(unsure)
+    if boundary > 0:
+        near = label_entropy(np.argmax(probabilities, axis=0), boundary) > 0
+    escalate = unsure | near
+    if mask is not None:
+        escalate &= mask
+        unsure &= mask
+    return escalate, int(unsure.sum()), int(escalate.sum() - unsure.sum())
+
+
+class CascadeModel(object):
+    def __init__(self, fast, slow, threshold=0.9, boundary=1, fast_mode='auto', slow_mode='auto'):
+        '''
+        Coarse-to-fine inference: a fast model classifies every pixel, and only the pixels it is unsure of, or that lie
+        near a predicted tumour boundary, are re-scored by a slower, more accurate model. Each model reads and normalizes
+        the slice in its own way, so e.g. a 3-channel Segmentation_Models network can gate a 4-channel Two_Models one.
+        INPUT   (1) SegmentationModel 'fast': first-pass model, e.g. the compile_model network. its roi setting, if
+                    any, also limits what is escalated
+                (2) SegmentationModel 'slow': model re-scoring the escalated pixels, e.g. the dual network
+                (3) float 'threshold': top class probability below which a pixel is escalated
+                (4) int 'boundary': pixels this close to a change of predicted class are escalated, see escalation_mask
+                (5) str 'fast_mode': inference mode of the first pass, as for predict_image
+                (6) str 'slow_mode': inference mode of the second pass. in patch mode only the escalated patches are
+                    classified; in dense mode the slow model runs over the bounding box of the escalated pixels
+        '''
+        self.fast = fast
+        self.slow = slow
+        self.threshold = threshold
+        self.boundary = boundary
+        self.fast_mode = fast_mode
+        self.slow_mode = slow_mode
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'slices': 0, 'pixels': 0, 'escalated': 0, 'escalated_confidence': 0, 'escalated_boundary': 0,
+                      'fast_seconds': 0., 'slow_seconds': 0.}
+
+    def predict_image(self, test_img):
+        '''
+        INPUT   str 'test_img': filepath to the slice to predict on
+        OUTPUT  (1) (208, 208) predicted classes: the slow model's where escalated, the fast model's elsewhere
+                (2) (208, 208) bool mask of the escalated pixels
+        '''
+        image = self.fast.read_image(test_img)
+        start = time.time()
+        roi = self.fast.roi_mask(image)
+        with span('cascade_fast'):
+            probabilities = self.fast.predict_stack(self.fast.normalize(image, test_img), self.fast_mode, mask=roi,
+                                                    probabilities=True)
+        fast_seconds = time.time() - start
+        escalate, n_confidence, n_boundary = escalation_mask(probabilities, self.threshold, self.boundary, roi)
+        classes = np.argmax(probabilities, axis=0)
+
+        start = time.time()
+        if escalate.any():
+            with span('cascade_slow'):
+                refined = self.slow.predict_stack(self.slow.normalize(image, test_img), self.slow_mode, mask=escalate)
+            classes[escalate] = refined[escalate]
+        slow_seconds = time.time() - start
+
+        s = self.stats
+        s['slices'] += 1
+        s['pixels'] += classes.size
+        s['escalated'] += int(escalate.sum())
+        s['escalated_confidence'] += n_confidence
+        s['escalated_boundary'] += n_boundary
+        s['fast_seconds'] += fast_seconds
+        s['slow_seconds'] += slow_seconds
+        count('pixels_escalated', n_confidence, reason='confidence')
+        count('pixels_escalated', n_boundary, reason='boundary')
+        return classes, escalate
+
+    def segment_volume(self, slice_paths):
+        '''
+        INPUT   list 'slice_paths': filepaths to the slices of one patient, in order
+        OUTPUT  (1) (n_slices, 208, 208) array of predicted classes
+                (2) (n_slices, 208, 208) bool array of the escalated pixels
+        '''
+        volume = np.empty((len(slice_paths), 208, 208), dtype=np.uint8)
+        escalated = np.empty((len(slice_paths), 208, 208), dtype=bool)
+        for i, path in enumerate(slice_paths):
+            volume[i], escalated[i] = self.predict_image(path)
+        return volume, escalated
+
+    def summary(self, baseline_seconds=None):
+        '''
+        INPUT   float 'baseline_seconds': time the slow model alone took on the same slices, if measured
+        OUTPUT  dict of the statistics so far: fraction of pixels escalated and seconds in each pass, and the speedup
+                over the slow model alone when baseline_seconds is given
+        '''
+        s = dict(self.stats)
+        s['escalated_fraction'] = s['escalated'] / float(s['pixels']) if s['pixels'] else 0.
+        s['seconds'] = s['fast_seconds'] + s['slow_seconds']
+        if baseline_seconds is not None:
+            s['baseline_seconds'] = baseline_seconds
+            s['speedup'] = baseline_seconds / s['seconds'] if s['seconds'] else float('inf')
+        return s
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Segment slices with a fast model gating a slower, more accurate one.')
+    parser.add_argument('slices', help="glob of the slice pngs, e.g. '/vdb1/ImageData/BRATS/n4_PNG/3_*'")
+    parser.add_argument('--fast', default='./models/example', help='Segmentation_Models model json/hdf5 path without extension')
+    parser.add_argument('--slow', default='../models/dual_example', help='Two_Models model json/hdf5 path without extension')
+    parser.add_argument('--threshold', type=float, default=0.9, help='top class probability below which pixels are escalated')
+    parser.add_argument('--boundary', type=int, default=1, help='pixels this close to a predicted class change are escalated')
+    parser.add_argument('--fast-mode', default='auto', choices=['auto', 'dense', 'patch'])
+    parser.add_argument('--slow-mode', default='auto', choices=['auto', 'dense', 'patch'])
+    parser.add_argument('--roi', type=int, default=None, help='only classify pixels within this many pixels of the brain')
+    parser.add_argument('--out', default='volume.npy', help='.npy file to save the (n_slices, 208, 208) volume to')
+    parser.add_argument('--baseline', action='store_true', help='also time the slow model alone, and compare its predictions')
+    args = parser.parse_args()
+
+    from Segmentation_Models import SegmentationModel as FastModel
+    from Two_Models import SegmentationModel as SlowModel
+    cascade = CascadeModel(FastModel(loaded_model=True, model_name=args.fast, roi=args.roi),
+                           SlowModel(loaded_model=True, model_name=args.slow, roi=args.roi),
+                           args.threshold, args.boundary, args.fast_mode, args.slow_mode)
+    slice_paths = sort_slices(glob(args.slices))
+    volume, escalated = cascade.segment_volume(slice_paths)
+    np.save(args.out, volume)
+
+    baseline_seconds = None
+    if args.baseline:
+        start = time.time()
+        reference = np.array([cascade.slow.predict_image(p, mode=args.slow_mode) for p in slice_paths])
+        baseline_seconds = time.time() - start
+        print('Agreement with the slow model alone: {:.4f}'.format((reference == volume).mean()))
+    s = cascade.summary(baseline_seconds)
+    print('Cascaded {} slices in {:.2f}s ({:.2f}s first pass, {:.2f}s second pass)'.format(
+        s['slices'], s['seconds'], s['fast_seconds'], s['slow_seconds']))
+    print('Escalated {:.2%} of pixels ({} on confidence, {} near boundaries)'.format(
+        s['escalated_fraction'], s['escalated_confidence'], s['escalated_boundary']))
+    if 'speedup' in s:
+        print('Slow model alone took {:.2f}s, speedup {:.2f}x'.format(s['baseline_seconds'], s['speedup']))
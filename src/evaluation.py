@@ -0,0 +1,132 @@
+import numpy as np
+import os
+import csv
+import json
+import time
+import argparse
+from glob import glob
+from slice_cache import read_label
+from segment_volume import iter_segmentations
+from metrics import DiceAccumulator, precision_recall_f1
+from prediction_cache import PredictionCache
+from norm_stats import NormStats, METHODS
+from instrumentation import span
+
+
+def patient_of(slice_path):
+    '''
+    Patient id of a '<patient>_<slice>.png' slice.
+    '''
+    return os.path.basename(slice_path).split('_')[0]
+
+
+def label_pairs(slice_paths, label_dir):
+    '''
+    Pairs each slice with its '<name>L.png' label in label_dir, dropping slices without one.
+    '''
+    pairs = []
+    for path in slice_paths:
+        label = os.path.join(label_dir, os.path.basename(path)[:-4] + 'L.png')
+        if os.path.exists(label):
+            pairs.append((path, label))
+    return pairs
+
+
+def evaluate(model, pairs, batch_slices=8, n_workers=4, mode='auto', out_json=None, out_csv=None):
+    '''
+    Scores a model on many slices with a single inference sweep. Slices are read ahead by worker threads and predicted
+    batch_slices at a time; each prediction updates one confusion matrix, from which both the pixel classification
+    report (precision, recall, f1-score, support) and the Dice scores are taken.
+    INPUT   (1) SegmentationModel 'model': model to evaluate
+            (2) list 'pairs': (slice filepath, label filepath) pairs
+            (3) int 'batch_slices': slices passed to the model together
+            (4) int 'n_workers': threads reading and normalizing slices
+            (5) str 'mode': inference mode, as for predict_image
+            (6) str 'out_json': if given, the summary is written there as json
+            (7) str 'out_csv': if given, the summary is written there as rows of (scope, name, metric, value)
+    OUTPUT  (1) dict summary: 'slices', 'timing', 'dice', 'classification_report', 'confusion_matrix' and 'patients'
+    '''
+    slice_paths = [p[0] for p in pairs]
+    scores = DiceAccumulator()
+    timing = {}
+    start = time.time()
+    with span('evaluate'):
+        for i, segmentation in iter_segmentations(model, slice_paths, n_workers, 2 * batch_slices, mode, batch_slices, timing):
+            scores.update(segmentation, read_label(pairs[i][1], model.cache), patient=patient_of(slice_paths[i]))
+    timing['seconds'] = time.time() - start
+    timing['slices_per_second'] = len(pairs) / timing['seconds'] if timing['seconds'] else 0.
+
+    report = precision_recall_f1(scores.cm)
+    summary = {'slices': len(pairs),
+               'timing': timing,
+               'dice': scores.scores(),
+               'classification_report': dict(('Class {}'.format(c), dict(zip(['precision', 'recall', 'f1-score', 'support'], row.tolist())))
+                                             for c, row in enumerate(report)),
+               'confusion_matrix': scores.cm.tolist(),
+               'patients': scores.patient_scores()}
+    print('Evaluated {} slices in {:.2f}s ({:.2f} slices/s)'.format(len(pairs), timing['seconds'], timing['slices_per_second']))
+    scores.report()
+
+    if out_json is not None:
+        with open(out_json, 'w') as f:
+            # nan (empty regions) is written as null
+            json.dump(_json_safe(summary), f, indent=2, sort_keys=True)
+    if out_csv is not None:
+        write_csv(summary, out_csv)
+    return summary
+
+
+def _json_safe(obj):
+    if isinstance(obj, dict):
+        return dict((k, _json_safe(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [_json_safe(v) for v in obj]
+    if isinstance(obj, float) and np.isnan(obj):
+        return None
+    return obj
+
+
+def write_csv(summary, path):
+    '''
+    Writes an evaluation summary as flat (scope, name, metric, value) rows, one scope per split or patient.
+    '''
+    with open(path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['scope', 'name', 'metric', 'value'])
+        for name, value in sorted(summary['dice'].items()):
+            writer.writerow(['all', name, 'dice', value])
+        for name, row in sorted(summary['classification_report'].items()):
+            for metric in ['precision', 'recall', 'f1-score', 'support']:
+                writer.writerow(['all', name, metric, row[metric]])
+        for patient, scores in sorted(summary['patients'].items()):
+            for name, value in sorted(scores.items()):
+                writer.writerow([patient, name, 'dice', value])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score a model checkpoint on labelled slices with one inference sweep.')
+    parser.add_argument('slices', help="glob of the slice pngs, e.g. '/vdb1/ImageData/BRATS/n4_PNG/*'")
+    parser.add_argument('--labels', default='/vdb1/ImageData/Labels/', help="directory holding the '<name>L.png' labels")
+    parser.add_argument('--model', default='./models/example', help='model json/hdf5 path without extension')
+    parser.add_argument('--dual', action='store_true', help='load a Two_Models architecture instead of Segmentation_Models')
+    parser.add_argument('--json', default='evaluation.json', help='file to write the json summary to')
+    parser.add_argument('--csv', default=None, help='file to write the csv summary to')
+    parser.add_argument('--batch-slices', type=int, default=8, help='slices passed to the model together')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--mode', default='auto', choices=['auto', 'dense', 'patch'])
+    parser.add_argument('--prediction-cache', default=None, help='directory of the on-disk prediction cache. no caching if omitted')
+    parser.add_argument('--normalization', default='slice_max', choices=METHODS)
+    parser.add_argument('--norm-stats', default=None, help='.npz of precomputed intensity statistics, see norm_stats.py')
+    parser.add_argument('--roi', type=int, default=None, help='only classify pixels within this many pixels of the brain')
+    args = parser.parse_args()
+
+    if args.dual:
+        from Two_Models import SegmentationModel
+    else:
+        from Segmentation_Models import SegmentationModel
+    cache = PredictionCache(args.prediction_cache) if args.prediction_cache else None
+    model = SegmentationModel(loaded_model=True, model_name=args.model, prediction_cache=cache,
+                             norm_stats=NormStats.load(args.norm_stats) if args.norm_stats else None, normalization=args.normalization,
+                             roi=args.roi)
+    pairs = label_pairs(sorted(glob(args.slices)), args.labels)
+    evaluate(model, pairs, args.batch_slices, args.workers, args.mode, args.json, args.csv)
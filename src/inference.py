@@ -0,0 +1,249 @@
+import numpy as np
+from patch_library import extract_patches
+from instrumentation import span, count
+import roi
+
+# layers that can be carried over as they are, provided they keep stride 1 and valid padding
+_CONVOLUTIONAL = ('Conv2D', 'Convolution2D', 'MaxPooling2D', 'AveragePooling2D')
+_ELEMENTWISE = ('BatchNormalization', 'Activation', 'Concatenate')
+
+
+def normalize_slice(stack, dtype=np.float32, scale=None, offset=None):
+    '''
+    Divides each modality of a slice by its max, leaving all-zero modalities as is, or applies precomputed
+    normalization parameters (see norm_stats) as one multiply-add.
+    INPUT   (1) array 'stack': (n_chan, 240, 240) modalities of one slice
+            (2) dtype 'dtype': dtype of the result. the arithmetic is done in float32 either way
+            (3) array 'scale': per-channel scale. if None, each channel is divided by its max
+            (4) array 'offset': per-channel offset added after scaling. defaults to 0
+    OUTPUT  normalized copy of stack
+    '''
+    with span('normalize_slice'):
+        stack = np.array(stack, dtype=np.float32)
+        if scale is None:
+            top = stack.max(axis=(1, 2), keepdims=True)
+            np.divide(stack, top, out=stack, where=top != 0)
+        else:
+            stack *= np.asarray(scale, dtype=np.float32)[:, np.newaxis, np.newaxis]
+            if offset is not None:
+                stack += np.asarray(offset, dtype=np.float32)[:, np.newaxis, np.newaxis]
+        return stack.astype(dtype, copy=False)
+
+
+def _graph(model):
+    '''
+    Lists the layers of a Sequential or functional keras model as (name, class name, config, inbound layer names), in
+    an order where every layer comes after its inputs, together with the names of the input and output layers.
+    '''
+    if model.__class__.__name__ == 'Sequential':
+        nodes, prev = [('twin_input', 'InputLayer', {}, [])], 'twin_input'
+        for layer in model.layers:
+            if layer.__class__.__name__ == 'InputLayer':
+                continue
+            nodes.append((layer.name, layer.__class__.__name__, layer.get_config(), [prev]))
+            prev = layer.name
+        return nodes, ['twin_input'], [prev]
+    config = model.get_config()
+    nodes = []
+    for layer in config['layers']:
+        inbound = [n[0] for n in layer['inbound_nodes'][0]] if layer['inbound_nodes'] else []
+        nodes.append((layer['name'], layer['class_name'], layer['config'], inbound))
+    return nodes, [l[0] for l in config['input_layers']], [l[0] for l in config['output_layers']]
+
+
+def dense_twin(model):
+    '''
+    Builds a fully-convolutional twin of a trained 33x33 patch classifier. Dropout is dropped, Flatten followed by
+    Dense becomes a convolution with a kernel the size of the flattened map, and the final softmax is left out, so run
+    over a whole (n_chan, 240, 240) slice the twin gives the class scores of every 33x33 patch at once as a
+    (5, 208, 208) map, sharing the convolutions of overlapping patches. This is only exact when every convolution and
+    pooling layer has stride 1 and valid padding, which holds for compile_model and for the functional comp_double,
+    and when every input is the same (n_chan, 33, 33) patch, as the whole slice is fed to each of them; anything else,
+    such as a multi-scale model with a smaller centre input, raises ValueError and is left to predict_patches.
+    INPUT   keras model 'model': patch classifier taking one or more (n_chan, 33, 33) inputs
+    OUTPUT  keras Model with the same inputs (any spatial size) and one score map output, weights copied from model
+    '''
+    from keras.layers import Input, deserialize
+    from keras.models import Model
+
+    nodes, input_names, output_names = _graph(model)
+    input_shapes = model.input_shape if isinstance(model.input_shape, list) else [model.input_shape]
+    for name, shape in zip(input_names, input_shapes):
+        if tuple(shape[1:]) != (input_shapes[0][1], 33, 33):
+            raise ValueError('Input {} of shape {} is not the single-scale {} patch'.format(name, tuple(shape[1:]), (input_shapes[0][1], 33, 33)))
+    tensors, alias, flat = {}, {}, {}
+    data_format = None
+    for name, class_name, config, inbound in nodes:
+        inbound = [alias.get(n, n) for n in inbound]
+        config = dict(config)
+        config.pop('batch_input_shape', None)
+        config.pop('input_shape', None)
+        if class_name == 'InputLayer':
+            shape = input_shapes[input_names.index(name)]
+            tensors[name] = Input(shape=(shape[1], None, None), name=name)
+            continue
+        if class_name == 'Dropout':
+            alias[name] = inbound[0]
+            continue
+        if class_name == 'Flatten':
+            # remember the size of the flattened map, the Dense layer after it becomes a convolution of that size
+            shape = model.get_layer(name).input_shape
+            alias[name] = inbound[0]
+            flat[inbound[0]] = tuple(shape[2:]) if data_format == 'channels_first' else tuple(shape[1:3])
+            continue
+        if class_name == 'Activation' and config['activation'] == 'softmax' and inbound[0] in flat:
+            # softmax over the flattened scores; argmax of the scores is the same
+            alias[name] = inbound[0]
+            continue
+        if class_name == 'Dense':
+            if inbound[0] not in flat:
+                raise ValueError('Dense layer {} does not follow a Flatten layer'.format(name))
+            activation = 'linear' if config['activation'] == 'softmax' else config['activation']
+            class_name = 'Conv2D'
+            config = {'name': name, 'filters': config['units'], 'kernel_size': flat[inbound[0]], 'activation': activation,
+                      'use_bias': config.get('use_bias', True), 'data_format': data_format}
+        elif class_name in _CONVOLUTIONAL:
+            if tuple(config['strides']) != (1, 1) or config['padding'] != 'valid':
+                raise ValueError('Layer {} needs stride 1 and valid padding'.format(name))
+            data_format = config.get('data_format', data_format)
+        elif class_name not in _ELEMENTWISE:
+            raise ValueError('No fully-convolutional equivalent for {} layer {}'.format(class_name, name))
+        layer = deserialize({'class_name': class_name, 'config': config})
+        inputs = [tensors[n] for n in inbound]
+        tensors[name] = layer(inputs[0] if len(inputs) == 1 else inputs)
+        if inbound[0] in flat:
+            flat[name] = (1, 1)
+
+    outputs = [tensors[alias.get(n, n)] for n in output_names]
+    dense = Model(inputs=[tensors[n] for n in input_names], outputs=outputs[0])
+    copy_weights(model, dense)
+    return dense
+
+
+def copy_weights(model, dense):
+    '''
+    Copies the weights of a patch classifier into its dense twin, reshaping Dense kernels into convolution kernels.
+    '''
+    # a channels_first Flatten permutes to (h, w, n_chan) before flattening; channels_last ones, and older ones without
+    # a data_format, flatten the map as it is, which for a channels_first map is (n_chan, h, w) order
+    nodes = dict((name, (class_name, config, inbound)) for name, class_name, config, inbound in _graph(model)[0])
+    for layer in dense.layers:
+        shapes = [w.shape for w in layer.get_weights()]
+        if not shapes:
+            continue
+        src = model.get_layer(layer.name).get_weights()
+        if src[0].ndim == 2 and len(shapes[0]) == 4:
+            # convolution kernel is (h, w, n_chan, filters)
+            h, w, n_chan, filters = shapes[0]
+            flatten = nodes[nodes[layer.name][2][0]][1]
+            if layer.get_config()['data_format'] == 'channels_first' and flatten.get('data_format') != 'channels_first':
+                src[0] = src[0].reshape(n_chan, h, w, filters).transpose(1, 2, 0, 3)
+        layer.set_weights([a.reshape(shape) for a, shape in zip(src, shapes)])
+
+
+def softmax(scores, axis=0):
+    e = np.exp(scores - scores.max(axis=axis, keepdims=True))
+    return e / e.sum(axis=axis, keepdims=True)
+
+
+def background(n=None, probabilities=False):
+    '''
+    OUTPUT  (208, 208) classes, or (5, 208, 208) class probabilities, of a slice that is all background (class 0),
+            with a leading n axis if n is given
+    '''
+    lead = () if n is None else (n,)
+    if not probabilities:
+        return np.zeros(lead + (208, 208), dtype=np.int64)
+    out = np.zeros(lead + (5, 208, 208), dtype=np.float32)
+    out[..., 0, :, :] = 1
+    return out
+
+
+def predict_dense(dense, stack, probabilities=False, mask=None):
+    '''
+    Classifies every 33x33 patch of a slice, or of a batch of slices, with one pass of a dense twin.
+    INPUT   (1) keras Model 'dense': twin built by dense_twin
+            (2) array 'stack': normalized (n_chan, 240, 240) modalities of one slice, or (n, n_chan, 240, 240) for n slices
+            (3) bool 'probabilities': if True, returns class probabilities instead of classes
+            (4) array 'mask': (208, 208) mask of the pixels to classify, or (n, 208, 208) for n slices, see roi. the twin
+                then only runs over the bounding box of the masks, cropped from the slices holding any masked pixel;
+                pixels outside the mask are background. pixels inside get the same scores as without a mask
+    OUTPUT  (1) (208, 208) predicted classes, or (5, 208, 208) class probabilities, with a leading n axis for n slices
+    '''
+    x = stack if stack.ndim == 4 else stack[np.newaxis]
+    if not np.issubdtype(x.dtype, np.floating):
+        x = x.astype(np.float32)
+    if mask is None:
+        out = _dense_scores(dense, x, probabilities)
+        count('pixels_classified', len(x) * 208 * 208, mode='dense')
+    else:
+        masks = mask.reshape((-1, 208, 208))
+        out = background(len(x), probabilities)
+        keep = np.flatnonzero(masks.any(axis=(1, 2)))
+        count('slices_skipped', len(x) - len(keep), reason='empty_mask')
+        box = roi.bounding_box(masks[keep]) if len(keep) else None
+        if box is not None:
+            r0, r1, c0, c1 = box
+            # output pixel (i, j) is the patch stack[:, i:i + 33, j:j + 33], so the box grows by a patch less one pixel
+            scores = _dense_scores(dense, x[keep][:, :, r0:r1 + 32, c0:c1 + 32], probabilities)
+            inside = masks[keep][:, r0:r1, c0:c1]
+            if probabilities:
+                inside = inside[:, np.newaxis]
+            region = out[keep][..., r0:r1, c0:c1]
+            out[keep, ..., r0:r1, c0:c1] = np.where(inside, scores, region)
+            count('pixels_classified', len(keep) * (r1 - r0) * (c1 - c0), mode='dense')
+    return out if stack.ndim == 4 else out[0]
+
+
+def _dense_scores(dense, x, probabilities):
+    # dense_twin only accepts models whose inputs all take the same patch, so each is fed the whole slice
+    n_inputs = len(dense.inputs)
+    with span('predict_dense'):
+        scores = dense.predict(x if n_inputs == 1 else [x] * n_inputs)
+    count('slices_predicted', len(x), mode='dense')
+    if probabilities:
+        return softmax(scores, axis=-3)
+    return np.argmax(scores, axis=-3)
+
+
+def predict_patches(model, stack, inputs=None, tile_rows=16, batch_size=1024, probabilities=False, mask=None):
+    '''
+    Classifies every 33x33 patch of a slice, gathering the patches of tile_rows rows of output pixels at a time into
+    one reused buffer of the dtype of stack, so peak memory is set by the tile size rather than by the 43,264 patches
+    of a slice.
+    INPUT   (1) keras model 'model': patch classifier
+            (2) array 'stack': normalized (n_chan, 240, 240) modalities of one slice
+            (3) function 'inputs': maps a batch of patches to the model inputs. defaults to the patches themselves
+            (4) int 'tile_rows': rows of output pixels per tile
+            (5) int 'batch_size': patches per model.predict batch
+            (6) bool 'probabilities': if True, returns class probabilities instead of classes
+            (7) array 'mask': (208, 208) mask of the pixels to classify, see roi. only their patches are gathered, in
+                tiles of tile_rows * 208 patches; the other pixels are background
+    OUTPUT  (1) (208, 208) predicted classes, or (5, 208, 208) class probabilities
+    '''
+    n_chan = stack.shape[0]
+    tile_size = tile_rows * 208
+    buf = np.empty((tile_size, n_chan, 33, 33), dtype=stack.dtype if np.issubdtype(stack.dtype, np.floating) else np.float32)
+    if mask is None:
+        out = np.empty((5, 208, 208), dtype=np.float32) if probabilities else np.empty((208, 208), dtype=np.int64)
+        rows, cols = np.meshgrid(np.arange(208), np.arange(208), indexing='ij')
+        pixels = np.stack([rows.ravel(), cols.ravel()], axis=-1)
+    else:
+        out = background(probabilities=probabilities)
+        pixels = np.argwhere(mask)
+        if len(pixels) == 0:
+            count('slices_skipped', reason='empty_mask')
+            return out
+    for start in range(0, len(pixels), tile_size):
+        pix = pixels[start:start + tile_size]
+        with span('extract_patches'):
+            tile = extract_patches(stack, pix + 16, (33, 33), out=buf[:len(pix)], normalize=False)
+        with span('predict_patches'):
+            scores = model.predict(tile if inputs is None else inputs(tile), batch_size=batch_size)
+        if probabilities:
+            out[:, pix[:, 0], pix[:, 1]] = scores.T
+        else:
+            out[pix[:, 0], pix[:, 1]] = np.argmax(scores, axis=1)
+    count('slices_predicted', mode='patch')
+    count('pixels_classified', len(pixels), mode='patch')
+    return out
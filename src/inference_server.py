@@ -0,0 +1,345 @@
+import numpy as np
+import os
+import json
+import time
+import threading
+import argparse
+from io import BytesIO
+from collections import deque
+from concurrent.futures import Future
+from prediction_cache import PredictionCache
+from norm_stats import NormStats, METHODS
+import model_registry
+import instrumentation
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+# upper bounds (seconds) of the request latency histogram
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+
+
+class ServerMetrics(object):
+    def __init__(self, max_batch):
+        '''
+        Request, batch and latency counters of the inference server, rendered in the Prometheus text format.
+        INPUT   int 'max_batch': largest batch size, for the batch size histogram
+        '''
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.cached = 0
+        self.batches = 0
+        self.batch_slices = 0
+        self.predict_seconds = 0.
+        self.latency_sum = 0.
+        self.latency_counts = np.zeros(len(LATENCY_BUCKETS) + 1, dtype=np.int64)
+        self.batch_sizes = np.zeros(max_batch + 1, dtype=np.int64)
+        self._lock = threading.Lock()
+
+    def request(self, seconds, error=False, cached=False):
+        with self._lock:
+            self.requests += 1
+            self.errors += error
+            self.cached += cached
+            self.latency_sum += seconds
+            self.latency_counts[np.searchsorted(LATENCY_BUCKETS, seconds)] += 1
+
+    def batch(self, size, seconds):
+        with self._lock:
+            self.batches += 1
+            self.batch_slices += size
+            self.batch_sizes[size] += 1
+            self.predict_seconds += seconds
+
+    def render(self, queued=0):
+        '''
+        OUTPUT  str of the counters in the Prometheus text exposition format
+        '''
+        with self._lock:
+            uptime = time.time() - self.started
+            lines = ['# TYPE segmentation_requests_total counter',
+                     'segmentation_requests_total {}'.format(self.requests),
+                     '# TYPE segmentation_request_errors_total counter',
+                     'segmentation_request_errors_total {}'.format(self.errors),
+                     '# TYPE segmentation_cached_requests_total counter',
+                     'segmentation_cached_requests_total {}'.format(self.cached),
+                     '# TYPE segmentation_batches_total counter',
+                     'segmentation_batches_total {}'.format(self.batches),
+                     '# TYPE segmentation_batch_slices_total counter',
+                     'segmentation_batch_slices_total {}'.format(self.batch_slices),
+                     '# TYPE segmentation_predict_seconds_total counter',
+                     'segmentation_predict_seconds_total {:.6f}'.format(self.predict_seconds),
+                     '# TYPE segmentation_queue_depth gauge',
+                     'segmentation_queue_depth {}'.format(queued),
+                     '# TYPE segmentation_throughput_slices_per_second gauge',
+                     'segmentation_throughput_slices_per_second {:.6f}'.format(self.requests / uptime if uptime else 0.),
+                     '# TYPE segmentation_request_seconds histogram']
+            cumulative = np.cumsum(self.latency_counts)
+            for bound, count in zip(LATENCY_BUCKETS, cumulative):
+                lines.append('segmentation_request_seconds_bucket{{le="{}"}} {}'.format(bound, count))
+            lines += ['segmentation_request_seconds_bucket{{le="+Inf"}} {}'.format(cumulative[-1]),
+                      'segmentation_request_seconds_sum {:.6f}'.format(self.latency_sum),
+                      'segmentation_request_seconds_count {}'.format(self.requests),
+                      '# TYPE segmentation_batch_size histogram']
+            cumulative = np.cumsum(self.batch_sizes)
+            for size in range(1, len(self.batch_sizes)):
+                lines.append('segmentation_batch_size_bucket{{le="{}"}} {}'.format(size, cumulative[size]))
+            lines += ['segmentation_batch_size_bucket{{le="+Inf"}} {}'.format(cumulative[-1]),
+                      'segmentation_batch_size_sum {}'.format(self.batch_slices),
+                      'segmentation_batch_size_count {}'.format(self.batches)]
+        return '\n'.join(lines) + '\n'
+
+
+class BatchingPredictor(object):
+    def __init__(self, model, max_batch=8, max_wait=0.01, mode='auto', timeout=60.):
+        '''
+        Collects slices submitted by concurrent requests and predicts them together. A single worker thread owns the
+        model: it waits for a first slice, then keeps collecting until max_batch slices are queued or max_wait seconds
+        have passed, and runs one predict_stack call for the whole batch.
+        INPUT   (1) SegmentationModel 'model': model to predict with
+                (2) int 'max_batch': most slices per predict call
+                (3) float 'max_wait': seconds the first slice of a batch waits for more to arrive
+                (4) str 'mode': inference mode, as for predict_image
+                (5) float 'timeout': seconds a request waits for its prediction before failing
+        '''
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.mode = mode
+        self.timeout = timeout
+        self.metrics = ServerMetrics(max_batch)
+        self._queue = deque()
+        self._ready = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='batching-predictor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, image, path=None):
+        '''
+        INPUT   (1) array 'image': (5, 240, 240) slice, as returned by SegmentationModel.read_image
+                (2) str 'path': filepath of the slice, whose statistics in the model's norm_stats normalize it.
+                    required by the volume-level normalizations, and must be held by norm_stats if the model has one
+        OUTPUT  (1) Future resolving to the (208, 208) predicted classes
+                (2) bool True if the prediction came from the model's prediction cache
+        '''
+        if path is None and self.model.normalization != 'slice_max':
+            raise ValueError('{} normalization needs the slice path, post {{"path": ...}} or ?slice=<name>'.format(
+                self.model.normalization))
+        if self.model.norm_stats is not None and path not in self.model.norm_stats:
+            raise ValueError('No intensity statistics of slice {}'.format(path))
+        future = Future()
+        key = self.model.prediction_key(image, path)
+        cached = self.model.prediction_cache.get(key) if key is not None else None
+        if cached is not None:
+            future.set_result(cached)
+            return future, True
+        stack = self.model.normalize(image, path)
+        with self._ready:
+            self._queue.append((stack, self.model.roi_mask(image), key, future))
+            self._ready.notify()
+        return future, False
+
+    def queued(self):
+        return len(self._queue)
+
+    def _next_batch(self):
+        with self._ready:
+            while not self._queue and not self._stopped:
+                self._ready.wait()
+            deadline = time.time() + self.max_wait
+            while len(self._queue) < self.max_batch and not self._stopped:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._ready.wait(remaining)
+            return [self._queue.popleft() for _ in range(min(self.max_batch, len(self._queue)))]
+
+    def _run(self):
+        while not self._stopped:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            # anything raised while handling the batch fails its remaining requests rather than the worker thread,
+            # whose death would leave every later request waiting on a future nobody resolves
+            try:
+                start = time.time()
+                masks = None if batch[0][1] is None else np.array([mask for _, mask, _, _ in batch])
+                predictions = self.model.predict_stack(np.array([stack for stack, _, _, _ in batch]), self.mode, mask=masks)
+                self.metrics.batch(len(batch), time.time() - start)
+                for (_, _, key, future), prediction in zip(batch, predictions):
+                    prediction = prediction.astype(np.uint8)
+                    if key is not None:
+                        self.model.prediction_cache.put(key, prediction)
+                    future.set_result(prediction)
+            except Exception as e:
+                for _, _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def stop(self):
+        with self._ready:
+            self._stopped = True
+            self._ready.notify_all()
+        self._thread.join()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def resolve_slice(slice_dir, name):
+    '''
+    Filepath of the slice a request names with ?slice=<name>: name resolved within slice_dir. raises ValueError if
+    the server has no slice_dir or if name leads outside it.
+    '''
+    if slice_dir is None:
+        raise ValueError('?slice= needs the server to run with --slice-dir')
+    root = os.path.abspath(slice_dir)
+    path = os.path.abspath(os.path.join(root, name))
+    if not path.startswith(root.rstrip(os.sep) + os.sep):
+        raise ValueError('Slice {} is outside the slice directory'.format(name))
+    return path
+
+
+def make_handler(predictor, slice_dir=None):
+    '''
+    Request handler class serving one BatchingPredictor:
+        POST /segment   body is a (5*240, 240) slice png, or json {"path": filepath of a slice readable by the server}.
+                        a png may name its slice with ?slice=<path relative to slice_dir>, to be normalized with its
+                        statistics in the model's norm_stats; volume-level normalizations need one or the other, and
+                        a model with norm_stats only serves slices it holds.
+                        answers the (208, 208) uint8 classes as .npy bytes, or as json with ?format=json.
+                        400 for a request that cannot be read, 500 if predicting it fails or outlasts the timeout
+        GET /metrics    Prometheus text metrics
+        GET /health     200 once the model is loaded
+    '''
+    class SegmentationHandler(BaseHTTPRequestHandler):
+        def _reply(self, code, body, content_type):
+            body = body.encode() if isinstance(body, str) else body
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _fail(self, start, code, e):
+            predictor.metrics.request(time.time() - start, error=True)
+            self._reply(code, '{}\n'.format(str(e) or type(e).__name__), 'text/plain')
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path == '/metrics':
+                text = predictor.metrics.render(predictor.queued())
+                # stage spans and counters too when the server runs with BRATS_PROFILE set
+                if instrumentation.profiler() is not None:
+                    text += instrumentation.profiler().render()
+                self._reply(200, text, 'text/plain; version=0.0.4')
+            elif path == '/health':
+                self._reply(200, 'ok\n', 'text/plain')
+            else:
+                self._reply(404, 'not found\n', 'text/plain')
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/segment':
+                self._reply(404, 'not found\n', 'text/plain')
+                return
+            start = time.time()
+            cached = False
+            try:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    path = json.loads(body.decode())['path']
+                    image = predictor.model.read_image(path)
+                else:
+                    name = parse_qs(url.query).get('slice', [None])[0]
+                    path = None if name is None else resolve_slice(slice_dir, name)
+                    from skimage import io
+                    image = io.imread(BytesIO(body)).reshape(5, 240, 240)
+            except Exception as e:
+                self._fail(start, 400, e)
+                return
+            try:
+                future, cached = predictor.submit(image, path)
+            except ValueError as e:
+                self._fail(start, 400, e)
+                return
+            except Exception as e:
+                self._fail(start, 500, e)
+                return
+            try:
+                segmentation = future.result(predictor.timeout)
+            except Exception as e:
+                # the request was fine, predicting or caching it failed or timed out
+                self._fail(start, 500, e)
+                return
+            if parse_qs(url.query).get('format', ['npy'])[0] == 'json':
+                self._reply(200, json.dumps(segmentation.tolist()), 'application/json')
+            else:
+                buf = BytesIO()
+                np.save(buf, segmentation)
+                self._reply(200, buf.getvalue(), 'application/octet-stream')
+            predictor.metrics.request(time.time() - start, cached=cached)
+
+        def log_message(self, format, *args):
+            pass
+
+    return SegmentationHandler
+
+
+def serve(model, host='127.0.0.1', port=8500, max_batch=8, max_wait=0.01, mode='auto', timeout=60., slice_dir=None):
+    '''
+    Serves a SegmentationModel over HTTP until interrupted, batching concurrent requests (see BatchingPredictor).
+    INPUT   (1) SegmentationModel 'model': loaded model to serve
+            (2) str, int 'host', 'port': address to listen on
+            (3) int 'max_batch', float 'max_wait', str 'mode', float 'timeout': as for BatchingPredictor
+            (4) str 'slice_dir': directory ?slice= names slices in, see make_handler. ?slice= is refused if None
+    '''
+    predictor = BatchingPredictor(model, max_batch, max_wait, mode, timeout)
+    server = _ThreadingHTTPServer((host, port), make_handler(predictor, slice_dir))
+    print('Serving segmentations on http://{}:{}/segment (max batch {}, max wait {:.0f} ms)'.format(host, port, max_batch, max_wait * 1000))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        predictor.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve slice segmentations over HTTP with dynamic request batching.')
+    parser.add_argument('--model', default='./models/example', help='model json/hdf5 path without extension')
+    parser.add_argument('--dual', action='store_true', help='load a Two_Models architecture instead of Segmentation_Models')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8500)
+    parser.add_argument('--max-batch', type=int, default=8, help='most slices per predict call')
+    parser.add_argument('--max-wait-ms', type=float, default=10., help='ms the first slice of a batch waits for more')
+    parser.add_argument('--mode', default='auto', choices=['auto', 'dense', 'patch'])
+    parser.add_argument('--timeout', type=float, default=60., help='seconds a request waits for its prediction before a 500')
+    parser.add_argument('--prediction-cache', default=None, help='directory of the on-disk prediction cache. no caching if omitted')
+    parser.add_argument('--normalization', default='slice_max', choices=METHODS)
+    parser.add_argument('--slice-dir', default=None, help='directory of the slices uploads may name with ?slice=')
+    parser.add_argument('--norm-stats', default=None, help='.npz of precomputed intensity statistics, see norm_stats.py')
+    parser.add_argument('--roi', type=int, default=None, help='only classify pixels within this many pixels of the brain')
+    args = parser.parse_args()
+
+    if args.dual:
+        from Two_Models import SegmentationModel
+    else:
+        from Segmentation_Models import SegmentationModel
+    # load the model and build its dense twin before accepting requests
+    model_registry.warm([args.model], dense=args.mode != 'patch')
+    cache = PredictionCache(args.prediction_cache) if args.prediction_cache else None
+    model = SegmentationModel(loaded_model=True, model_name=args.model, prediction_cache=cache,
+                             norm_stats=NormStats.load(args.norm_stats) if args.norm_stats else None, normalization=args.normalization,
+                             roi=args.roi)
+    serve(model, args.host, args.port, args.max_batch, args.max_wait_ms / 1000., args.mode, args.timeout, args.slice_dir)
@@ -0,0 +1,267 @@
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import threading
+
+# set BRATS_PROFILE to a file path to instrument a run without editing code: '.prom' files get the Prometheus text
+# format (rewritten at exit), anything else a JSON line per dump (appended). BRATS_PROFILE_MEMORY=1 also traces python
+# allocations per span with tracemalloc, which slows allocation-heavy code down noticeably
+ENV_OUT = 'BRATS_PROFILE'
+ENV_MEMORY = 'BRATS_PROFILE_MEMORY'
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Profiler(object):
+    def __init__(self, out_path=None, memory=False):
+        '''
+        Collects named span timings and labelled counters of one process. Spans nest and may be opened from any
+        thread; tracemalloc has a single process-wide peak, so memory figures of spans running concurrently in
+        several threads overlap.
+        INPUT   (1) str 'out_path': file written by dump. format chosen by extension, see ENV_OUT
+                (2) bool 'memory': if True, records bytes allocated and peak traced memory of every span with tracemalloc
+        '''
+        self.out_path = out_path
+        self.memory = memory
+        self.started = time.time()
+        # name -> [calls, seconds, min seconds, max seconds, bytes allocated, peak bytes]
+        self.spans = {}
+        # (name, sorted label items) -> value
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def record(self, name, seconds, allocated=0, peak=0, calls=1):
+        with self._lock:
+            s = self.spans.get(name)
+            if s is None:
+                self.spans[name] = [calls, seconds, seconds, seconds, allocated, peak]
+            else:
+                s[0] += calls
+                s[1] += seconds
+                s[2] = min(s[2], seconds)
+                s[3] = max(s[3], seconds)
+                s[4] += allocated
+                s[5] = max(s[5], peak)
+
+    def count(self, name, n=1, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def snapshot(self, reset=False):
+        '''
+        OUTPUT  dict of the spans and counters collected so far, that merge accepts. cleared if reset
+        '''
+        with self._lock:
+            snap = {'spans': dict((k, list(v)) for k, v in self.spans.items()),
+                    'counters': [[name, dict(labels), n] for (name, labels), n in self.counters.items()]}
+            if reset:
+                self.spans, self.counters = {}, {}
+        return snap
+
+    def merge(self, snap):
+        '''
+        Adds the spans and counters of a snapshot, e.g. one taken in a worker process.
+        '''
+        for name, (calls, seconds, low, high, allocated, peak) in snap['spans'].items():
+            self.record(name, seconds, allocated, peak, calls)
+            with self._lock:
+                self.spans[name][2] = min(self.spans[name][2], low)
+                self.spans[name][3] = max(self.spans[name][3], high)
+        for name, labels, n in snap['counters']:
+            self.count(name, n, **labels)
+
+    def render(self):
+        '''
+        OUTPUT  str of the spans and counters in the Prometheus text exposition format
+        '''
+        snap = self.snapshot()
+        lines = []
+        for metric, i, kind in (('brats_span_calls_total', 0, 'counter'), ('brats_span_seconds_total', 1, 'counter'),
+                                ('brats_span_min_seconds', 2, 'gauge'), ('brats_span_max_seconds', 3, 'gauge'),
+                                ('brats_span_allocated_bytes_total', 4, 'counter'), ('brats_span_peak_bytes', 5, 'gauge')):
+            if i >= 4 and not self.memory:
+                continue
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            for name in sorted(snap['spans']):
+                lines.append('{}{{span="{}"}} {}'.format(metric, name, _number(snap['spans'][name][i])))
+        by_name = {}
+        for name, labels, n in snap['counters']:
+            by_name.setdefault(name, []).append((labels, n))
+        for name in sorted(by_name):
+            lines.append('# TYPE brats_{}_total counter'.format(name))
+            for labels, n in sorted(by_name[name], key=lambda x: sorted(x[0].items())):
+                text = ','.join('{}="{}"'.format(k, v) for k, v in sorted(labels.items()))
+                lines.append('brats_{}_total{} {}'.format(name, '{' + text + '}' if text else '', _number(n)))
+        lines += ['# TYPE brats_peak_rss_bytes gauge', 'brats_peak_rss_bytes {}'.format(peak_rss_bytes()),
+                  '# TYPE brats_wall_seconds gauge', 'brats_wall_seconds {:.6f}'.format(time.time() - self.started)]
+        return '\n'.join(lines) + '\n'
+
+    def record_json(self):
+        '''
+        OUTPUT  dict of the spans, counters and process details, one structured log record
+        '''
+        snap = self.snapshot()
+        fields = ('calls', 'seconds', 'min_seconds', 'max_seconds', 'allocated_bytes', 'peak_bytes')
+        spans = dict((name, dict(zip(fields, v if self.memory else v[:4]))) for name, v in snap['spans'].items())
+        return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'pid': os.getpid(), 'argv': sys.argv,
+                'wall_seconds': time.time() - self.started, 'peak_rss_bytes': peak_rss_bytes(),
+                'spans': spans, 'counters': [{'name': n, 'labels': l, 'value': v} for n, l, v in snap['counters']]}
+
+    def dump(self, out_path=None):
+        '''
+        Writes the collected spans and counters to out_path, by default self.out_path.
+        '''
+        out_path = out_path or self.out_path
+        if out_path is None:
+            return
+        if out_path.endswith('.prom'):
+            text = self.render()
+            with open(out_path, 'w') as f:
+                f.write(text)
+        else:
+            text = json.dumps(self.record_json(), sort_keys=True) + '\n'
+            with open(out_path, 'a') as f:
+                f.write(text)
+
+
+class _Span(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        p = self.profiler
+        if p.memory:
+            import tracemalloc
+            current, peak = tracemalloc.get_traced_memory()
+            stack = p._stack()
+            # tracemalloc has one peak per process, so keep the enclosing span's peak before resetting it for this one
+            if stack:
+                stack[-1].children_peak = max(stack[-1].children_peak, peak)
+            tracemalloc.reset_peak()
+            self.start_bytes = current
+            self.children_peak = current
+            stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.time() - self.start
+        p = self.profiler
+        allocated = peak = 0
+        if p.memory:
+            import tracemalloc
+            current, traced_peak = tracemalloc.get_traced_memory()
+            stack = p._stack()
+            stack.pop()
+            peak = max(traced_peak, self.children_peak)
+            if stack:
+                stack[-1].children_peak = max(stack[-1].children_peak, peak)
+            allocated, peak = current - self.start_bytes, peak - self.start_bytes
+        p.record(self.name, seconds, allocated, peak)
+        return False
+
+
+def _number(x):
+    return '{:.6f}'.format(x) if isinstance(x, float) else str(x)
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+_profiler = None
+
+
+def enable(out_path=None, memory=False):
+    '''
+    Starts collecting spans and counters in this process, replacing any profiler already running.
+    INPUT   (1) str 'out_path': file to dump to at exit, see ENV_OUT. nothing is written at exit if None
+            (2) bool 'memory': if True, traces allocations per span
+    OUTPUT  (1) the Profiler
+    '''
+    global _profiler
+    _profiler = Profiler(out_path, memory)
+    return _profiler
+
+
+def disable():
+    '''
+    Stops collecting. OUTPUT the Profiler that was running, or None
+    '''
+    global _profiler
+    p, _profiler = _profiler, None
+    return p
+
+
+def profiler():
+    '''
+    OUTPUT  the running Profiler, or None if instrumentation is off
+    '''
+    return _profiler
+
+
+def span(name):
+    '''
+    Context manager timing the enclosed block under name. does nothing unless instrumentation is enabled.
+    '''
+    if _profiler is None:
+        return _NULL_SPAN
+    return _Span(_profiler, name)
+
+
+def count(name, n=1, **labels):
+    '''
+    Adds n to the counter name with the given labels, e.g. count('patches_rejected', 3, reason='edge').
+    does nothing unless instrumentation is enabled.
+    '''
+    if _profiler is not None:
+        _profiler.count(name, n, **labels)
+
+
+def drain():
+    '''
+    OUTPUT  snapshot of the spans and counters collected since the last drain, or None if instrumentation is off.
+            used to send the counts of forked worker processes back to the parent, which merges them
+    '''
+    return _profiler.snapshot(reset=True) if _profiler is not None else None
+
+
+def merge(snap):
+    if _profiler is not None and snap is not None:
+        _profiler.merge(snap)
+
+
+@atexit.register
+def _dump_at_exit():
+    # forked pool workers leave with os._exit and never get here, their counts are merged by the parent
+    if _profiler is not None:
+        _profiler.dump()
+
+
+if os.environ.get(ENV_OUT):
+    enable(os.environ[ENV_OUT], os.environ.get(ENV_MEMORY, '') not in ('', '0'))
@@ -0,0 +1,136 @@
+import numpy as np
+import os
+
+
+def progress_bar():
+    '''
+    New '[****] 40%' progress bar. progressbar is imported on first use, as it pulls in IPython.
+    '''
+    import progressbar
+    return progressbar.ProgressBar(widgets=[progressbar.Bar('*', '[', ']'), progressbar.Percentage(), ' '])
+
+
+class LabelIndex(object):
+    def __init__(self, paths, classes, slices, offsets, coords, brain_only=False, min_pixels=None):
+        '''
+        Maps each label class to the training slices and pixel coordinates where it occurs. Build it once with
+        LabelIndex.build and save it, then sample patch centres straight from it instead of decoding random labels.
+        INPUT   (1) list 'paths': filepaths of the indexed training slices
+                (2) list 'classes': classes held in the index
+                (3) dict 'slices': class -> indices into paths of slices holding enough pixels of that class
+                (4) dict 'offsets': class -> offsets into coords for each entry of slices (len(slices) + 1)
+                (5) dict 'coords': class -> (n, 2) array of pixel coordinates, grouped by slice
+                (6) bool 'brain_only': True if class 0 was only indexed where the slice is nonzero, see build
+                (7) int 'min_pixels': min_pixels the index was built with, None if unknown
+        '''
+        self.paths = list(paths)
+        self.classes = list(classes)
+        self.slices = slices
+        self.offsets = offsets
+        self.coords = coords
+        self.brain_only = brain_only
+        self.min_pixels = min_pixels
+
+    @classmethod
+    def build(cls, train_data, load_label, classes=[0,1,2,3,4], min_pixels=10, load_image=None):
+        '''
+        Decodes every label once and records where each class occurs.
+        INPUT   (1) list 'train_data': filepaths to training slices
+                (2) function 'load_label': maps a training slice filepath to its decoded label
+                (3) list 'classes': classes to index
+                (4) int 'min_pixels': slices with fewer pixels of a class are left out for that class
+                (5) function 'load_image': maps a training slice filepath to its (n_mod, 240, 240) modalities. if given,
+                    class 0 is only indexed where any modality is nonzero, leaving out the empty background around the
+                    brain, which is most of each slice and whose patches find_patches rejects anyway
+        OUTPUT  (1) LabelIndex over train_data
+        '''
+        print('Indexing labels of {} slices...'.format(len(train_data)))
+        slices = dict((c, []) for c in classes)
+        coords = dict((c, []) for c in classes)
+        bar = progress_bar()
+        for s in bar(range(len(train_data))):
+            label = load_label(train_data[s])
+            brain = None if load_image is None else (load_image(train_data[s]) != 0).any(axis=0)
+            for c in classes:
+                where = np.argwhere((label == c) & brain if c == 0 and brain is not None else label == c)
+                if len(where) < min_pixels:
+                    continue
+                slices[c].append(s)
+                coords[c].append(where.astype(np.uint8))
+        offsets = {}
+        for c in classes:
+            offsets[c] = np.cumsum([0] + [len(p) for p in coords[c]]).astype(np.int64)
+            slices[c] = np.array(slices[c], dtype=np.int64)
+            coords[c] = np.concatenate(coords[c]) if len(coords[c]) else np.zeros((0, 2), np.uint8)
+        print('Done.')
+        return cls(train_data, classes, slices, offsets, coords, load_image is not None, min_pixels)
+
+    @classmethod
+    def load(cls, index_path):
+        '''
+        INPUT   (1) str 'index_path': filepath of an index written by save
+        OUTPUT  (1) LabelIndex
+        '''
+        data = np.load(index_path)
+        classes = [int(c) for c in data['classes']]
+        slices = dict((c, data['slices_{}'.format(c)]) for c in classes)
+        offsets = dict((c, data['offsets_{}'.format(c)]) for c in classes)
+        coords = dict((c, data['coords_{}'.format(c)]) for c in classes)
+        brain_only = bool(data['brain_only']) if 'brain_only' in data else False
+        min_pixels = int(data['min_pixels']) if 'min_pixels' in data else None
+        return cls([str(p) for p in data['paths']], classes, slices, offsets, coords, brain_only, min_pixels)
+
+    def save(self, index_path):
+        '''
+        INPUT   (1) str 'index_path': filepath to save the index to (.npz)
+        '''
+        arrays = {'paths': np.array(self.paths), 'classes': np.array(self.classes), 'brain_only': np.array(self.brain_only)}
+        if self.min_pixels is not None:
+            arrays['min_pixels'] = np.array(self.min_pixels)
+        for c in self.classes:
+            arrays['slices_{}'.format(c)] = self.slices[c]
+            arrays['offsets_{}'.format(c)] = self.offsets[c]
+            arrays['coords_{}'.format(c)] = self.coords[c]
+        np.savez(index_path, **arrays)
+
+    def covers(self, train_data):
+        '''
+        True if the index was built over exactly the slices in train_data (in any order).
+        '''
+        return set(self.paths) == set(train_data)
+
+    def sample(self, class_num, n=1, rng=np.random):
+        '''
+        Draws slices uniformly from those holding class_num, then a pixel of class_num uniformly within each slice.
+        INPUT   (1) int 'class_num': class to sample
+                (2) int 'n': number of draws
+                (3) RandomState 'rng': source of randomness. defaults to the global numpy state
+        OUTPUT  (1) array of indices into paths (n,)
+                (2) array of pixel coordinates (n, 2)
+        '''
+        class_num = int(class_num)
+        slices, offsets = self.slices[class_num], self.offsets[class_num]
+        if len(slices) == 0:
+            raise ValueError('No slice in the index holds class {}'.format(class_num))
+        s = rng.randint(0, len(slices), n)
+        start, count = offsets[s], offsets[s + 1] - offsets[s]
+        p = start + (rng.random_sample(n) * count).astype(np.int64)
+        return slices[s], self.coords[class_num][p].astype(np.int64)
+
+
+def load_or_build(index_path, train_data, load_label, classes=[0,1,2,3,4], min_pixels=10, load_image=None):
+    '''
+    Loads the index at index_path, rebuilding and saving it if missing, if it no longer matches train_data, if it was
+    built with another min_pixels, or if load_image is given and the saved index holds class 0 at every background
+    pixel.
+    '''
+    if index_path is not None and os.path.exists(index_path):
+        index = LabelIndex.load(index_path)
+        if (index.covers(train_data) and set(classes) <= set(index.classes) and index.min_pixels == min_pixels
+                and (load_image is None or index.brain_only)):
+            return index
+        print('Label index {} is out of date, rebuilding.'.format(index_path))
+    index = LabelIndex.build(train_data, load_label, classes, min_pixels, load_image)
+    if index_path is not None:
+        index.save(index_path)
+    return index
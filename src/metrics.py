@@ -0,0 +1,120 @@
+import numpy as np
+from instrumentation import span
+
+# BRATS evaluation regions, as the label classes each one covers
+REGIONS = [('Whole Tumor', (1, 2, 3, 4)),
+           ('Core Tumor', (1, 3, 4)),
+           ('Enhancing Tumor', (4,))]
+
+
+def pad_to_label(segmentation, shape):
+    '''
+    Pads (..., 208, 208) predictions at the edges to the (..., 240, 240) shape of the labels, as the segmentation
+    overlays do. Returns segmentation unchanged if it already has that shape.
+    '''
+    segmentation = np.asarray(segmentation)
+    if segmentation.shape == tuple(shape):
+        return segmentation
+    pad = [(0, 0)] * (segmentation.ndim - 2) + [((shape[-2] - segmentation.shape[-2]) // 2,) * 2,
+                                                 ((shape[-1] - segmentation.shape[-1]) // 2,) * 2]
+    return np.pad(segmentation, pad, mode='edge')
+
+
+def confusion_matrix(segmentation, label, n_classes=5):
+    '''
+    Counts every (true class, predicted class) pair in one bincount pass.
+    INPUT   (1) array 'segmentation': predicted classes of a slice or volume, (208, 208) predictions are edge-padded
+            (2) array 'label': ground truth classes of the same slice or volume
+            (3) int 'n_classes': number of classes
+    OUTPUT  (1) (n_classes, n_classes) counts, rows are true classes and columns predicted classes
+    '''
+    label = np.asarray(label)
+    segmentation = pad_to_label(segmentation, label.shape)
+    pairs = label.astype(np.int64).ravel() * n_classes + segmentation.astype(np.int64).ravel()
+    return np.bincount(pairs, minlength=n_classes * n_classes).reshape(n_classes, n_classes)
+
+
+def dice(cm, classes):
+    '''
+    Dice coefficient of the region made of the given classes, from a confusion matrix. nan if the region is empty in
+    both the ground truth and the prediction.
+    '''
+    classes = list(classes)
+    both = cm[np.ix_(classes, classes)].sum()
+    total = cm[classes, :].sum() + cm[:, classes].sum()
+    return 2. * both / total if total else float('nan')
+
+
+def precision_recall_f1(cm):
+    '''
+    OUTPUT  (n_classes, 4) array of precision, recall, f1-score and support of each class, from a confusion matrix
+    '''
+    tp = np.diag(cm).astype(float)
+    predicted, support = cm.sum(axis=0), cm.sum(axis=1)
+    precision = np.divide(tp, predicted, out=np.zeros_like(tp), where=predicted != 0)
+    recall = np.divide(tp, support, out=np.zeros_like(tp), where=support != 0)
+    f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros_like(tp), where=precision + recall != 0)
+    return np.stack([precision, recall, f1, support], axis=1)
+
+
+class DiceAccumulator(object):
+    def __init__(self, n_classes=5):
+        '''
+        Accumulates confusion matrices over slices, volumes and patients, so Dice scores of a whole test split are a
+        streaming reduction that never holds more than one prediction at a time.
+        INPUT   int 'n_classes': number of classes
+        '''
+        self.n_classes = n_classes
+        self.cm = np.zeros((n_classes, n_classes), dtype=np.int64)
+        self.patients = {}
+
+    def update(self, segmentation, label, patient=None):
+        '''
+        INPUT   (1) array 'segmentation': predicted classes of a slice or volume
+                (2) array 'label': ground truth classes of the same slice or volume
+                (3) str 'patient': if given, the counts are also kept for that patient
+        OUTPUT  (1) confusion matrix of this update
+        '''
+        with span('dice'):
+            cm = confusion_matrix(segmentation, label, self.n_classes)
+        self.cm += cm
+        if patient is not None:
+            self.patients[patient] = self.patients.get(patient, 0) + cm
+        return cm
+
+    def merge(self, other):
+        '''
+        Adds the counts of another accumulator, e.g. one filled by another worker.
+        '''
+        self.cm += other.cm
+        for patient, cm in other.patients.items():
+            self.patients[patient] = self.patients.get(patient, 0) + cm
+        return self
+
+    def scores(self, cm=None):
+        '''
+        INPUT   array 'cm': confusion matrix to score. defaults to everything accumulated so far
+        OUTPUT  dict of pixel accuracy, Dice of each BRATS region and Dice of each class
+        '''
+        cm = self.cm if cm is None else cm
+        scores = {'Total Slice': np.trace(cm) / float(cm.sum()) if cm.sum() else float('nan')}
+        for name, classes in REGIONS:
+            scores[name] = dice(cm, classes)
+        for c in range(self.n_classes):
+            scores['Class {}'.format(c)] = dice(cm, [c])
+        return scores
+
+    def patient_scores(self):
+        '''
+        OUTPUT  dict of patient -> scores of that patient
+        '''
+        return dict((patient, self.scores(cm)) for patient, cm in self.patients.items())
+
+    def report(self, cm=None):
+        '''
+        Prints the scores as a table of Dice coefficients.
+        '''
+        print(' ')
+        print('Region_______________________| Dice Coefficient')
+        for name, score in sorted(self.scores(cm).items(), key=lambda kv: kv[0].startswith('Class')):
+            print('{0:_<29}| {1:.2f}'.format(name, score))
@@ -0,0 +1,338 @@
+import numpy as np
+import os
+import time
+from patch_library import MultiScalePatches, extract_patches
+from slice_cache import read_slice, read_label
+from patch_stream import PatchStream, ArrayBatches, as_keras_sequence
+from inference import normalize_slice, predict_dense, predict_patches
+from segment_volume import segment_volume
+from rendering import overlay, render_volume, load_backgrounds
+from metrics import DiceAccumulator
+from evaluation import evaluate
+from prediction_cache import model_weights_key, slice_key
+import model_registry
+from norm_stats import normalization_params, stats_digest
+from roi import brain_mask, output_mask
+from instrumentation import span
+
+
+class SegmentationModelBase(object):
+    '''
+    Loading, fitting, inference, rendering and scoring shared by the SegmentationModel of Segmentation_Models and of
+    Two_Models. Subclasses set model_comp, the attributes their __init__ documents, and checkpoint_path, and compile
+    their own architectures.
+    '''
+    # weights file ModelCheckpoint saves the best model of fit_model and fit_stream to
+    checkpoint_path = './models/example.hdf5'
+
+    def load_model_weights(self, model_name):
+        '''
+        INPUT  (1) string 'model_name': filepath to model and weights, not including extension
+        OUTPUT: Model with loaded weights. can fit on model using loaded_model=True in fit_model method
+                The model comes from the process-level model_registry, so it is parsed and loaded once and shared by
+                every SegmentationModel loading the same files; fitting first gives this instance a private copy.
+        '''
+        model_comp, self.weights_key = model_registry.get_model(model_name)
+        # the registry holds the twin built with these weights
+        self.dense = None
+        return model_comp
+
+    def _own_model(self):
+        '''
+        Replaces a model shared through the registry with a private copy before its weights are changed.
+        '''
+        if model_registry.is_shared(self.model_comp):
+            self.model_comp = model_registry.private_copy(self.model_comp)
+            self.dense = None
+        self.weights_key = None
+
+    def _weights_changed(self):
+        '''
+        Brings the dense twin, if one was built, up to date after fitting changed the weights of model_comp.
+        '''
+        if self.dense:
+            model_registry.refresh_dense(self.model_comp, self.dense)
+
+    def fit_model(self, X_train, y_train, X5_train = None, save=True):
+        '''
+        INPUT   (1) numpy array 'X_train': list of patches to train on in form (n_sample, n_channel, h, w)
+                (2) numpy vector 'y_train': list of labels corresponding to X_train patches in form (n_sample,)
+                (3) numpy array 'X5_train': center 5x5 patch in corresponding X_train patch. if None, the centre crops a
+                    multi-scale architecture takes are cut from each batch of X_train as views (see batch_inputs)
+        OUTPUT  (1) Fits specified model
+        '''
+        from keras.callbacks import EarlyStopping, ModelCheckpoint
+        started = time.time()
+        self._own_model()
+
+        # shuffle and split off the last 10% for validation through one index permutation, without copying the patches
+        order = np.random.permutation(len(X_train))
+        n_val = int(len(order) * 0.1)
+        if X5_train is None:
+            arrays, inputs = [X_train], self.batch_inputs
+        else:
+            arrays, inputs = [X5_train, X_train], None
+        train = ArrayBatches(arrays, y_train, order[:len(order) - n_val], self.batch_size, inputs=inputs, started=started)
+        val = ArrayBatches(arrays, y_train, order[len(order) - n_val:], self.batch_size, inputs=inputs, shuffle=False)
+        es = EarlyStopping(monitor='val_loss', patience=2, verbose=1, mode='auto')
+
+        # Save model after each epoch to check/bm_epoch#-val_loss
+        checkpointer = ModelCheckpoint(filepath=self.checkpoint_path, monitor='val_acc', save_best_only=True, mode='max',verbose=1)
+
+        if self.architecture == 'two_path':
+            data = {'input': X_train[order], 'output': np.eye(5, dtype=np.float32)[y_train[order].astype(np.int64)]}
+            self.model_comp.fit(data, batch_size=self.batch_size, nb_epoch=self.n_epoch, validation_split=0.1, show_accuracy=True, verbose=1, callbacks=[checkpointer])
+        else:
+            self.model_comp.fit_generator(as_keras_sequence(train), steps_per_epoch=len(train), epochs=self.n_epoch, validation_data=as_keras_sequence(val), validation_steps=len(val),
+                                          verbose=1, callbacks=[checkpointer])
+        self._weights_changed()
+
+    def batch_inputs(self, X):
+        '''
+        Maps a batch of (n_sample, n_channel, 33, 33) patches to the inputs the compiled architecture takes. Smaller
+        inputs, such as the centre 5x5 of the dual model, are views of the batch rather than copies.
+        '''
+        if self.scales is None:
+            self.scales = MultiScalePatches.for_model(self.model_comp)
+        return self.scales(X)
+
+    def fit_stream(self, stream, validation_data=None, workers=4, max_queue_size=10, use_multiprocessing=False):
+        '''
+        Fits the model on batches sampled on demand, so the training set never has to fit in memory.
+        INPUT   (1) PatchStream 'stream': training batches
+                (2) PatchStream or tuple 'validation_data': validation batches, or (X_val, y_val) arrays. defaults to None
+                (3) int 'workers': threads (or processes) preparing batches in the background
+                (4) int 'max_queue_size': number of batches prepared ahead of training
+                (5) bool 'use_multiprocessing': if True, prepares batches in processes instead of threads
+        OUTPUT  (1) Fits specified model
+        '''
+        from keras.callbacks import ModelCheckpoint
+        stream.inputs = self.batch_inputs
+        self._own_model()
+        validation_steps = None
+        if isinstance(validation_data, PatchStream):
+            validation_data.inputs = self.batch_inputs
+            validation_steps = len(validation_data)
+            validation_data = as_keras_sequence(validation_data)
+        elif validation_data is not None:
+            validation_data = (self.batch_inputs(validation_data[0]), np.eye(5, dtype=np.float32)[np.asarray(validation_data[1]).astype(np.int64)])
+
+        checkpointer = ModelCheckpoint(filepath=self.checkpoint_path, monitor='val_acc', save_best_only=True, mode='max',verbose=1)
+        self.model_comp.fit_generator(as_keras_sequence(stream), steps_per_epoch=len(stream), epochs=self.n_epoch, validation_data=validation_data, validation_steps=validation_steps,
+                                      max_queue_size=max_queue_size, workers=workers, use_multiprocessing=use_multiprocessing, verbose=1, callbacks=[checkpointer])
+        self._weights_changed()
+
+    def class_report(self, X_test, y_test):
+        '''
+        returns skilearns test report (precision, recall, f1-score)
+        INPUT   (1) list 'X_test': test data of 4x33x33 patches
+                (2) list 'y_test': labels for X_test
+        OUTPUT  (1) confusion matrix of precision, recall and f1 score
+        '''
+        from sklearn.metrics import classification_report
+        y_pred = np.argmax(self.model_comp.predict(self.batch_inputs(X_test)), axis=1)
+        print(classification_report(y_test, y_pred))
+
+    def read_image(self, test_img):
+        '''
+        INPUT   str 'test_img': filepath to a slice
+        OUTPUT  read-only array of shape (5, 240, 240), from the store if it holds test_img, otherwise decoded through the cache
+        '''
+        if self.store is not None and test_img in self.store:
+            return self.store.image(test_img)
+        return read_slice(test_img, self.cache)
+
+    def normalize(self, image, test_img=None):
+        '''
+        INPUT   (1) array 'image': (5, 240, 240) slice as returned by read_image
+                (2) str 'test_img': filepath of the slice, to look up its statistics in self.norm_stats
+        OUTPUT  (1) (n_chan, 240, 240) normalized modalities in self.channels, of self.dtype
+        '''
+        scale, offset = normalization_params(self.norm_stats, test_img, image, self.channels, self.normalization)
+        return normalize_slice(image[list(self.channels)], self.dtype, scale, offset)
+
+    def dense_model(self):
+        '''
+        Returns the fully-convolutional twin of model_comp used for dense inference, or None if the architecture has no
+        exact fully-convolutional equivalent. the twin gets the weights of model_comp when it is built, and again after
+        fit_model or fit_stream change them.
+        '''
+        if self.dense is None:
+            try:
+                self.dense = model_registry.get_dense(self.model_comp)
+            except ValueError as e:
+                print('No dense inference for this model: {}'.format(e))
+                self.dense = False
+        return self.dense or None
+
+    def predict_image(self, test_img, show=False, mode='auto', tile_rows=16, batch_size=1024):
+        '''
+        predicts classes of input image
+        INPUT   (1) str 'test_image': filepath to image to predict on
+                (2) bool 'show': True to show the results of prediction, False to return prediction
+                (3) str 'mode': 'dense' runs the fully-convolutional twin of the model once over the whole slice, 'patch'
+                    classifies every 33x33 patch separately. 'auto' uses dense if the architecture allows it. defaults to auto
+                (4) int 'tile_rows': in patch mode, rows of output pixels whose patches are held in memory at once
+                (5) int 'batch_size': in patch mode, patches per model.predict batch
+        OUTPUT  (1) if show == False: uint8 array of predicted pixel classes for the center 208 x 208 pixels
+                (2) if show == True: displays segmentation results
+        '''
+        with span('predict_image'):
+            image = self.read_image(test_img)
+            key = self.prediction_key(image, test_img)
+            fp1 = self.prediction_cache.get(key) if key is not None else None
+            if fp1 is None:
+                # uint8, as the cache stores it, so hits and misses return the same dtype
+                fp1 = self.predict_stack(self.normalize(image, test_img), mode, tile_rows, batch_size, self.roi_mask(image)).astype(np.uint8)
+                if key is not None:
+                    self.prediction_cache.put(key, fp1)
+        if show:
+            import matplotlib.pyplot as plt
+            from skimage import io
+            io.imshow(fp1)
+            plt.show()
+        else:
+            return fp1
+
+    def prediction_key(self, image, test_img=None):
+        '''
+        INPUT   (1) array 'image': (5, 240, 240) slice as returned by read_image
+                (2) str 'test_img': filepath of the slice, whose statistics in self.norm_stats normalize it
+        OUTPUT  (1) key of the predicted classes of image in self.prediction_cache, or None without a prediction cache
+        '''
+        if self.prediction_cache is None:
+            return None
+        if self.weights_key is None:
+            self.weights_key = model_weights_key(self.model_comp)
+        # predictions also depend on how the slice is normalized and on which pixels are classified
+        stats = stats_digest(self.norm_stats, test_img, self.normalization)
+        return slice_key(self.weights_key, image, self.channels, 'classes|{}|{}|{}|roi={}'.format(self.normalization, stats, self.dtype, self.roi))
+
+    def roi_mask(self, image):
+        '''
+        INPUT   array 'image': (5, 240, 240) slice as returned by read_image
+        OUTPUT  (208, 208) mask of the pixels to classify, or None if self.roi is None
+        '''
+        if self.roi is None:
+            return None
+        return output_mask(brain_mask(image[list(self.channels)], self.roi))
+
+    def predict_stack(self, stack, mode='auto', tile_rows=16, batch_size=1024, mask=None, probabilities=False):
+        '''
+        predicts classes of a slice, or a batch of slices, that is already loaded and normalized
+        INPUT   (1) array 'stack': normalized (n_chan, 240, 240) modalities of the slice, in the order of self.channels,
+                    or (n, n_chan, 240, 240) for n slices
+                (2) str, int, int 'mode', 'tile_rows', 'batch_size': as for predict_image
+                (3) array 'mask': (208, 208) mask of the pixels to classify, or (n, 208, 208) for n slices, e.g. from
+                    roi_mask. every pixel is classified if None
+                (4) bool 'probabilities': if True, returns (5, 208, 208) class probabilities instead of classes
+        OUTPUT  (1) array of predicted pixel classes for the center 208 x 208 pixels, with a leading n axis for n slices
+        '''
+        if mode == 'auto':
+            mode = 'dense' if self.dense_model() is not None else 'patch'
+        if mode == 'dense':
+            return predict_dense(self.dense_model(), stack, probabilities, mask)
+        # predict classes of each pixel based on models, a few rows of patches at a time
+        if stack.ndim == 4:
+            masks = [None] * len(stack) if mask is None else mask
+            return np.array([predict_patches(self.model_comp, s, self.batch_inputs, tile_rows, batch_size, probabilities, m) for s, m in zip(stack, masks)])
+        return predict_patches(self.model_comp, stack, self.batch_inputs, tile_rows, batch_size, probabilities, mask)
+
+    def segment_volume(self, slice_paths, n_workers=4, prefetch=8, mode='auto', batch_slices=1):
+        '''
+        Segments the ordered slices of one patient, reading and normalizing upcoming slices in worker threads while
+        the model predicts.
+        INPUT   (1) list 'slice_paths': filepaths to the slices of one patient, in order
+                (2) int 'n_workers': threads reading and normalizing slices
+                (3) int 'prefetch': slices prepared ahead of the model at most
+                (4) str 'mode': inference mode, as for predict_image
+                (5) int 'batch_slices': slices passed to the model together
+        OUTPUT  (1) (n_slices, 208, 208) array of predicted classes
+                (2) dict of throughput statistics
+        '''
+        return segment_volume(self, slice_paths, n_workers, prefetch, mode, batch_slices)
+
+    def evaluate(self, pairs, batch_slices=8, n_workers=4, mode='auto', out_json=None, out_csv=None):
+        '''
+        Scores the model on many labelled slices with one inference sweep, see evaluation.evaluate.
+        INPUT   (1) list 'pairs': (slice filepath, label filepath) pairs
+                (2) int 'batch_slices', 'n_workers', str 'mode': as for segment_volume
+                (3) str 'out_json', 'out_csv': if given, files to write the summary to
+        OUTPUT  (1) dict of Dice scores, classification report and confusion matrix, overall and per patient
+        '''
+        return evaluate(self, pairs, batch_slices, n_workers, mode, out_json, out_csv)
+
+    def verify_dense(self, test_img, n_pixels=256):
+        '''
+        Compares dense inference against the patch classifier on randomly chosen pixels of a slice
+        INPUT   (1) str 'test_img': filepath to image to compare on
+                (2) int 'n_pixels': number of pixels to compare
+        OUTPUT  (1) largest absolute difference between the class probabilities of the two paths
+        '''
+        stack = self.normalize(self.read_image(test_img), test_img).astype(np.float32)
+        dense = predict_dense(self.dense_model(), stack, probabilities=True)
+        pix = np.random.randint(0, 208, (n_pixels, 2))
+        patches = extract_patches(stack, pix + 16, (33,33), normalize=False)
+        patch = self.model_comp.predict(self.batch_inputs(patches))
+        return np.abs(dense[:, pix[:, 0], pix[:, 1]].T - patch).max()
+
+    def show_segmented_image(self, test_img, modality='t1c', show = False, segmentation=None):
+        '''
+        Creates an image of original brain with segmentation overlay
+        INPUT   (1) str 'test_img': filepath to test image for segmentation, including file extension
+                (2) str 'modality': imaging modelity to use as background. defaults to t1c. options: (flair, t1, t1c, t2)
+                (3) bool 'show': If true, shows output image. defaults to False.
+                (4) array 'segmentation': predicted classes of test_img, e.g. from segment_volume. predicted if None
+        OUTPUT  (1) if show is True, shows image of segmentation results
+                (2) if show is false, returns segmented image.
+        '''
+        if segmentation is None:
+            segmentation = self.predict_image(test_img)
+
+        # background, gamma adjustment and class colours in one vectorized pass
+        sliced_image = overlay(load_backgrounds([test_img], self.read_image)[0], segmentation)
+
+        if show:
+            import matplotlib.pyplot as plt
+            from skimage import io
+            io.imshow(sliced_image)
+            plt.show()
+
+        else:
+            return sliced_image
+
+    def render_volume(self, slice_paths, volume=None, out_dir=None):
+        '''
+        Creates segmentation overlays for every slice of a volume at once
+        INPUT   (1) list 'slice_paths': filepaths to the slices, in order
+                (2) array 'volume': (n_slices, 208, 208) predicted classes, e.g. from segment_volume. predicted if None
+                (3) str 'out_dir': if given, overlays are written there as '<slice name>_seg.png' instead of being returned
+        OUTPUT  (1) (n_slices, 240, 240, 3) overlays if out_dir is None
+        '''
+        if volume is None:
+            volume = self.segment_volume(slice_paths)[0]
+        out_paths = None
+        if out_dir is not None:
+            out_paths = [os.path.join(out_dir, os.path.basename(p)[:-4] + '_seg.png') for p in slice_paths]
+        return render_volume(load_backgrounds(slice_paths, self.read_image), volume, out_paths)
+
+    def get_dice_coef(self, test_img, label, segmentation=None):
+        '''
+        Calculate dice coefficient for total slice, whole tumor, core tumor, advancing tumor and each class
+        INPUT   (1) str 'test_img': filepath to slice to predict on
+                (2) str 'label': filepath to ground truth label for test_img
+                (3) array 'segmentation': predicted classes of test_img, e.g. from segment_volume. predicted if None
+        OUTPUT: Summary of dice scores for the following classes:
+                    - all classes (pixel accuracy)
+                    - whole tumor (1, 2, 3 and 4)
+                    - core tumor (1, 3 and 4)
+                    - advancing tumor (4)
+                    - each class
+                and a dict of the same scores
+        '''
+        if segmentation is None:
+            segmentation = self.predict_image(test_img)
+        scores = DiceAccumulator()
+        scores.update(segmentation, read_label(label, self.cache))
+        scores.report()
+        return scores.scores()
@@ -0,0 +1,121 @@
+import numpy as np
+import os
+import threading
+from prediction_cache import model_file_key
+
+# absolute model name -> entry dict: mtimes of the json and hdf5 files, the loaded model, its key and its dense twin
+_models = {}
+_lock = threading.Lock()
+
+
+def _mtimes(model_name):
+    return (os.path.getmtime(model_name + '.json'), os.path.getmtime(model_name + '.hdf5'))
+
+
+def _load(model_name):
+    from keras.models import model_from_json
+
+    print('Loading model {}'.format(model_name))
+    with open(model_name + '.json') as f:
+        model = model_from_json(f.read())
+    model.load_weights(model_name + '.hdf5')
+    print('Done.')
+    return model
+
+
+def get_model(model_name):
+    '''
+    Process-level registry of loaded models: each saved model is parsed and its weights loaded once, and every caller
+    asking for it shares the same keras model. The json and hdf5 mtimes are checked on each call and the model is
+    reloaded if either file changed; callers holding the old model keep it.
+    INPUT   str 'model_name': filepath to model and weights, not including extension
+    OUTPUT  (1) shared keras model with loaded weights. do not train it in place, see private_copy
+            (2) str key of the json and hdf5 contents, see prediction_cache.model_file_key
+    '''
+    path = os.path.abspath(model_name)
+    mtimes = _mtimes(path)
+    with _lock:
+        entry = _models.get(path)
+        if entry is None or entry['mtimes'] != mtimes:
+            entry = {'mtimes': mtimes, 'model': _load(model_name), 'key': model_file_key(model_name), 'dense': None}
+            _models[path] = entry
+        return entry['model'], entry['key']
+
+
+def get_dense(model):
+    '''
+    Dense twin of a registry model, built once and shared like the model itself. Models that are not in the
+    registry get a twin of their own.
+    OUTPUT  keras Model from inference.dense_twin. raises ValueError if model has no exact dense twin
+    '''
+    from inference import dense_twin
+
+    with _lock:
+        entry = next((e for e in _models.values() if e['model'] is model), None)
+        if entry is None:
+            return dense_twin(model)
+        if entry['dense'] is None:
+            try:
+                entry['dense'] = dense_twin(model)
+            except ValueError as e:
+                entry['dense'] = e
+        if isinstance(entry['dense'], ValueError):
+            raise entry['dense']
+        return entry['dense']
+
+
+def refresh_dense(model, dense):
+    '''
+    Copies the current weights of model into its dense twin, e.g. after training changed them. the copy is made under
+    the registry lock, like the twins built by get_dense.
+    '''
+    from inference import copy_weights
+
+    with _lock:
+        copy_weights(model, dense)
+
+
+def is_shared(model):
+    '''
+    True if model is held by the registry, and so possibly used by other SegmentationModels.
+    '''
+    with _lock:
+        return any(e['model'] is model for e in _models.values())
+
+
+def private_copy(model):
+    '''
+    Copy of a model with its own weights, e.g. to fine-tune a registry model without changing it for other users.
+    '''
+    from keras.models import model_from_json
+
+    copy = model_from_json(model.to_json())
+    copy.set_weights(model.get_weights())
+    return copy
+
+
+def warm(model_names, dense=True):
+    '''
+    Loads models (and builds their dense twins) and runs one prediction on zeros ahead of the first request, e.g. at
+    server or worker startup, so the first real prediction does not pay for the graph build and weight load.
+    INPUT   (1) list 'model_names': filepaths to models and weights, not including extension
+            (2) bool 'dense': if True, also builds the dense twin of each model
+    '''
+    for model_name in model_names:
+        model, _ = get_model(model_name)
+        shapes = model.input_shape if isinstance(model.input_shape, list) else [model.input_shape]
+        x = [np.zeros((1,) + tuple(shape[1:]), dtype=np.float32) for shape in shapes]
+        model.predict(x[0] if len(x) == 1 else x)
+        if dense:
+            try:
+                twin = get_dense(model)
+            except ValueError as e:
+                print('No dense inference for {}: {}'.format(model_name, e))
+                continue
+            x = np.zeros((1, shapes[0][1], 240, 240), dtype=np.float32)
+            twin.predict(x if len(twin.inputs) == 1 else [x] * len(twin.inputs))
+
+
+def clear():
+    with _lock:
+        _models.clear()
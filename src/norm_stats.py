@@ -0,0 +1,238 @@
+import numpy as np
+import os
+import hashlib
+import argparse
+from glob import glob
+from label_index import progress_bar
+from slice_store import slice_key
+
+# statistics kept for each modality, over its nonzero (brain) voxels except max
+FIELDS = ('max', 'p1', 'p99', 'mean', 'std')
+# 'slice_max' divides by the max of the slice (what predict_image always did), 'volume_max' and 'volume_p99' by the
+# max or 99th percentile of the patient volume, 'zscore' subtracts the volume mean and divides by its std
+METHODS = ('slice_max', 'volume_max', 'volume_p99', 'zscore')
+
+
+def volume_of(path):
+    '''
+    Patient volume of a '<patient>_<slice>.png' slice: the patient name within the slice's directory, so patients of
+    the same number in different directories are kept apart.
+    '''
+    key = slice_key(path)
+    return os.path.join(os.path.dirname(key), os.path.basename(key).split('_')[0])
+
+
+def image_stats(image):
+    '''
+    INPUT   array 'image': (n_mod, 240, 240) modalities of one slice
+    OUTPUT  (n_mod, len(FIELDS)) float64 statistics of each modality
+    '''
+    stats = np.zeros((len(image), len(FIELDS)))
+    for m, channel in enumerate(image):
+        stats[m, 0] = channel.max()
+        brain = channel[channel != 0].astype(np.float64)
+        if len(brain):
+            stats[m, 1:3] = np.percentile(brain, [1, 99])
+            stats[m, 3:] = brain.mean(), brain.std()
+    return stats
+
+
+def norm_params(stats, channels, method):
+    '''
+    Turns statistics into a per-channel multiply-add, normalized = image * scale + offset.
+    INPUT   (1) array 'stats': (n_mod, len(FIELDS)) statistics of a slice or volume
+            (2) tuple 'channels': modalities being normalized
+            (3) str 'method': one of METHODS
+    OUTPUT  (1) float32 scale of each channel
+            (2) float32 offset of each channel
+    '''
+    stats = stats[list(channels)]
+    if method in ('slice_max', 'volume_max', 'volume_p99'):
+        top = stats[:, FIELDS.index('p99' if method == 'volume_p99' else 'max')]
+        scale = np.divide(1., top, out=np.ones_like(top), where=top != 0)
+        offset = np.zeros_like(top)
+    elif method == 'zscore':
+        mean, std = stats[:, FIELDS.index('mean')], stats[:, FIELDS.index('std')]
+        scale = np.divide(1., std, out=np.ones_like(std), where=std != 0)
+        offset = -mean * scale
+    else:
+        raise ValueError('Unknown normalization {}, use one of {}'.format(method, METHODS))
+    return scale.astype(np.float32), offset.astype(np.float32)
+
+
+class NormStats(object):
+    def __init__(self, paths, volumes, slice_stats, volume_stats):
+        '''
+        Side index of per-slice and per-volume intensity statistics, so normalization is a lookup and a multiply-add
+        instead of a reduction over every slice or patch, and uses the same numbers in training and inference.
+        INPUT   (1) list 'paths': filepaths of the slices
+                (2) list 'volumes': volume (patient) names, see volume_of, in the order of volume_stats
+                (3) array 'slice_stats': (n_slices, n_mod, len(FIELDS)) statistics of each slice
+                (4) array 'volume_stats': (n_volumes, n_mod, len(FIELDS)) statistics of each volume
+        '''
+        self.paths = list(paths)
+        self.volumes = list(volumes)
+        self.slice_stats = slice_stats
+        self.volume_stats = volume_stats
+        self._rows = dict((slice_key(p), i) for i, p in enumerate(self.paths))
+        self._volume_rows = dict((v, i) for i, v in enumerate(self.volumes))
+
+    @classmethod
+    def build(cls, paths, load_image):
+        '''
+        Reads every slice once, volume by volume. Volume percentiles are exact for integer slices, taken from summed
+        intensity histograms; for float slices they are the median of the slice percentiles.
+        INPUT   (1) list 'paths': filepaths to slices
+                (2) function 'load_image': maps a slice filepath to its (n_mod, 240, 240) array
+        OUTPUT  (1) NormStats over paths
+        '''
+        print('Computing intensity statistics of {} slices...'.format(len(paths)))
+        paths = sorted(paths, key=volume_of)
+        slice_stats, volume_stats, volumes = [], [], []
+        bar = progress_bar()
+        for i in bar(range(len(paths))):
+            image = load_image(paths[i])
+            if not volumes or volumes[-1] != volume_of(paths[i]):
+                volumes.append(volume_of(paths[i]))
+                acc = {'max': np.zeros(len(image)), 'sum': np.zeros(len(image)), 'sumsq': np.zeros(len(image)),
+                       'count': np.zeros(len(image)), 'hist': [np.zeros(0, np.int64) for _ in image], 'slices': []}
+                volume_stats.append(acc)
+            slice_stats.append(image_stats(image))
+            acc['slices'].append(slice_stats[-1])
+            for m, channel in enumerate(image):
+                brain = channel[channel != 0]
+                acc['max'][m] = max(acc['max'][m], channel.max())
+                acc['sum'][m] += brain.sum(dtype=np.float64)
+                acc['sumsq'][m] += np.square(brain, dtype=np.float64).sum()
+                acc['count'][m] += len(brain)
+                if np.issubdtype(brain.dtype, np.integer) and len(brain):
+                    hist = np.bincount(brain.ravel())
+                    if len(hist) > len(acc['hist'][m]):
+                        hist[:len(acc['hist'][m])] += acc['hist'][m]
+                        acc['hist'][m] = hist
+                    else:
+                        acc['hist'][m][:len(hist)] += hist
+        print('Done.')
+        return cls(paths, volumes, np.array(slice_stats, dtype=np.float32),
+                   np.array([_finish_volume(acc) for acc in volume_stats], dtype=np.float32))
+
+    @classmethod
+    def load(cls, stats_path):
+        '''
+        INPUT   (1) str 'stats_path': filepath of statistics written by save
+        OUTPUT  (1) NormStats
+        '''
+        data = np.load(stats_path)
+        return cls([str(p) for p in data['paths']], [str(v) for v in data['volumes']], data['slice_stats'], data['volume_stats'])
+
+    def save(self, stats_path):
+        '''
+        INPUT   (1) str 'stats_path': filepath to save the statistics to (.npz)
+        '''
+        np.savez(stats_path, paths=np.array(self.paths), volumes=np.array(self.volumes), slice_stats=self.slice_stats,
+                 volume_stats=self.volume_stats, fields=np.array(FIELDS))
+
+    def covers(self, paths):
+        '''
+        True if every slice in paths has statistics.
+        '''
+        return all(slice_key(p) in self._rows for p in paths)
+
+    def __contains__(self, path):
+        return path is not None and slice_key(path) in self._rows
+
+    def stats(self, path, volume=False):
+        '''
+        INPUT   (1) str 'path': filepath of an indexed slice
+                (2) bool 'volume': if True, returns the statistics of the slice's volume instead
+        OUTPUT  (1) (n_mod, len(FIELDS)) statistics
+        '''
+        if volume:
+            return self.volume_stats[self._volume_rows[volume_of(path)]]
+        return self.slice_stats[self._rows[slice_key(path)]]
+
+    def params(self, path, channels, method):
+        '''
+        OUTPUT  scale and offset normalizing the given channels of the slice at path, see norm_params
+        '''
+        return norm_params(self.stats(path, volume=method != 'slice_max'), channels, method)
+
+
+def _finish_volume(acc):
+    stats = np.zeros((len(acc['max']), len(FIELDS)))
+    stats[:, 0] = acc['max']
+    count = np.maximum(acc['count'], 1)
+    stats[:, 3] = acc['sum'] / count
+    stats[:, 4] = np.sqrt(np.maximum(acc['sumsq'] / count - stats[:, 3] ** 2, 0))
+    slices = np.array(acc['slices'])
+    for m, hist in enumerate(acc['hist']):
+        if hist.sum():
+            cumulative = np.cumsum(hist) / float(hist.sum())
+            stats[m, 1:3] = np.searchsorted(cumulative, [0.01, 0.99])
+        else:
+            stats[m, 1:3] = np.median(slices[:, m, 1:3], axis=0)
+    return stats
+
+
+def normalization_params(norm_stats, path, image, channels, method):
+    '''
+    Scale and offset for one slice: looked up in norm_stats when it holds the slice, otherwise computed from the slice
+    itself. volume methods only fall back to the statistics of the slice alone without norm_stats; with norm_stats,
+    a slice it does not hold raises ValueError rather than being normalized differently from its volume.
+    INPUT   (1) NormStats 'norm_stats': side index, or None
+            (2) str 'path': filepath of the slice, or None if it was not read from a file
+            (3) array 'image': (n_mod, 240, 240) slice
+            (4) tuple 'channels': modalities being normalized
+            (5) str 'method': one of METHODS
+    '''
+    if norm_stats is not None and path in norm_stats:
+        return norm_stats.params(path, channels, method)
+    if norm_stats is not None and method != 'slice_max':
+        raise ValueError('No intensity statistics of {} for {} normalization'.format(path, method))
+    if method in ('slice_max', 'volume_max'):
+        stats = np.zeros((len(image), len(FIELDS)))
+        stats[list(channels), 0] = image[list(channels)].max(axis=(1, 2))
+        return norm_params(stats, channels, method)
+    return norm_params(image_stats(image), channels, method)
+
+
+def stats_digest(norm_stats, path, method):
+    '''
+    Digest of the statistics normalization_params looks up for a slice, to key cached predictions on, or '' when the
+    slice is normalized from its own contents (which the caches key on already).
+    INPUT   (1) NormStats 'norm_stats': side index, or None
+            (2) str 'path': filepath of the slice, or None
+            (3) str 'method': one of METHODS
+    '''
+    if norm_stats is None or path not in norm_stats:
+        return ''
+    stats = norm_stats.stats(path, volume=method != 'slice_max')
+    return hashlib.sha1(np.ascontiguousarray(stats, dtype=np.float32).tobytes()).hexdigest()
+
+
+def load_or_build(stats_path, paths, load_image):
+    '''
+    Loads the statistics at stats_path, rebuilding and saving them if missing or if they do not cover paths.
+    '''
+    if stats_path is not None and os.path.exists(stats_path):
+        norm_stats = NormStats.load(stats_path)
+        if norm_stats.covers(paths):
+            return norm_stats
+        print('Intensity statistics {} are out of date, rebuilding.'.format(stats_path))
+    norm_stats = NormStats.build(paths, load_image)
+    if stats_path is not None:
+        norm_stats.save(stats_path)
+    return norm_stats
+
+
+if __name__ == '__main__':
+    from slice_cache import SliceCache, read_slice
+
+    parser = argparse.ArgumentParser(description='Precompute per-slice and per-volume intensity statistics of slice pngs.')
+    parser.add_argument('slices', help="glob of the slice pngs, e.g. '/vdb1/ImageData/n4_PNG/*'")
+    parser.add_argument('--out', default='norm_stats.npz', help='.npz file to write the statistics to')
+    args = parser.parse_args()
+
+    # slices are read once each, so skip the shared cache
+    cache = SliceCache(0)
+    NormStats.build(glob(args.slices), lambda p: read_slice(p, cache)).save(args.out)
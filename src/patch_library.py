@@ -1,95 +1,259 @@
 import numpy as np
-import random
 import os
+import mmap
+import multiprocessing
 from glob import glob
-import matplotlib
-import matplotlib.pyplot as plt
-from skimage import io
-from skimage.filters.rank import entropy
-from skimage.morphology import disk
-import progressbar
-from sklearn.feature_extraction.image import extract_patches_2d
-
-progress = progressbar.ProgressBar(widgets=[progressbar.Bar('*', '[', ']'), progressbar.Percentage(), ' '])
+from numpy.lib.stride_tricks import as_strided
+from label_index import load_or_build, progress_bar
+from norm_stats import normalization_params
+from boundary_index import load_or_build as load_boundaries
+from slice_cache import read_slice, read_label
+from instrumentation import span, count, drain, merge
+
 np.random.seed(5)
 
 
+def extract_patches(stack, centres, patch_size, out=None, normalize=True, dtype=np.float32):
+    '''
+    Gathers the patches centred on each of centres in one strided-view gather, without a python loop over patches.
+    INPUT   (1) array 'stack': (n_chan, 240, 240) modalities of one slice
+            (2) array 'centres': (n, 2) pixel coordinates. each must be far enough from the border for a whole patch
+            (3) tuple 'patch_size': (h, w) of patches
+            (4) array 'out': preallocated (n, n_chan, h, w) output. allocated with dtype if None
+            (5) bool 'normalize': if True, divides each channel of each patch by its max (all-zero channels are left as is)
+            (6) dtype 'dtype': dtype of out if it is allocated here. defaults to float32
+    OUTPUT  (1) out, filled with the patches
+    '''
+    h, w = patch_size
+    n_chan, rows, cols = stack.shape
+    if out is None:
+        out = np.empty((len(centres), n_chan, h, w), dtype=dtype)
+    if len(centres) == 0:
+        return out
+    r, c = centres[:, 0] - h // 2, centres[:, 1] - w // 2
+    if r.min() < 0 or c.min() < 0 or r.max() > rows - h or c.max() > cols - w:
+        raise ValueError('Patch centres must lie at least half a patch inside the slice')
+    # every window start in row-major order, so a (row, col) start is the flat index row * cols + col
+    stack = np.ascontiguousarray(stack)
+    s_chan, s_row, s_col = stack.strides
+    windows = as_strided(stack, shape=((rows - h) * cols + cols - w + 1, n_chan, h, w), strides=(s_col, s_chan, s_row, s_col))
+    patches = windows[r * cols + c]
+    if normalize:
+        # normalize in float32 before any cast to out, raw uint16 intensities overflow float16
+        patches = normalize_patches(patches.astype(np.float32))
+    out[...] = patches
+    return out
+
+
+def check_raw_dtype(dtype, normalize):
+    '''
+    Raises ValueError for raw (unnormalized) patches of a dtype the uint16 intensities of the slices overflow, i.e.
+    float16, whose largest finite value is 65504.
+    '''
+    if not normalize and np.dtype(dtype) == np.float16:
+        raise ValueError('Raw intensities overflow float16, normalize the patches or gather them as float32')
+
+
+def normalize_patches(patches):
+    '''
+    Divides each channel of each (n, n_chan, h, w) patch by its max in place, leaving all-zero channels as is.
+    '''
+    top = patches.max(axis=(2, 3), keepdims=True)
+    np.divide(patches, top, out=patches, where=top != 0)
+    return patches
+
+
+def centre_crop(patches, n):
+    '''
+    View of the centre n x n of every patch, sharing the memory of patches rather than copying it.
+    INPUT   (1) array 'patches': (..., h, w) patches, e.g. (n_sample, n_chan, 33, 33)
+            (2) int 'n': size of the centre crop. for an even n the crop extends one pixel further up and left of the centre pixel
+    OUTPUT  (1) (..., n, n) view of patches
+    '''
+    h, w = patches.shape[-2:]
+    if n > min(h, w):
+        raise ValueError('Centre crop of {} is larger than the {}x{} patches'.format(n, h, w))
+    r, c = h // 2 - n // 2, w // 2 - n // 2
+    return patches[..., r:r + n, c:c + n]
+
+
+class MultiScalePatches(object):
+    def __init__(self, sizes):
+        '''
+        Maps a batch of patches to the inputs of a multi-scale model: for each model input, the centre size x size of
+        every patch, as a view over the batch (see centre_crop). The context patch and its centre crops therefore share
+        one buffer, whether it is a training batch or an inference tile.
+        INPUT   tuple 'sizes': spatial size of each model input, in input order, e.g. (5, 33) for a centre 5x5 input
+                followed by the whole 33x33 patch
+        '''
+        self.sizes = tuple(sizes)
+
+    @classmethod
+    def for_model(cls, model):
+        '''
+        INPUT   keras model 'model': channels-first model taking one or more (n_chan, size, size) inputs
+        OUTPUT  MultiScalePatches feeding each input of model
+        '''
+        shapes = model.input_shape if isinstance(model.input_shape, list) else [model.input_shape]
+        return cls([shape[-1] for shape in shapes])
+
+    def __call__(self, X):
+        '''
+        INPUT   array 'X': (n_sample, n_chan, h, w) patches at the largest scale
+        OUTPUT  X itself for a single full-size input, otherwise a list of views of X, one per model input
+        '''
+        views = [X if size == X.shape[-1] else centre_crop(X, size) for size in self.sizes]
+        return views[0] if len(views) == 1 else views
+
+
 class PatchLibrary(object):
-    def __init__(self, patch_size, train_data, num_samples):
+    def __init__(self, patch_size, train_data, num_samples, label_dir='/vdb1/ImageData/Labels/', index_path=None, cache=None, store=None, channels=(0,2,3), dtype=np.float32, norm_stats=None, normalization='patch', boundary_path=None):
         '''
         class for creating patches and subpatches from training data to use as input for segmentation models.
         INPUT   (1) tuple 'patch_size': size (in voxels) of patches to extract. Use (33,33) for sequential model
                 (2) list 'train_data': list of filepaths to all training data saved as pngs. images should have shape (5*240,240)
                 (3) int 'num_samples': the number of patches to collect from training data.
+                (4) str 'label_dir': directory holding the '<name>L.png' label of each training image
+                (5) str 'index_path': .npz file to keep the label index in. built on first use if missing. if None, the index is only kept in memory
+                (6) SliceCache 'cache': cache of decoded slices and labels. defaults to the cache shared by all instances
+                (7) SliceStore 'store': packed slice store. slices found in it are read as memory-mapped views instead of decoding pngs
+                (8) tuple 'channels': modalities to build patches from. defaults to flair, t1c and t2
+                (9) dtype 'dtype': dtype of the normalized patches. float32 by default, float16 halves training sets again
+                    but only holds normalized patches. slices themselves stay in the integer type of the pngs until
+                    patches are gathered
+                (10) NormStats 'norm_stats': precomputed intensity statistics of train_data, see norm_stats
+                (11) str 'normalization': 'patch' divides each channel of each patch by its own max. any of
+                     norm_stats.METHODS scales every patch of a slice by the statistics of that slice or its volume, as
+                     SegmentationModel does at inference
+                (12) str 'boundary_path': .npz file to keep the label boundary index for entropy sampling in. built on
+                     first use if missing. if None, the index is only kept in memory
         '''
         self.patch_size = patch_size
         self.num_samples = num_samples
         self.train_data = train_data
         self.h = self.patch_size[0]
         self.w = self.patch_size[1]
+        self.label_dir = label_dir
+        self.index_path = index_path
+        self.index = None
+        self.cache = cache
+        self.store = store
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self.norm_stats = norm_stats
+        self.normalization = normalization
+        self.boundary_path = boundary_path
+        self.boundaries = None
+
+    def label_path(self, im_path):
+        '''
+        INPUT   str 'im_path': filepath to a training image
+        OUTPUT  filepath to the label of that image
+        '''
+        fn = os.path.basename(im_path)
+        return os.path.join(self.label_dir, fn[:-4] + 'L.png')
+
+    def read_image(self, im_path):
+        '''
+        INPUT   str 'im_path': filepath to a training image
+        OUTPUT  read-only array of shape (5, 240, 240), from the store if it holds im_path, otherwise decoded through the cache
+        '''
+        if self.store is not None and im_path in self.store:
+            return self.store.image(im_path)
+        return read_slice(im_path, self.cache)
+
+    def read_label(self, im_path):
+        '''
+        INPUT   str 'im_path': filepath to a training image
+        OUTPUT  read-only label of im_path of shape (240, 240)
+        '''
+        if self.store is not None and im_path in self.store and self.store.labelled(im_path):
+            return self.store.label(im_path)
+        return read_label(self.label_path(im_path), self.cache)
 
-    def find_patches(self, class_num, num_patches):
+    def normalize(self, patches, im_path, image):
+        '''
+        Normalizes raw patches gathered from one slice according to self.normalization.
+        INPUT   (1) array 'patches': (n, n_chan, h, w) raw patches of the channels in self.channels
+                (2) str 'im_path': filepath of the slice the patches come from
+                (3) array 'image': (5, 240, 240) slice, used when norm_stats does not hold im_path
+        OUTPUT  (1) float32 normalized patches
+        '''
+        patches = patches.astype(np.float32)
+        if self.normalization == 'patch':
+            return normalize_patches(patches)
+        scale, offset = normalization_params(self.norm_stats, im_path, image, self.channels, self.normalization)
+        patches *= scale[:, np.newaxis, np.newaxis]
+        patches += offset[:, np.newaxis, np.newaxis]
+        return patches
+
+    def label_index(self):
+        '''
+        Returns the per-class label index of train_data, loading it from index_path or building it on first use.
+        '''
+        if self.index is None:
+            self.index = load_or_build(self.index_path, self.train_data, self.read_label, load_image=self.read_image)
+        return self.index
+
+    def find_patches(self, class_num, num_patches, out=None, normalize=False, rng=np.random, verbose=True):
         '''
         Helper function for sampling slices with evenly distributed classes
-        INPUT:  (1) list 'training_images': all training images to select from
-                (2) int 'class_num': class to sample from choice of {0, 1, 2, 3, 4}.
-                (3) tuple 'patch_size': dimensions of patches to be generated defaults to 65 x 65
-        OUTPUT: (1) num_samples patches from class 'class_num' randomly selected.
+        INPUT:  (1) int 'class_num': class to sample from choice of {0, 1, 2, 3, 4}.
+                (2) int 'num_patches': number of patches to find
+                (3) array 'out': preallocated (num_patches, n_chan, h, w) array to write patches into. allocated as self.dtype if None
+                (4) bool 'normalize': if True, normalizes the patches according to self.normalization
+                (5) RandomState 'rng': source of randomness. defaults to the global numpy state
+                (6) bool 'verbose': if True, prints which class is being sampled
+        OUTPUT: (1) num_patches patches from class 'class_num' randomly selected.
+                (2) labels of the patches
         '''
         h,w = self.patch_size[0], self.patch_size[1]
-        patches, labels = [], np.full(num_patches, class_num, 'float')
-        print( 'Finding patches of class {}...'.format(class_num))
+        labels = np.full(num_patches, class_num, 'float')
+        check_raw_dtype(self.dtype if out is None else out.dtype, normalize)
+        if out is None:
+            out = np.empty((num_patches, len(self.channels), h, w), dtype=self.dtype)
+        if verbose:
+            print( 'Finding patches of class {}...'.format(class_num))
 
+        index = self.label_index()
+        cls = int(class_num)
         ct = 0
-        while ct < num_patches:
-            im_path = random.choice(self.train_data)
-            fn = os.path.basename(im_path)
-            label = io.imread('/vdb1/ImageData/Labels/' + fn[:-4] + 'L.png')
-
-            # resample if class_num not in selected slice
-            # while len(np.argwhere(label == class_num)) < 10:
-            #     im_path = random.choice(self.train_data)
-            #     fn = os.path.basename(im_path)
-            #     label = io.imread('Labels/' + fn[:-4] + 'L.png')
-            if len(np.argwhere(label == class_num)) < 10:
-                continue
-
-            # select centerpix (p) and patch (p_ix)
-            imgs = io.imread(im_path).reshape(5, 240, 240)[:-1].astype('float')
-            img=[]
-            img.append(imgs[0])
-            #img.append(imgs[1])
-            img.append(imgs[2])
-            img.append(imgs[3])
-            p = random.choice(np.argwhere(label == class_num))
-            #print(p)
-            p_ix = (p[0]-int(h/2), p[0]+int((h+1)/2), p[1]-int(w/2), p[1]+int((w+1)/2))
-            patch = np.array([i[p_ix[0]:p_ix[1], p_ix[2]:p_ix[3]] for i in img])
-
-            # resample it patch is empty or too close to edge
-            # while patch.shape != (4, h, w) or len(np.unique(patch)) == 1:
-            #     p = random.choice(np.argwhere(label == class_num))
-            #     p_ix = (p[0]-(h/2), p[0]+((h+1)/2), p[1]-(w/2), p[1]+((w+1)/2))
-            #     patch = np.array([i[p_ix[0]:p_ix[1], p_ix[2]:p_ix[3]] for i in img])
-            if patch.shape != (3, h, w) or len(np.argwhere(patch == 0)) > (h * w):
-                continue
-
-            patches.append(patch)
-            ct += 1
-        return np.array(patches), labels
+        with span('find_patches'):
+            while ct < num_patches:
+                # draw slices holding class_num and a pixel of that class in each from the index
+                s, p = index.sample(class_num, num_patches - ct, rng)
+                count('patches_drawn', len(p), cls=cls)
+
+                # resample if patch is too close to edge
+                inside = (p[:, 0] >= h // 2) & (p[:, 0] <= 240 - (h + 1) // 2) & (p[:, 1] >= w // 2) & (p[:, 1] <= 240 - (w + 1) // 2)
+                s, p = s[inside], p[inside]
+                count('patches_rejected', len(inside) - len(p), cls=cls, reason='edge')
+
+                # gather the patches of each drawn slice at once
+                for sl in np.unique(s):
+                    centres = p[s == sl]
+                    with span('read_slice'):
+                        imgs = self.read_image(index.paths[sl])
+                    with span('extract_patches'):
+                        batch = extract_patches(imgs[list(self.channels)], centres, (h, w), normalize=False, dtype=imgs.dtype)
+
+                    # resample if patch is mostly empty
+                    batch = batch[(batch == 0).sum(axis=(1, 2, 3)) <= h * w]
+                    count('patches_rejected', len(centres) - len(batch), cls=cls, reason='empty')
+                    with span('normalize_patches'):
+                        out[ct:ct + len(batch)] = self.normalize(batch, index.paths[sl], imgs) if normalize else batch
+                    ct += len(batch)
+        count('patches_accepted', num_patches, cls=cls)
+        return out, labels
 
     def center_n(self, n, patches):
         '''
         Takes list of patches and returns center nxn for each patch. Use as input for cascaded architectures.
         INPUT   (1) int 'n': size of center patch to take (square)
-                (2) list 'patches': list of patches to take subpatch of
-        OUTPUT: list of center nxn patches.
+                (2) array 'patches': patches to take subpatch of, with the patch rows and columns as the last two axes
+        OUTPUT: view of the center nxn of each patch, sharing memory with patches (see centre_crop)
         '''
-        sub_patches = []
-        for mode in patches:
-            subs = np.array([patch[(self.h/2) - (n/2):(self.h/2) + ((n+1)/2),(self.w/2) - (n/2):(self.w/2) + ((n+1)/2)] for patch in mode])
-            sub_patches.append(subs)
-        return np.array(sub_patches)
+        return centre_crop(np.asarray(patches), n)
 
     def slice_to_patches(self, filename):
         '''
@@ -97,82 +261,161 @@ class PatchLibrary(object):
         INPUT: str 'filename': path to image to be converted to patches
         OUTPUT: list of patched version of imput image.
         '''
-        slices = io.imread(filename).astype('float').reshape(5,240,240)[:-1]
+        from sklearn.feature_extraction.image import extract_patches_2d
+        image = self.read_image(filename)
+        method = 'slice_max' if self.normalization == 'patch' else self.normalization
+        scale, offset = normalization_params(self.norm_stats, filename, image, range(4), method)
         plist=[]
-        for slice in slices:
-            if np.max(img) != 0:
-                img /= np.max(img)
-            p = extract_patches_2d(img, (h,w))
+        for img, a, b in zip(image[:-1], scale, offset):
+            img = (img.astype(np.float32) * a + b).astype(self.dtype)
+            p = extract_patches_2d(img, (self.h, self.w))
             plist.append(p)
         aa=list(zip(np.array(plist[0]), np.array(plist[1]), np.array(plist[2]), np.array(plist[3])))
         return np.array(aa)
 
-    def patches_by_entropy(self, num_patches):
+    def patches_by_entropy(self, num_patches, out=None, normalize=True, top=None, rng=np.random):
         '''
-        Finds high-entropy patches based on label, allows net to learn borders more effectively.
-        INPUT: int 'num_patches': defaults to num_samples, enter in quantity it using in conjunction with randomly sampled patches.
-        OUTPUT: list of patches (num_patches, 4, h, w) selected by highest entropy
+        Finds high-entropy patches based on label, allows net to learn borders more effectively. Centres are drawn from
+        the boundary index, so no entropy is computed while sampling.
+        INPUT   (1) int 'num_patches': number of patches to find
+                (2) array 'out': preallocated (num_patches, n_chan, h, w) array to write patches into. allocated as self.dtype if None
+                (3) bool 'normalize': if True, normalizes the patches according to self.normalization
+                (4) int 'top': if given, centres are drawn from the top highest-entropy pixels of each slice only
+                (5) RandomState 'rng': source of randomness. defaults to the global numpy state
+        OUTPUT  (1) num_patches patches (num_patches, n_chan, h, w) centred on label boundaries
+                (2) label of the centre pixel of each patch
         '''
-        patches, labels = [], []
+        h, w = self.h, self.w
+        labels = np.empty(num_patches, 'float')
+        check_raw_dtype(self.dtype if out is None else out.dtype, normalize)
+        if out is None:
+            out = np.empty((num_patches, len(self.channels), h, w), dtype=self.dtype)
+        index = self.boundary_index()
         ct = 0
-        while ct < num_patches:
-            im_path = random.choice(training_images)
-            fn = os.path.basename(im_path)
-            label = io.imread('/vdb1/ImageData/BRATS/Labels/' + fn[:-4] + 'L.png')
-
-            # pick again if slice is only background
-            if len(np.unique(label)) == 1:
-                continue
-
-            img = io.imread(im_path).reshape(5, 240, 240)[:-1].astype('float')
-            l_ent = entropy(label, disk(self.h))
-            top_ent = np.percentile(l_ent, 90)
-
-            # restart if 80th entropy percentile = 0
-            if top_ent == 0:
-                continue
-
-            highest = np.argwhere(l_ent >= top_ent)
-            p_s = random.sample(highest, 3)
-            for p in p_s:
-                p_ix = (p[0]-(h//2), p[0]+((h+1)//2), p[1]-(w//2), p[1]+((w+1)//2))
-                patch = np.array([i[p_ix[0]:p_ix[1], p_ix[2]:p_ix[3]] for i in img])
-                # exclude any patches that are too small
-                if np.shape(patch) != (4,65,65):
-                    continue
-                patches.append(patch)
-                labels.append(label[p[0],p[1]])
-            ct += 1
-            return np.array(patches[:num_samples]), np.array(labels[:num_samples])
-
-    def make_training_patches(self, entropy=False, balanced_classes=True, classes=[0,1,2,3,4]):
+        with span('patches_by_entropy'):
+            while ct < num_patches:
+                s, p, classes = index.sample(num_patches - ct, top, rng)
+                count('patches_drawn', len(p), cls='boundary')
+                for sl in np.unique(s):
+                    centres = p[s == sl]
+                    with span('read_slice'):
+                        imgs = self.read_image(index.paths[sl])
+                    with span('extract_patches'):
+                        batch = extract_patches(imgs[list(self.channels)], centres, (h, w), normalize=False, dtype=imgs.dtype)
+
+                    # resample if patch is mostly empty
+                    keep = (batch == 0).sum(axis=(1, 2, 3)) <= h * w
+                    batch = batch[keep]
+                    count('patches_rejected', len(centres) - len(batch), cls='boundary', reason='empty')
+                    with span('normalize_patches'):
+                        out[ct:ct + len(batch)] = self.normalize(batch, index.paths[sl], imgs) if normalize else batch
+                    labels[ct:ct + len(batch)] = classes[s == sl][keep]
+                    ct += len(batch)
+        count('patches_accepted', num_patches, cls='boundary')
+        return out, labels
+
+    def boundary_index(self, n_jobs=1):
+        '''
+        Returns the label boundary index of train_data, loading it from boundary_path or building it on first use.
+        INPUT   int 'n_jobs': worker processes to build the index with
+        '''
+        if self.boundaries is None:
+            self.boundaries = load_boundaries(self.boundary_path, self.train_data, self.read_label, radius=self.h // 2,
+                                              border=self.h // 2, n_jobs=n_jobs)
+        return self.boundaries
+
+    def make_training_patches(self, entropy=False, balanced_classes=True, classes=[0,1,2,3,4], n_jobs=1, shard_size=1000):
         '''
         Creates X and y for training CNN
-        INPUT   (1) bool 'entropy': if True, half of the patches are chosen based on highest entropy area. defaults to False.
+        INPUT   (1) bool 'entropy': if True, half of the patches are centred on label boundaries (see patches_by_entropy),
+                    after the class-balanced half. defaults to False.
                 (2) bool 'balanced classes': if True, will produce an equal number of each class from the randomly chosen samples
                 (3) list 'classes': list of classes to sample from. Only change default oif entropy is False and balanced_classes is True
-        OUTPUT  (1) X: patches (num_samples, 4_chan, h, w)
+                (4) int 'n_jobs': number of worker processes to sample with. defaults to 1 (sample in this process)
+                (5) int 'shard_size': patches per unit of work. each shard has its own seed, drawn from the numpy global state,
+                    so X is the same for any n_jobs
+        OUTPUT  (1) X: patches (num_samples, n_chan, h, w) of self.dtype, normalized according to self.normalization:
+                    'patch' divides each channel of each patch by its own max, 'slice_max', 'volume_max', 'volume_p99'
+                    and 'zscore' scale every patch of a slice by the statistics of that slice or its volume (see
+                    norm_stats.METHODS), looked up in self.norm_stats
                 (2) y: labels (num_samples,)
         '''
         if balanced_classes:
-            per_class = self.num_samples // len(classes)
-            patches, labels = [], []
-            progress.currval = 0
-           # print(type(classes[1]))
-            for i in progress(range(len(classes))):
-                p, l = self.find_patches(float(classes[i]), per_class)
-                # set 0 <= pix intensity <= 1
-                for img_ix in range(len(p)):
-                    for slice in range(len(p[img_ix])):
-                        if np.max(p[img_ix][slice]) != 0:
-                            p[img_ix][slice] //= np.max(p[img_ix][slice])
-                patches.append(p)
-                labels.append(l)
-            return np.array(patches).reshape(self.num_samples, 3, self.h, self.w), np.array(labels).reshape(self.num_samples)
+            n_entropy = self.num_samples // 2 if entropy else 0
+            per_class = (self.num_samples - n_entropy) // len(classes)
+            n_balanced = per_class * len(classes)
+            shape = (n_balanced + n_entropy, len(self.channels), self.h, self.w)
+            shards = []
+            for i in range(len(classes)):
+                for start in range(0, per_class, shard_size):
+                    shards.append((float(classes[i]), i * per_class + start, min(shard_size, per_class - start)))
+            # entropy shards have no class, their labels come back from the shard
+            for start in range(0, n_entropy, shard_size):
+                shards.append((None, n_balanced + start, min(shard_size, n_entropy - start)))
+            seeds = np.random.randint(0, 2**31 - 1, len(shards))
+            shards = [shard + (seed,) for shard, seed in zip(shards, seeds)]
+            labels = np.empty(shape[0], 'float')
+
+            # build the indices once here rather than once per worker
+            with span('build_indices'):
+                self.label_index()
+                if n_entropy:
+                    self.boundary_index(n_jobs)
+            progress = progress_bar()
+            if n_jobs == 1:
+                X = np.empty(shape, dtype=self.dtype)
+                with span('make_training_patches'):
+                    for shard in progress(shards):
+                        start, y = self._sample_shard(X, *shard)
+                        labels[start:start + len(y)] = y
+                return X, labels
+
+            # workers are forked and write their shards straight into an anonymous shared mapping backing X
+            buf = mmap.mmap(-1, int(np.prod(shape)) * self.dtype.itemsize)
+            X = np.frombuffer(buf, dtype=self.dtype).reshape(shape)
+            pool = multiprocessing.get_context('fork').Pool(n_jobs, _init_worker, (self, X))
+            try:
+                with span('make_training_patches'):
+                    # imap_unordered has no length, so the bar counts shards as they complete
+                    results = pool.imap_unordered(_sample_worker_shard, shards)
+                    for _ in progress(range(len(shards))):
+                        start, y, counts = next(results)
+                        labels[start:start + len(y)] = y
+                        merge(counts)
+            finally:
+                pool.close()
+                pool.join()
+            return X, labels
         else:
             print("Use balanced classes, random won't work.")
 
+    def _sample_shard(self, X, class_num, start, n, seed):
+        '''
+        Fills X[start:start + n] with normalized patches of class_num, or with boundary patches if class_num is
+        None, sampled with its own seed. Returns start and the labels of the patches.
+        '''
+        rng = np.random.RandomState(seed)
+        if class_num is None:
+            _, y = self.patches_by_entropy(n, out=X[start:start + n], normalize=True, rng=rng)
+        else:
+            _, y = self.find_patches(class_num, n, out=X[start:start + n], normalize=True, rng=rng, verbose=False)
+        return start, y
+
+
+# library and output array of a make_training_patches worker process, set when the worker is forked
+_worker = {}
+
+
+def _init_worker(library, X):
+    _worker['library'] = library
+    _worker['X'] = X
+    # drop the counts inherited from the parent, so each worker only sends back its own
+    drain()
+
 
+def _sample_worker_shard(shard):
+    start, y = _worker['library']._sample_shard(_worker['X'], *shard)
+    return start, y, drain()
 
 if __name__ == '__main__':
     pass
@@ -0,0 +1,140 @@
+import numpy as np
+import threading
+import time
+
+
+class PatchStream(object):
+    def __init__(self, library, batch_size=128, steps=1000, classes=[0,1,2,3,4], n_classes=5, seed=None, inputs=None):
+        '''
+        Class-balanced batches of training patches, sampled on demand from a PatchLibrary so only one batch per worker
+        is ever held in memory. Index it like a keras Sequence or iterate over it as an endless generator.
+        INPUT   (1) PatchLibrary 'library': library to sample patches from
+                (2) int 'batch_size': patches per batch. split as evenly as possible between classes
+                (3) int 'steps': batches per epoch
+                (4) list 'classes': classes to sample from
+                (5) int 'n_classes': number of classes for one-hot labels
+                (6) int 'seed': base seed. batch i of epoch e is always sampled with seed + e * steps + i. drawn from the
+                    numpy global state if None
+                (7) function 'inputs': maps a batch of patches to the model inputs, e.g. to add a centre crop. defaults to identity
+        '''
+        self.library = library
+        self.batch_size = batch_size
+        self.steps = steps
+        self.classes = classes
+        self.n_classes = n_classes
+        self.seed = np.random.randint(0, 2**31 - 1) if seed is None else seed
+        self.inputs = inputs
+        self.epoch = 0
+        self._lock = threading.Lock()
+        self._next = 0
+        # build (or load) the label index here, before any worker thread samples from the library and would build
+        # it lazily and concurrently
+        library.label_index()
+
+    def __len__(self):
+        return self.steps
+
+    def __getitem__(self, i):
+        '''
+        INPUT   int 'i': index of the batch in the current epoch
+        OUTPUT  (1) model inputs for batch_size patches ((batch_size, n_chan, h, w) of library.dtype unless 'inputs' maps them)
+                (2) one-hot labels (batch_size, n_classes)
+        '''
+        rng = np.random.RandomState((self.seed + self.epoch * self.steps + i) % (2**31 - 1))
+        counts = np.full(len(self.classes), self.batch_size // len(self.classes))
+        counts[:self.batch_size % len(self.classes)] += 1
+        X = np.empty((self.batch_size, len(self.library.channels), self.library.h, self.library.w), dtype=self.library.dtype)
+        y = np.repeat(self.classes, counts)
+        start = 0
+        for c, n in zip(self.classes, counts):
+            self.library.find_patches(float(c), n, out=X[start:start + n], normalize=True, rng=rng, verbose=False)
+            start += n
+
+        # shuffle within the batch so classes are not in blocks
+        order = rng.permutation(self.batch_size)
+        X, y = X[order], y[order]
+        Y = np.eye(self.n_classes, dtype=np.float32)[y]
+        if self.inputs is not None:
+            return self.inputs(X), Y
+        return X, Y
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._lock:
+            i = self._next
+            self._next += 1
+            if self._next == self.steps:
+                self._next = 0
+                self.on_epoch_end()
+        return self[i]
+
+    next = __next__
+
+
+class ArrayBatches(object):
+    def __init__(self, arrays, y, indices, batch_size=128, n_classes=5, inputs=None, shuffle=True, started=None):
+        '''
+        Batches over in-memory (or memory-mapped) training arrays, selected through an index array so the patches are
+        never copied or reordered as a whole. Only the current batch is gathered and one-hot encoded.
+        INPUT   (1) list 'arrays': arrays of patches sharing their first axis, gathered together into the model inputs
+                (2) array 'y': labels (n_sample,)
+                (3) array 'indices': rows of arrays and y in this split, in the order to visit them
+                (4) int 'batch_size': rows per batch
+                (5) int 'n_classes': number of classes for one-hot labels
+                (6) function 'inputs': maps the gathered arrays of a batch to the model inputs. defaults to the arrays themselves
+                (7) bool 'shuffle': if True, reshuffles indices at the end of each epoch
+                (8) float 'started': time.time() when fitting started. if given, the time to the first batch is printed
+        '''
+        self.arrays = arrays
+        self.y = np.asarray(y).astype(int)
+        self.indices = np.asarray(indices)
+        self.batch_size = batch_size
+        self.n_classes = n_classes
+        self.inputs = inputs
+        self.shuffle = shuffle
+        self.started = started
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices) / float(self.batch_size)))
+
+    def __getitem__(self, i):
+        # gathering in ascending row order keeps reads from a memmap sequential
+        rows = np.sort(self.indices[i * self.batch_size:(i + 1) * self.batch_size])
+        X = [a[rows] for a in self.arrays]
+        X = X[0] if len(X) == 1 else X
+        Y = np.eye(self.n_classes, dtype=np.float32)[self.y[rows]]
+        if self.started is not None:
+            print('Time to first batch: {0:.2f}s'.format(time.time() - self.started))
+            self.started = None
+        if self.inputs is not None:
+            return self.inputs(X), Y
+        return X, Y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.indices)
+
+
+def as_keras_sequence(stream):
+    '''
+    Wraps a PatchStream (or anything with __len__, __getitem__ and on_epoch_end) in a keras Sequence, so fit_generator
+    can prefetch batches with several workers.
+    '''
+    from keras.utils import Sequence
+
+    class StreamSequence(Sequence):
+        def __len__(self):
+            return len(stream)
+
+        def __getitem__(self, i):
+            return stream[i]
+
+        def on_epoch_end(self):
+            stream.on_epoch_end()
+
+    return StreamSequence()
@@ -0,0 +1,139 @@
+import numpy as np
+import os
+import hashlib
+import threading
+from instrumentation import count
+
+# (path, size, mtime) -> sha1 of the file, so each checkpoint is hashed once per process
+_file_hashes = {}
+
+
+def file_hash(path):
+    '''
+    OUTPUT  sha1 hex digest of the file at path, remembered until its size or mtime changes
+    '''
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime)
+    if key not in _file_hashes:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        _file_hashes[key] = h.hexdigest()
+    return _file_hashes[key]
+
+
+def model_file_key(model_name):
+    '''
+    Key of a saved model: hash of its architecture json and hdf5 weights.
+    INPUT   str 'model_name': filepath to model and weights, not including extension
+    '''
+    return hashlib.sha1((file_hash(model_name + '.json') + file_hash(model_name + '.hdf5')).encode()).hexdigest()
+
+
+def model_weights_key(model):
+    '''
+    Key of a model in memory, e.g. one just trained: hash of its architecture json and weight arrays.
+    '''
+    h = hashlib.sha1(model.to_json().encode())
+    for w in model.get_weights():
+        h.update(np.ascontiguousarray(w).tobytes())
+    return h.hexdigest()
+
+
+def slice_key(model_key, image, channels, kind='classes'):
+    '''
+    Key of one prediction: the model key, the raw slice contents, the modalities fed to the model and the kind of output.
+    '''
+    h = hashlib.sha1('{}|{}|{}|{}|{}'.format(model_key, kind, tuple(channels), image.shape, image.dtype).encode())
+    h.update(np.ascontiguousarray(image).tobytes())
+    return h.hexdigest()
+
+
+class PredictionCache(object):
+    def __init__(self, cache_dir='./prediction_cache', max_bytes=1024**3):
+        '''
+        Persistent on-disk cache of slice predictions, one .npy file per (model, slice) key. Reads refresh the mtime of
+        an entry, and once the cache holds more than max_bytes the entries read least recently are deleted.
+        INPUT   (1) str 'cache_dir': directory holding the entries. created if missing
+                (2) int 'max_bytes': byte budget for the entries on disk. defaults to 1 GB
+        '''
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.n_bytes = sum(e.stat().st_size for e in self._entries())
+
+    def _entries(self):
+        return [e for e in os.scandir(self.cache_dir) if e.name.endswith('.npy')]
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        '''
+        OUTPUT  cached array for key, or None on a miss
+        '''
+        path = self._path(key)
+        try:
+            arr = np.load(path)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            count('prediction_cache_lookups', result='miss')
+            return None
+        with self._lock:
+            self.hits += 1
+        count('prediction_cache_lookups', result='hit')
+        return arr
+
+    def put(self, key, arr):
+        '''
+        Writes arr under key. The entry is written to a temporary file and renamed, so readers never see partial entries.
+        '''
+        path = self._path(key)
+        tmp = '{}.{}.{}.tmp'.format(path[:-4], os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            np.save(f, arr)
+        size = os.path.getsize(tmp)
+        existed = os.path.exists(path)
+        os.replace(tmp, path)
+        with self._lock:
+            if not existed:
+                self.n_bytes += size
+            if self.n_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # drop least recently read entries until 90% of the budget is used, leaving room for the next writes
+        entries = sorted(self._entries(), key=lambda e: e.stat().st_mtime)
+        self.n_bytes = sum(e.stat().st_size for e in entries)
+        for e in entries:
+            if self.n_bytes <= 0.9 * self.max_bytes:
+                break
+            try:
+                size = e.stat().st_size
+                os.remove(e.path)
+            except OSError:
+                continue
+            self.n_bytes -= size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            for e in self._entries():
+                os.remove(e.path)
+            self.n_bytes = 0
+
+    def stats(self):
+        '''
+        OUTPUT  dict of hit/miss/eviction counters, entry count and bytes on disk
+        '''
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self._entries()),
+                'bytes': self.n_bytes, 'hit_rate': self.hits / float(total) if total else 0.}
@@ -0,0 +1,66 @@
+import numpy as np
+import os
+from instrumentation import span
+
+# overlay colour of each class, background (0) keeps the gamma-adjusted slice
+COLOURS = np.array([[0, 0, 0],
+                    [1, 0.2, 0.2],      # 1 red
+                    [0.35, 0.75, 0.25], # 2 green
+                    [0, 0.25, 0.9],     # 3 blue
+                    [1, 1, 0.25]])      # 4 yellow
+
+
+def load_backgrounds(slice_paths, read_image=None):
+    '''
+    INPUT   (1) list 'slice_paths': filepaths to (5*240, 240) slice pngs
+            (2) function 'read_image': maps a slice filepath to its (5, 240, 240) modalities, e.g. the read_image of a
+                model, so slices come from its store or cache. if None, each png is decoded here
+    OUTPUT  (n, 240, 240) array of the background modality of each slice, in the dtype of the pngs
+    '''
+    if read_image is not None:
+        return np.array([read_image(p)[-2] for p in slice_paths])
+    from skimage import io
+    with span('decode_png'):
+        return np.array([io.imread(p).reshape(5, 240, 240)[-2] for p in slice_paths])
+
+
+def overlay(backgrounds, segmentations, gamma=0.65):
+    '''
+    Paints the segmentation of one slice, or of a volume of slices, over the gamma-adjusted background in one lookup.
+    INPUT   (1) array 'backgrounds': (240, 240) or (n, 240, 240) background modality, as read from the pngs
+            (2) array 'segmentations': (208, 208) or (n, 208, 208) predicted classes, or already padded to 240 x 240
+            (3) float 'gamma': gamma applied to the background
+    OUTPUT  (1) float RGB image(s) of shape backgrounds.shape + (3,)
+    '''
+    from skimage import img_as_float
+    with span('render'):
+        segmentations = np.asarray(segmentations)
+        if segmentations.shape[-1] == 208:
+            pad = [(0, 0)] * (segmentations.ndim - 2) + [(16, 16), (16, 16)]
+            segmentations = np.pad(segmentations, pad, mode='edge')
+        gray = img_as_float(backgrounds) ** gamma
+        image = np.repeat(gray[..., np.newaxis], 3, axis=-1)
+        mask = segmentations != 0
+        image[mask] = COLOURS[segmentations[mask]]
+        return image
+
+
+def render_volume(backgrounds, segmentations, out_paths=None, gamma=0.65):
+    '''
+    Renders the overlays of a whole volume at once.
+    INPUT   (1) array 'backgrounds': (n, 240, 240) background modality of each slice
+            (2) array 'segmentations': (n, 208, 208) predicted classes of each slice
+            (3) list 'out_paths': if given, each overlay is written there as an 8-bit RGB png instead of being returned
+            (4) float 'gamma': gamma applied to the background
+    OUTPUT  (1) (n, 240, 240, 3) float overlays if out_paths is None
+    '''
+    images = overlay(backgrounds, segmentations, gamma)
+    if out_paths is None:
+        return images
+    from skimage import io
+    images = (images * 255 + 0.5).astype(np.uint8)
+    with span('encode_png'):
+        for image, path in zip(images, out_paths):
+            if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            io.imsave(path, image)
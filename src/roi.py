@@ -0,0 +1,45 @@
+import numpy as np
+
+
+def brain_mask(stack, dilation=2, threshold=0):
+    '''
+    Foreground (brain) mask of a slice: pixels where any modality is above threshold, grown by dilation pixels in every
+    direction. Skull-stripped BRATS slices are exactly zero outside the brain.
+    INPUT   (1) array 'stack': (n_chan, 240, 240) raw modalities, before normalization (which may shift the background)
+            (2) int 'dilation': pixels the foreground is grown by (a square of side 2 * dilation + 1)
+            (3) float 'threshold': intensities at or below this count as background
+    OUTPUT  (1) (240, 240) bool mask
+    '''
+    mask = (np.asarray(stack) > threshold).any(axis=0)
+    if dilation <= 0 or not mask.any():
+        return mask
+    # a pixel is in the dilated mask if the window around it holds any foreground, counted from an integral image
+    h, w = mask.shape
+    integral = np.zeros((h + 1, w + 1), dtype=np.int32)
+    integral[1:, 1:] = mask.cumsum(axis=0, dtype=np.int32).cumsum(axis=1)
+    r0, r1 = np.clip(np.arange(h) - dilation, 0, h), np.clip(np.arange(h) + dilation + 1, 0, h)
+    c0, c1 = np.clip(np.arange(w) - dilation, 0, w), np.clip(np.arange(w) + dilation + 1, 0, w)
+    counts = integral[r1][:, c1] - integral[r0][:, c1] - integral[r1][:, c0] + integral[r0][:, c0]
+    return counts > 0
+
+
+def output_mask(mask, patch_size=33):
+    '''
+    INPUT   (1) array 'mask': (240, 240) mask, or (n, 240, 240) masks, over the slice
+            (2) int 'patch_size': side of the patches classified
+    OUTPUT  (1) (208, 208) (or (n, 208, 208)) mask over the predicted pixels, the centres of whole patches
+    '''
+    half = patch_size // 2
+    return mask[..., half:mask.shape[-2] - half, half:mask.shape[-1] - half]
+
+
+def bounding_box(mask):
+    '''
+    INPUT   array 'mask': (h, w) mask, or (n, h, w) masks whose union is boxed
+    OUTPUT  (r0, r1, c0, c1) smallest box holding every True pixel, ends exclusive, or None if the mask is empty
+    '''
+    mask = mask.reshape((-1,) + mask.shape[-2:]).any(axis=0)
+    rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        return None
+    return rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
@@ -0,0 +1,127 @@
+import numpy as np
+import os
+import time
+import argparse
+from glob import glob
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from prediction_cache import PredictionCache
+from norm_stats import NormStats, METHODS
+from instrumentation import span
+
+
+def sort_slices(slice_paths):
+    '''
+    Sorts the slices of one patient ('<patient>_<slice>.png') by slice number.
+    '''
+    return sorted(slice_paths, key=lambda x: int(os.path.basename(x)[:-4].split('_')[-1]))
+
+
+def iter_segmentations(model, slice_paths, n_workers=4, prefetch=8, mode='auto', batch_slices=1, stats=None):
+    '''
+    Yields the predicted classes of each slice in order. Worker threads read and normalize upcoming slices while the
+    model predicts on the current ones, so decoding overlaps with inference. Slices already in the model's prediction
+    cache, if it has one, are not predicted again.
+    INPUT   (1) SegmentationModel 'model': model to segment with
+            (2) list 'slice_paths': filepaths to the slices, in order
+            (3) int 'n_workers': threads reading and normalizing slices
+            (4) int 'prefetch': slices prepared ahead of the model at most
+            (5) str 'mode': inference mode passed to predict_stack ('auto', 'dense' or 'patch')
+            (6) int 'batch_slices': slices passed to the model together
+            (7) dict 'stats': if given, filled with the seconds spent waiting for slices and predicting and the number of
+                slices found in the model's prediction cache
+    OUTPUT  generator of (index into slice_paths, (208, 208) uint8 predicted classes)
+    '''
+    cache = getattr(model, 'prediction_cache', None)
+
+    def prepare(path):
+        # returns (cache key, cached prediction or None, normalized stack and mask of pixels to predict on a miss)
+        image = model.read_image(path)
+        key = model.prediction_key(image, path) if cache is not None else None
+        cached = cache.get(key) if key is not None else None
+        if cached is not None:
+            return key, cached, None, None
+        return key, None, model.normalize(image, path), model.roi_mask(image)
+
+    stats = {} if stats is None else stats
+    stats['wait_seconds'] = stats['predict_seconds'] = 0.
+    stats['cached'] = 0
+    prefetch = max(prefetch, batch_slices)
+    with ThreadPoolExecutor(n_workers) as pool:
+        pending = deque(pool.submit(prepare, p) for p in slice_paths[:prefetch])
+        submitted = len(pending)
+        for start in range(0, len(slice_paths), batch_slices):
+            t = time.time()
+            with span('wait_for_slices'):
+                batch = [pending.popleft().result() for _ in range(min(batch_slices, len(slice_paths) - start))]
+            stats['wait_seconds'] += time.time() - t
+            while submitted < len(slice_paths) and len(pending) < prefetch:
+                pending.append(pool.submit(prepare, slice_paths[submitted]))
+                submitted += 1
+            misses = [i for i, (_, cached, _, _) in enumerate(batch) if cached is None]
+            predictions = [cached for _, cached, _, _ in batch]
+            stats['cached'] += len(batch) - len(misses)
+            if misses:
+                t = time.time()
+                masks = None if batch[misses[0]][3] is None else np.array([batch[i][3] for i in misses])
+                predicted = model.predict_stack(np.array([batch[i][2] for i in misses]), mode, mask=masks)
+                stats['predict_seconds'] += time.time() - t
+                for i, prediction in zip(misses, predicted.astype(np.uint8)):
+                    predictions[i] = prediction
+                    if batch[i][0] is not None:
+                        cache.put(batch[i][0], prediction)
+            for i, prediction in enumerate(predictions):
+                yield start + i, prediction
+
+
+def segment_volume(model, slice_paths, n_workers=4, prefetch=8, mode='auto', batch_slices=1):
+    '''
+    Segments the ordered slices of one patient, overlapping slice decoding with inference (see iter_segmentations).
+    INPUT   (1) SegmentationModel 'model': model to segment with
+            (2) list 'slice_paths': filepaths to the slices of one patient, in order
+            (3) int 'n_workers': threads reading and normalizing slices
+            (4) int 'prefetch': slices prepared ahead of the model at most
+            (5) str 'mode': inference mode passed to predict_stack ('auto', 'dense' or 'patch')
+            (6) int 'batch_slices': slices passed to the model together
+    OUTPUT  (1) (n_slices, 208, 208) array of predicted classes
+            (2) dict of timings: total seconds, slices per second and seconds spent waiting for slices and predicting
+    '''
+    volume = np.empty((len(slice_paths), 208, 208), dtype=np.uint8)
+    stats = {'slices': len(slice_paths)}
+    start = time.time()
+    with span('segment_volume'):
+        for i, segmentation in iter_segmentations(model, slice_paths, n_workers, prefetch, mode, batch_slices, stats):
+            volume[i] = segmentation
+    stats['seconds'] = time.time() - start
+    stats['slices_per_second'] = len(slice_paths) / stats['seconds'] if stats['seconds'] else 0.
+    print('Segmented {} slices in {:.2f}s ({:.2f} slices/s, {:.2f}s waiting for slices)'.format(
+        len(slice_paths), stats['seconds'], stats['slices_per_second'], stats['wait_seconds']))
+    return volume, stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Segment every slice of one patient into a label volume.')
+    parser.add_argument('slices', help="glob of the patient's slice pngs, e.g. '/vdb1/ImageData/BRATS/n4_PNG/3_*'")
+    parser.add_argument('--model', default='./models/example', help='model json/hdf5 path without extension')
+    parser.add_argument('--dual', action='store_true', help='load a Two_Models architecture instead of Segmentation_Models')
+    parser.add_argument('--out', default='volume.npy', help='.npy file to save the (n_slices, 208, 208) volume to')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--prefetch', type=int, default=8)
+    parser.add_argument('--mode', default='auto', choices=['auto', 'dense', 'patch'])
+    parser.add_argument('--prediction-cache', default=None, help='directory of the on-disk prediction cache. no caching if omitted')
+    parser.add_argument('--normalization', default='slice_max', choices=METHODS)
+    parser.add_argument('--norm-stats', default=None, help='.npz of precomputed intensity statistics, see norm_stats.py')
+    parser.add_argument('--batch-slices', type=int, default=1, help='slices passed to the model together')
+    parser.add_argument('--roi', type=int, default=None, help='only classify pixels within this many pixels of the brain')
+    args = parser.parse_args()
+
+    if args.dual:
+        from Two_Models import SegmentationModel
+    else:
+        from Segmentation_Models import SegmentationModel
+    cache = PredictionCache(args.prediction_cache) if args.prediction_cache else None
+    model = SegmentationModel(loaded_model=True, model_name=args.model, prediction_cache=cache,
+                             norm_stats=NormStats.load(args.norm_stats) if args.norm_stats else None, normalization=args.normalization,
+                             roi=args.roi)
+    volume, stats = segment_volume(model, sort_slices(glob(args.slices)), args.workers, args.prefetch, args.mode, args.batch_slices)
+    np.save(args.out, volume)
@@ -0,0 +1,91 @@
+import threading
+from collections import OrderedDict
+from instrumentation import span, count
+
+
+class SliceCache(object):
+    def __init__(self, max_bytes=2 * 1024**3):
+        '''
+        Bounded in-memory cache of decoded slices, keyed by filepath. Least recently used entries are evicted once
+        the cached arrays exceed max_bytes. Cached arrays are read-only; copy them before modifying in place.
+        INPUT   (1) int 'max_bytes': byte budget for cached arrays. defaults to 2 GB
+        '''
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        '''
+        INPUT   (1) hashable 'key': cache key, normally the filepath (plus the kind of decode)
+                (2) function 'loader': called as loader() to decode the array on a miss
+        OUTPUT  (1) read-only array for key
+        '''
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                count('slice_cache_lookups', kind=key[0], result='hit')
+                return self._entries[key]
+            self.misses += 1
+        count('slice_cache_lookups', kind=key[0], result='miss')
+        arr = loader()
+        arr.flags.writeable = False
+        with self._lock:
+            if key not in self._entries and arr.nbytes <= self.max_bytes:
+                self._entries[key] = arr
+                self.n_bytes += arr.nbytes
+                while self.n_bytes > self.max_bytes:
+                    _, old = self._entries.popitem(last=False)
+                    self.n_bytes -= old.nbytes
+                    self.evictions += 1
+        return arr
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
+
+    def stats(self):
+        '''
+        OUTPUT  dict of hit/miss/eviction counters, entry count and bytes held
+        '''
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self._entries),
+                'bytes': self.n_bytes, 'hit_rate': self.hits / float(total) if total else 0.}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# shared by every PatchLibrary and SegmentationModel that is not given its own cache
+default_cache = SliceCache()
+
+
+def read_slice(path, cache=None):
+    '''
+    INPUT   (1) str 'path': filepath to a (5*240, 240) slice png
+            (2) SliceCache 'cache': defaults to default_cache
+    OUTPUT  (1) read-only array of shape (5, 240, 240), in the integer type of the png. normalizing converts it to float
+    '''
+    cache = default_cache if cache is None else cache
+    return cache.get(('slice', path), lambda: _decode(path).reshape(5, 240, 240))
+
+
+def read_label(path, cache=None):
+    '''
+    INPUT   (1) str 'path': filepath to a (240, 240) label png
+            (2) SliceCache 'cache': defaults to default_cache
+    OUTPUT  (1) read-only label array of shape (240, 240)
+    '''
+    cache = default_cache if cache is None else cache
+    return cache.get(('label', path), lambda: _decode(path))
+
+
+def _decode(path):
+    from skimage import io
+    with span('decode_png'):
+        return io.imread(path)
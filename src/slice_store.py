@@ -0,0 +1,104 @@
+import numpy as np
+import os
+import json
+import argparse
+from glob import glob
+from label_index import progress_bar
+
+
+def slice_key(path):
+    '''
+    Key of a slice in the store: its normalised absolute path, so slices of the same name in different directories
+    (e.g. a test and a training set) are never mistaken for one another.
+    '''
+    return os.path.abspath(path)
+
+
+class SliceStore(object):
+    def __init__(self, store_dir):
+        '''
+        Read-only view of a slice store written by pack_slices. Slices and labels are memory-mapped, so image and
+        label return zero-copy views served from the page cache instead of decoding pngs.
+        INPUT   (1) str 'store_dir': directory holding images.npy, labels.npy and index.json
+        '''
+        self.store_dir = store_dir
+        self.images = np.load(os.path.join(store_dir, 'images.npy'), mmap_mode='r')
+        self.labels = np.load(os.path.join(store_dir, 'labels.npy'), mmap_mode='r')
+        with open(os.path.join(store_dir, 'index.json')) as f:
+            meta = json.load(f)
+        self.offsets = meta['offsets']
+        self.has_label = set(meta['labelled'])
+
+    def __contains__(self, path):
+        return slice_key(path) in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def image(self, path):
+        '''
+        INPUT   str 'path': filepath of a packed slice
+        OUTPUT  read-only view of shape (5, 240, 240) in the dtype of the source pngs
+        '''
+        return self.images[self.offsets[slice_key(path)]]
+
+    def labelled(self, path):
+        '''
+        True if the slice at path was packed together with its label.
+        '''
+        return slice_key(path) in self.has_label
+
+    def label(self, path):
+        '''
+        INPUT   str 'path': filepath of a packed slice, not of its label
+        OUTPUT  read-only view of shape (240, 240). raises KeyError if the slice was packed without a label, see labelled
+        '''
+        key = slice_key(path)
+        if key not in self.has_label:
+            raise KeyError('No label packed for {}'.format(path))
+        return self.labels[self.offsets[key]]
+
+
+def pack_slices(image_paths, label_dir, store_dir):
+    '''
+    Packs every slice png, and its '<name>L.png' label where one exists, into one contiguous memory-mappable store.
+    INPUT   (1) list 'image_paths': filepaths to (5*240, 240) slice pngs
+            (2) str 'label_dir': directory holding the labels. slices without one are packed unlabelled, see SliceStore.labelled
+            (3) str 'store_dir': directory to write images.npy, labels.npy and index.json to
+    OUTPUT  (1) SliceStore over the written files
+    '''
+    from skimage import io
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    image_paths = sorted(image_paths)
+    first = io.imread(image_paths[0])
+    images = np.lib.format.open_memmap(os.path.join(store_dir, 'images.npy'), mode='w+', dtype=first.dtype,
+                                       shape=(len(image_paths), 5, 240, 240))
+    labels = np.lib.format.open_memmap(os.path.join(store_dir, 'labels.npy'), mode='w+', dtype=np.uint8,
+                                       shape=(len(image_paths), 240, 240))
+    offsets, labelled = {}, []
+    print('Packing {} slices into {}...'.format(len(image_paths), store_dir))
+    bar = progress_bar()
+    for i in bar(range(len(image_paths))):
+        fn, key = os.path.basename(image_paths[i]), slice_key(image_paths[i])
+        images[i] = io.imread(image_paths[i]).reshape(5, 240, 240)
+        label_path = os.path.join(label_dir, fn[:-4] + 'L.png')
+        if os.path.exists(label_path):
+            labels[i] = io.imread(label_path)
+            labelled.append(key)
+        offsets[key] = i
+    images.flush()
+    labels.flush()
+    with open(os.path.join(store_dir, 'index.json'), 'w') as f:
+        json.dump({'offsets': offsets, 'labelled': labelled}, f)
+    print('Done.')
+    return SliceStore(store_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack slice and label pngs into a memory-mapped store.')
+    parser.add_argument('--images', default='/vdb1/ImageData/n4_PNG/**', help='glob of slice pngs')
+    parser.add_argument('--labels', default='/vdb1/ImageData/Labels/', help='directory of label pngs')
+    parser.add_argument('--out', default='/vdb1/ImageData/store', help='directory to write the store to')
+    args = parser.parse_args()
+    pack_slices(glob(args.images), args.labels, args.out)
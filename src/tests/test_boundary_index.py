@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from boundary_index import label_entropy, slice_boundaries
+
+
+def naive_entropy(label, radius, n_classes=5):
+    h, w = label.shape
+    out = np.zeros((h, w))
+    for r in range(h):
+        for c in range(w):
+            window = label[max(r - radius, 0):r + radius + 1, max(c - radius, 0):c + radius + 1]
+            p = np.bincount(window.ravel(), minlength=n_classes) / float(window.size)
+            p = p[p > 0]
+            out[r, c] = -(p * np.log2(p)).sum()
+    return out
+
+
+def test_label_entropy_matches_window_counts():
+    rng = np.random.RandomState(0)
+    label = np.zeros((20, 24), np.uint8)
+    label[5:12, 6:15] = 2
+    label[8:10, 9:11] = 4
+    label[15:, :] = rng.randint(0, 5, (5, 24))
+    ent = label_entropy(label, 2)
+    assert ent.dtype == np.float32
+    np.testing.assert_allclose(ent, naive_entropy(label, 2), atol=1e-5)
+
+
+def test_entropy_of_a_two_class_window():
+    label = np.zeros((9, 9), np.uint8)
+    label[:, 5:] = 1
+    # the 3x3 window around (4, 4) holds 3 pixels of class 1 out of 9, around (4, 5) six
+    ent = label_entropy(label, 1)
+    p = np.array([1 / 3., 2 / 3.])
+    assert ent[4, 4] == ent[4, 5]
+    assert ent[4, 4] == pytest.approx(-(p * np.log2(p)).sum(), rel=1e-6)
+    assert ent[4, 0] == 0
+
+
+def test_slice_boundaries_rank_inner_pixels_by_entropy():
+    label = np.zeros((40, 40), np.uint8)
+    label[10:30, 10:30] = 1
+    label[18:22, 18:22] = 3
+    coords, scores, classes = slice_boundaries(label, radius=2, percentile=90, border=5)
+    assert len(coords)
+    assert (coords >= 5).all() and (coords < 35).all()
+    assert (np.diff(scores.astype(np.float32)) <= 0).all()
+    np.testing.assert_array_equal(classes, label[coords[:, 0], coords[:, 1]])
+    assert len(slice_boundaries(np.zeros((40, 40), np.uint8), 2, border=5)[0]) == 0
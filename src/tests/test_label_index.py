@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+from label_index import LabelIndex, load_or_build
+
+pytest.importorskip('progressbar')
+
+
+def make_slices():
+    '''
+    Two 240x240 slices: 'a' holds 12 pixels of class 4 and 'b' only 3, so with min_pixels=10 class 4 is indexed in 'a'
+    only. both are brain (nonzero) in their top half and empty below.
+    '''
+    labels, images = {}, {}
+    for name, n4 in (('/data/a_1.png', 12), ('/data/b_1.png', 3)):
+        label = np.zeros((240, 240), np.uint8)
+        label[50, 60:60 + n4] = 4
+        label[100:110, 100:110] = 2
+        image = np.zeros((5, 240, 240), np.uint16)
+        image[:, :120] = 1
+        labels[name], images[name] = label, image
+    return labels, images
+
+
+def build(**kwargs):
+    labels, images = make_slices()
+    return LabelIndex.build(sorted(labels), labels.__getitem__, min_pixels=10, **kwargs), labels
+
+
+def test_build_leaves_out_slices_with_too_few_pixels():
+    index, _ = build()
+    assert [index.paths[s] for s in index.slices[4]] == ['/data/a_1.png']
+    assert len(index.coords[4]) == 12
+    assert [index.paths[s] for s in index.slices[2]] == ['/data/a_1.png', '/data/b_1.png']
+    assert len(index.slices[1]) == 0
+    np.testing.assert_array_equal(index.offsets[2], [0, 100, 200])
+
+
+def test_brain_only_indexes_class_0_inside_the_brain():
+    labels, images = make_slices()
+    index = LabelIndex.build(sorted(labels), labels.__getitem__, min_pixels=10, load_image=images.__getitem__)
+    assert index.brain_only
+    assert index.coords[0][:, 0].max() < 120
+    # top half less the class 2 square and the class 4 run, per slice
+    assert len(index.coords[0]) == (120 * 240 - 100 - 12) + (120 * 240 - 100 - 3)
+
+
+def test_sample_draws_pixels_of_the_class():
+    index, labels = build()
+    rng = np.random.RandomState(0)
+    for c in (2, 4):
+        s, p = index.sample(c, 500, rng)
+        assert s.shape == (500,) and p.shape == (500, 2)
+        for sl, (r, col) in zip(s, p):
+            assert labels[index.paths[sl]][r, col] == c
+    s, _ = index.sample(2, 500, rng)
+    assert set(s) == {0, 1}
+
+
+def test_sample_of_absent_class_raises():
+    index, _ = build()
+    with pytest.raises(ValueError):
+        index.sample(1)
+
+
+def test_covers_exactly_the_indexed_slices():
+    index, _ = build()
+    assert index.covers(['/data/b_1.png', '/data/a_1.png'])
+    assert not index.covers(['/data/a_1.png'])
+    assert not index.covers(['/data/a_1.png', '/data/b_1.png', '/other/a_1.png'])
+
+
+def test_save_load_round_trip(tmp_path):
+    index, _ = build()
+    path = str(tmp_path / 'index.npz')
+    index.save(path)
+    loaded = LabelIndex.load(path)
+    assert loaded.paths == index.paths and loaded.classes == index.classes and not loaded.brain_only
+    for c in index.classes:
+        np.testing.assert_array_equal(loaded.slices[c], index.slices[c])
+        np.testing.assert_array_equal(loaded.offsets[c], index.offsets[c])
+        np.testing.assert_array_equal(loaded.coords[c], index.coords[c])
+
+
+def test_load_or_build_rebuilds_for_other_slices(tmp_path):
+    labels, images = make_slices()
+    path = str(tmp_path / 'index.npz')
+    load_or_build(path, ['/data/a_1.png'], labels.__getitem__, min_pixels=10)
+    index = load_or_build(path, sorted(labels), labels.__getitem__, min_pixels=10)
+    assert index.covers(sorted(labels))
+    assert LabelIndex.load(path).covers(sorted(labels))
+
+
+def test_load_or_build_rebuilds_for_other_min_pixels(tmp_path):
+    labels, _ = make_slices()
+    path = str(tmp_path / 'index.npz')
+    load_or_build(path, sorted(labels), labels.__getitem__, min_pixels=10)
+    assert LabelIndex.load(path).min_pixels == 10
+    index = load_or_build(path, sorted(labels), labels.__getitem__, min_pixels=3)
+    assert [index.paths[s] for s in index.slices[4]] == ['/data/a_1.png', '/data/b_1.png']
+    assert LabelIndex.load(path).min_pixels == 3
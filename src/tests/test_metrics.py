@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+from metrics import DiceAccumulator, confusion_matrix, dice, pad_to_label, precision_recall_f1
+
+# (true, predicted) pairs (0,0) (1,1) (2,1) (3,3) / (4,4) (4,0) (0,2) (2,2)
+LABEL = np.array([[0, 1, 2, 3], [4, 4, 0, 2]])
+SEGMENTATION = np.array([[0, 1, 1, 3], [4, 0, 2, 2]])
+
+
+def test_confusion_matrix():
+    cm = confusion_matrix(SEGMENTATION, LABEL)
+    expected = np.zeros((5, 5), dtype=np.int64)
+    for t, p in [(0, 0), (1, 1), (2, 1), (3, 3), (4, 4), (4, 0), (0, 2), (2, 2)]:
+        expected[t, p] += 1
+    np.testing.assert_array_equal(cm, expected)
+
+
+def test_region_dice():
+    cm = confusion_matrix(SEGMENTATION, LABEL)
+    # whole: 6 true and 6 predicted tumour pixels, 5 in both
+    assert dice(cm, (1, 2, 3, 4)) == pytest.approx(2. * 5 / 12)
+    # core: 4 true and 4 predicted pixels of classes 1, 3 and 4, 3 in both
+    assert dice(cm, (1, 3, 4)) == pytest.approx(2. * 3 / 8)
+    # enhancing: 2 true and 1 predicted pixel of class 4, 1 in both
+    assert dice(cm, (4,)) == pytest.approx(2. * 1 / 3)
+
+
+def test_dice_of_empty_region_is_nan():
+    cm = confusion_matrix(np.zeros((2, 2)), np.zeros((2, 2)))
+    assert np.isnan(dice(cm, (4,)))
+
+
+def test_precision_recall_f1():
+    table = precision_recall_f1(confusion_matrix(SEGMENTATION, LABEL))
+    expected = np.array([[.5, .5, .5, 2],
+                         [.5, 1., 2. / 3, 1],
+                         [.5, .5, .5, 2],
+                         [1., 1., 1., 1],
+                         [1., .5, 2. / 3, 2]])
+    np.testing.assert_allclose(table, expected)
+
+
+def test_precision_recall_f1_of_absent_class_is_zero():
+    table = precision_recall_f1(confusion_matrix(np.zeros((2, 2)), np.zeros((2, 2))))
+    np.testing.assert_array_equal(table[1:], 0)
+    np.testing.assert_array_equal(table[0], [1, 1, 1, 4])
+
+
+def test_predictions_are_edge_padded_to_the_label():
+    segmentation = np.arange(208 * 208).reshape(208, 208)
+    padded = pad_to_label(segmentation, (240, 240))
+    assert padded.shape == (240, 240)
+    np.testing.assert_array_equal(padded[16:-16, 16:-16], segmentation)
+    assert padded[0, 0] == segmentation[0, 0] and padded[-1, -1] == segmentation[-1, -1]
+    assert pad_to_label(padded, (240, 240)) is padded
+
+
+def test_accumulator_sums_updates_and_patients():
+    acc = DiceAccumulator()
+    acc.update(SEGMENTATION[:1], LABEL[:1], patient='a')
+    acc.update(SEGMENTATION[1:], LABEL[1:], patient='b')
+    other = DiceAccumulator()
+    other.update(SEGMENTATION[1:], LABEL[1:], patient='b')
+    acc.merge(other)
+
+    cm = confusion_matrix(SEGMENTATION, LABEL) + confusion_matrix(SEGMENTATION[1:], LABEL[1:])
+    np.testing.assert_array_equal(acc.cm, cm)
+    np.testing.assert_array_equal(acc.patients['b'], 2 * confusion_matrix(SEGMENTATION[1:], LABEL[1:]))
+
+    scores = acc.scores(confusion_matrix(SEGMENTATION, LABEL))
+    assert scores['Total Slice'] == pytest.approx(5. / 8)
+    assert scores['Whole Tumor'] == pytest.approx(5. / 6)
+    assert scores['Core Tumor'] == pytest.approx(.75)
+    assert scores['Enhancing Tumor'] == pytest.approx(2. / 3)
+    assert scores['Class 3'] == pytest.approx(1.)
+    # patient a holds (0,0) (1,1) (2,1) (3,3): no enhancing pixel at all
+    assert np.isnan(acc.patient_scores()['a']['Enhancing Tumor'])
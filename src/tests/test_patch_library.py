@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from patch_library import centre_crop, check_raw_dtype, extract_patches
+
+
+def naive_patches(stack, centres, h, w):
+    return np.array([stack[:, r - h // 2:r - h // 2 + h, c - w // 2:c - w // 2 + w] for r, c in centres])
+
+
+@pytest.mark.parametrize('patch_size', [(33, 33), (5, 5), (4, 6)])
+def test_extract_patches_matches_slicing(patch_size):
+    rng = np.random.RandomState(0)
+    stack = rng.randint(0, 4000, (3, 40, 50)).astype(np.uint16)
+    h, w = patch_size
+    centres = np.array([[h // 2, w // 2], [40 - (h + 1) // 2, 50 - (w + 1) // 2], [20, 25], [20, 25], [h // 2, 30]])
+    patches = extract_patches(stack, centres, patch_size, normalize=False, dtype=stack.dtype)
+    np.testing.assert_array_equal(patches, naive_patches(stack, centres, h, w))
+
+
+def test_extract_patches_normalizes_each_channel_of_each_patch():
+    rng = np.random.RandomState(1)
+    stack = rng.randint(0, 4000, (2, 20, 20)).astype(np.uint16)
+    stack[1] = 0
+    centres = np.array([[5, 5], [12, 9]])
+    out = np.empty((2, 2, 7, 7), np.float16)
+    extract_patches(stack, centres, (7, 7), out=out)
+    expected = naive_patches(stack, centres, 7, 7).astype(np.float32)
+    expected[:, 0] /= expected[:, 0].max(axis=(1, 2))[:, np.newaxis, np.newaxis]
+    np.testing.assert_allclose(out, expected, rtol=1e-3)
+    assert not out[:, 1].any()
+
+
+def test_extract_patches_rejects_centres_near_the_border():
+    stack = np.zeros((1, 20, 20))
+    with pytest.raises(ValueError):
+        extract_patches(stack, np.array([[2, 10]]), (7, 7))
+    with pytest.raises(ValueError):
+        extract_patches(stack, np.array([[10, 17]]), (7, 7))
+
+
+@pytest.mark.parametrize('n, rows', [(5, [14, 15, 16, 17, 18]), (4, [14, 15, 16, 17]), (33, list(range(33)))])
+def test_centre_crop_is_a_view_of_the_centre(n, rows):
+    patches = np.arange(2 * 3 * 33 * 33).reshape(2, 3, 33, 33)
+    crop = centre_crop(patches, n)
+    np.testing.assert_array_equal(crop, patches[:, :, rows][:, :, :, rows])
+    assert np.shares_memory(crop, patches)
+
+
+def test_centre_crop_larger_than_the_patch_raises():
+    with pytest.raises(ValueError):
+        centre_crop(np.zeros((1, 1, 5, 5)), 7)
+
+
+def test_raw_float16_patches_are_rejected():
+    with pytest.raises(ValueError):
+        check_raw_dtype(np.float16, normalize=False)
+    check_raw_dtype(np.float16, normalize=True)
+    check_raw_dtype(np.float32, normalize=False)
@@ -0,0 +1,45 @@
+import numpy as np
+from prediction_cache import PredictionCache, slice_key
+
+
+def test_slice_key_changes_with_every_input():
+    image = np.arange(5 * 4 * 4, dtype=np.uint16).reshape(5, 4, 4)
+    key = slice_key('model', image, (0, 2, 3))
+    assert key == slice_key('model', image.copy(), (0, 2, 3))
+    changed = image.copy()
+    changed[4, 3, 3] += 1
+    others = [slice_key('other', image, (0, 2, 3)),
+              slice_key('model', changed, (0, 2, 3)),
+              slice_key('model', image, (0, 1, 2, 3)),
+              slice_key('model', image, (0, 2, 3), kind='probabilities'),
+              slice_key('model', image.astype(np.float32), (0, 2, 3)),
+              slice_key('model', image.reshape(5, 2, 8), (0, 2, 3))]
+    assert len(set(others + [key])) == len(others) + 1
+
+
+def test_slice_key_of_a_view_matches_a_copy():
+    image = np.arange(2 * 6 * 6, dtype=np.uint16).reshape(2, 6, 6)
+    assert slice_key('m', image[:, ::2, ::2], (0,)) == slice_key('m', image[:, ::2, ::2].copy(), (0,))
+
+
+def test_put_get_round_trip_and_miss(tmp_path):
+    cache = PredictionCache(str(tmp_path))
+    prediction = np.arange(16, dtype=np.uint8).reshape(4, 4)
+    assert cache.get('a') is None
+    cache.put('a', prediction)
+    np.testing.assert_array_equal(cache.get('a'), prediction)
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+    assert cache.stats()['entries'] == 1
+
+
+def test_least_recently_read_entries_are_evicted(tmp_path):
+    import os
+    arr = np.zeros(1000, np.uint8)
+    cache = PredictionCache(str(tmp_path), max_bytes=10 ** 6)
+    for i, key in enumerate('abc'):
+        cache.put(key, arr)
+        os.utime(cache._path(key), (i, i))
+    cache.max_bytes = 3 * os.path.getsize(cache._path('a')) - 1
+    cache.put('d', arr)
+    assert cache.get('a') is None and cache.get('b') is None
+    assert cache.get('c') is not None and cache.get('d') is not None
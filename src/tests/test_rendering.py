@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from rendering import COLOURS, load_backgrounds, overlay
+
+pytest.importorskip('skimage')
+
+
+def test_overlay_paints_classes_over_the_gamma_adjusted_background():
+    background = np.full((240, 240), 0.25)
+    segmentation = np.zeros((208, 208), np.int64)
+    segmentation[0, 0] = 1
+    segmentation[100, 50] = 4
+    image = overlay(background, segmentation, gamma=0.5)
+    assert image.shape == (240, 240, 3)
+    # predictions are edge-padded by 16 pixels, so class 1 covers the top-left 17x17 corner
+    np.testing.assert_allclose(image[:17, :17], np.broadcast_to(COLOURS[1], (17, 17, 3)))
+    np.testing.assert_allclose(image[116, 66], COLOURS[4])
+    np.testing.assert_allclose(image[200, 200], [0.5, 0.5, 0.5])
+
+
+def test_overlay_of_a_volume_matches_each_slice():
+    rng = np.random.RandomState(0)
+    backgrounds = rng.random_sample((3, 240, 240))
+    segmentations = rng.randint(0, 5, (3, 208, 208))
+    volume = overlay(backgrounds, segmentations)
+    for b, s, v in zip(backgrounds, segmentations, volume):
+        np.testing.assert_allclose(overlay(b, s), v)
+
+
+def test_backgrounds_come_from_the_reader():
+    slices = {'a': np.arange(5 * 240 * 240).reshape(5, 240, 240)}
+    np.testing.assert_array_equal(load_backgrounds(['a'], slices.__getitem__), slices['a'][-2][np.newaxis])
@@ -0,0 +1,40 @@
+import numpy as np
+from roi import bounding_box, brain_mask, output_mask
+
+
+def naive_dilation(mask, d):
+    h, w = mask.shape
+    out = np.zeros_like(mask)
+    for r, c in np.argwhere(mask):
+        out[max(r - d, 0):r + d + 1, max(c - d, 0):c + d + 1] = True
+    return out
+
+
+def test_brain_mask_is_the_dilated_foreground():
+    stack = np.zeros((3, 30, 30), np.uint16)
+    stack[0, 10, 10] = 5
+    stack[2, 0, 29] = 1
+    stack[1, 20:23, 5:8] = 7
+    mask = brain_mask(stack, dilation=2)
+    np.testing.assert_array_equal(mask, naive_dilation(stack.any(axis=0), 2))
+    np.testing.assert_array_equal(brain_mask(stack, dilation=0), stack.any(axis=0))
+    assert not brain_mask(stack, threshold=7).any()
+    assert not brain_mask(np.zeros((3, 30, 30))).any()
+
+
+def test_output_mask_keeps_patch_centres():
+    mask = np.zeros((240, 240), bool)
+    mask[16, 16] = mask[223, 223] = mask[15, 100] = True
+    out = output_mask(mask)
+    assert out.shape == (208, 208)
+    np.testing.assert_array_equal(np.argwhere(out), [[0, 0], [207, 207]])
+    assert output_mask(np.zeros((4, 240, 240), bool)).shape == (4, 208, 208)
+
+
+def test_bounding_box():
+    mask = np.zeros((2, 10, 12), bool)
+    assert bounding_box(mask) is None
+    mask[0, 2, 3] = True
+    assert bounding_box(mask[0]) == (2, 3, 3, 4)
+    mask[1, 7, 10] = True
+    assert bounding_box(mask) == (2, 8, 3, 11)
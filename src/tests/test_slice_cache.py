@@ -0,0 +1,51 @@
+import numpy as np
+from slice_cache import SliceCache
+
+
+def loader(value, n=100):
+    calls = []
+
+    def load():
+        calls.append(value)
+        return np.full(n, value, np.uint8)
+    return load, calls
+
+
+def test_hits_do_not_reload_and_are_read_only():
+    cache = SliceCache(1000)
+    load, calls = loader(1)
+    first = cache.get(('slice', 'a'), load)
+    second = cache.get(('slice', 'a'), load)
+    assert second is first and calls == [1]
+    assert not first.flags.writeable
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SliceCache(300)
+    for name in 'abc':
+        cache.get(('slice', name), loader(0)[0])
+    # touch 'a', so 'b' is now the least recently used
+    cache.get(('slice', 'a'), loader(0)[0])
+    cache.get(('slice', 'd'), loader(0)[0])
+    assert len(cache) == 3 and cache.n_bytes == 300 and cache.evictions == 1
+    load, calls = loader(0)
+    cache.get(('slice', 'a'), load)
+    cache.get(('slice', 'c'), load)
+    assert calls == []
+    cache.get(('slice', 'b'), load)
+    assert calls == [0]
+
+
+def test_arrays_larger_than_the_budget_are_not_cached():
+    cache = SliceCache(50)
+    load, calls = loader(0, n=100)
+    cache.get(('slice', 'a'), load)
+    cache.get(('slice', 'a'), load)
+    assert calls == [0, 0] and len(cache) == 0 and cache.n_bytes == 0
+
+
+def test_zero_budget_caches_nothing():
+    cache = SliceCache(0)
+    cache.get(('label', 'a'), loader(0, n=1)[0])
+    assert len(cache) == 0